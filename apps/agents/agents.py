@@ -45,10 +45,23 @@ except ImportError:
 
 # Import tools and storage helpers
 from tools import Tool
+from step_analysis import analyze_steps
+from pattern_detection import iter_patterns, summarize_patterns
+from llm_cache import cached_recommendations
+from snapshot import CompetitionSnapshot, load_competition_snapshot, use_snapshot, snapshot_for
+from incremental_fairness import (
+    FAIRNESS_INCREMENTAL,
+    build_user_stats,
+    score_increment,
+    recent_steps_by_user,
+    watermark_query_start
+)
 from agents_storage import (
-    get_competitions,
-    get_user_steps,
-    get_teams_for_competition,
+    get_daily_rollup,
+    get_missing_submitters,
+    get_steps_written_since,
+    get_fairness_state,
+    save_fairness_state,
     flag_unfair_data,
     get_flagged_data
 )
@@ -107,33 +120,36 @@ class SyncAgent:
         def check_missing_data(comp_id: str, date: str) -> Dict[str, Any]:
             """Check for users who haven't submitted step data for a specific competition and date"""
             try:
-                competition = None
-                competitions = get_competitions(comp_id=comp_id)
-                if competitions:
-                    competition = competitions[0]
-                
-                if not competition:
+                snapshot = snapshot_for(comp_id)
+                if not snapshot.competition:
                     return {"error": "Competition not found"}
                 
-                teams = get_teams_for_competition(comp_id)
-                all_user_ids = set()
-                for team in teams:
-                    all_user_ids.update(team.get("members", []))
+                all_user_ids = set(snapshot.members)
                 
+                # The submission bitmap (kept on ingest, rebuilt by the daily rollup job)
+                # answers this without reading every user's history
+                source = "bitmap"
                 users_with_data = set()
-                steps_data = []
-                for uid in all_user_ids:
-                    user_steps = get_user_steps(uid, comp_id)
-                    for step_entry in user_steps:
-                        if step_entry.get("date") == date:
+                # A bitmap older than the day's rollup missed its rebuild; read the steps then
+                rollup = get_daily_rollup(comp_id, date)
+                missing_from_bitmap = get_missing_submitters(
+                    comp_id, date, list(all_user_ids), not_before=rollup.get("updated_at") if rollup else None
+                )
+                if missing_from_bitmap is not None:
+                    users_with_data = all_user_ids - missing_from_bitmap
+                else:
+                    source = "steps"
+                    for uid in all_user_ids:
+                        if any(step_entry.get("date") == date for step_entry in snapshot.steps_by_user.get(uid, [])):
                             users_with_data.add(uid)
-                            steps_data.append(step_entry)
                 
-                missing_users = list(all_user_ids - users_with_data)
+                # Sorted: set order varies across processes and would change the LLM cache key
+                missing_users = sorted(all_user_ids - users_with_data)
                 
                 return {
                     "comp_id": comp_id,
                     "date": date,
+                    "source": source,
                     "total_users": len(all_user_ids),
                     "users_with_data": len(users_with_data),
                     "missing_users": missing_users,
@@ -166,27 +182,16 @@ class SyncAgent:
         def check_late_data(comp_id: str, grace_days: int = 2) -> Dict[str, Any]:
             """Check for data submitted after competition end date (with grace period)"""
             try:
-                competition = None
-                competitions = get_competitions(comp_id=comp_id)
-                if competitions:
-                    competition = competitions[0]
-                
-                if not competition:
+                snapshot = snapshot_for(comp_id)
+                if not snapshot.competition:
                     return {"error": "Competition not found"}
                 
-                end_date = datetime.strptime(competition.get("end_date"), "%Y-%m-%d").date()
-                grace_end_date = end_date + timedelta(days=grace_days)
+                grace_end_date = snapshot.end_date + timedelta(days=grace_days)
                 today = datetime.now().date()
                 
                 late_entries = []
-                teams = get_teams_for_competition(comp_id)
-                all_user_ids = set()
-                for team in teams:
-                    all_user_ids.update(team.get("members", []))
-                
-                for uid in all_user_ids:
-                    user_steps = get_user_steps(uid, comp_id)
-                    for step_entry in user_steps:
+                for uid in snapshot.members:
+                    for step_entry in snapshot.user_steps(uid):
                         entry_date = datetime.strptime(step_entry.get("date"), "%Y-%m-%d").date()
                         if entry_date > grace_end_date:
                             late_entries.append({
@@ -256,13 +261,14 @@ class SyncAgent:
             func=notify_fairness_agent
         )
     
-    def run(self, comp_id: str, date: Optional[str] = None) -> Dict[str, Any]:
+    def run(self, comp_id: str, date: Optional[str] = None, snapshot: Optional[CompetitionSnapshot] = None) -> Dict[str, Any]:
         """
         Run sync agent workflow
         
         Args:
             comp_id: Competition ID to analyze
             date: Specific date to check (default: today)
+            snapshot: Competition data already loaded for this run (loaded here if omitted)
         
         Returns:
             Dictionary with sync agent actions and findings
@@ -273,50 +279,42 @@ class SyncAgent:
         actions = []
         findings = []
         
-        # Use tools to analyze data
-        if self.tools:
-            # Check for missing data
-            missing_data_tool = next((t for t in self.tools if t.name == "check_missing_data"), None)
-            if missing_data_tool:
-                missing_result = missing_data_tool.func(comp_id, date)
-                findings.append(missing_result)
-                
-                if missing_result.get("missing_count", 0) > 0:
-                    actions.append({
-                        "type": "missing_data_detected",
-                        "count": missing_result.get("missing_count"),
-                        "users": missing_result.get("missing_users", [])
-                    })
-            
-            # Check for late data
-            late_data_tool = next((t for t in self.tools if t.name == "check_late_data"), None)
-            if late_data_tool:
-                late_result = late_data_tool.func(comp_id)
-                findings.append(late_result)
+        with use_snapshot(snapshot or load_competition_snapshot(comp_id)):
+            # Use tools to analyze data
+            if self.tools:
+                # Check for missing data
+                missing_data_tool = next((t for t in self.tools if t.name == "check_missing_data"), None)
+                if missing_data_tool:
+                    missing_result = missing_data_tool.func(comp_id, date)
+                    findings.append(missing_result)
+                    
+                    if missing_result.get("missing_count", 0) > 0:
+                        actions.append({
+                            "type": "missing_data_detected",
+                            "count": missing_result.get("missing_count"),
+                            "users": missing_result.get("missing_users", [])
+                        })
                 
-                if late_result.get("late_count", 0) > 0:
-                    actions.append({
-                        "type": "late_data_detected",
-                        "count": late_result.get("late_count"),
-                        "entries": late_result.get("late_entries", [])
-                    })
+                # Check for late data
+                late_data_tool = next((t for t in self.tools if t.name == "check_late_data"), None)
+                if late_data_tool:
+                    late_result = late_data_tool.func(comp_id)
+                    findings.append(late_result)
+                    
+                    if late_result.get("late_count", 0) > 0:
+                        actions.append({
+                            "type": "late_data_detected",
+                            "count": late_result.get("late_count"),
+                            "entries": late_result.get("late_entries", [])
+                        })
         
-        # Use Gemini for intelligent analysis if available
-        if gemini_model and findings:
-            try:
-                prompt = f"""
-                Analyze this step competition sync data and provide recommendations:
-                {findings}
-                
-                Provide 2-3 actionable recommendations for improving data collection.
-                """
-                response = gemini_model.generate_content(prompt)
-                recommendations = response.text if response else None
-            except Exception as e:
-                logging.warning(f"Gemini analysis failed: {e}")
-                recommendations = None
-        else:
-            recommendations = None
+        # Use Gemini for intelligent analysis if available (digest of the findings, cached)
+        recommendations = cached_recommendations(
+            gemini_model,
+            "sync",
+            "Analyze this step competition sync data and provide 2-3 actionable recommendations for improving data collection.",
+            findings
+        )
         
         return {
             "ok": True,
@@ -369,73 +367,24 @@ class FairnessAgent:
         def analyze_step_data(comp_id: str, user_id: Optional[str] = None) -> Dict[str, Any]:
             """Analyze step data for anomalies like unrealistic step counts"""
             try:
-                competition = None
-                competitions = get_competitions(comp_id=comp_id)
-                if competitions:
-                    competition = competitions[0]
-                
-                if not competition:
+                snapshot = snapshot_for(comp_id)
+                if not snapshot.competition:
                     return {"error": "Competition not found"}
                 
-                start_date = datetime.strptime(competition.get("start_date"), "%Y-%m-%d").date()
-                end_date = datetime.strptime(competition.get("end_date"), "%Y-%m-%d").date()
-                
-                teams = get_teams_for_competition(comp_id)
-                all_user_ids = set()
-                for team in teams:
-                    all_user_ids.update(team.get("members", []))
-                
+                # A single user is still compared against the whole population
+                users = snapshot.members
+                all_user_ids = set(users)
+                analysis = analyze_steps(users, snapshot.start_date, snapshot.end_date, snapshot.steps_by_user, snapshot.step_matrix())
+                anomalies = analysis["anomalies"]
                 if user_id:
-                    all_user_ids = {user_id} if user_id in all_user_ids else set()
-                
-                anomalies = []
-                all_data = []
-                
-                for uid in all_user_ids:
-                    user_steps = get_user_steps(uid, comp_id)
-                    user_total = 0
-                    daily_counts = []
-                    
-                    for step_entry in user_steps:
-                        entry_date = datetime.strptime(step_entry.get("date"), "%Y-%m-%d").date()
-                        if start_date <= entry_date <= end_date:
-                            steps = step_entry.get("steps", 0)
-                            user_total += steps
-                            daily_counts.append(steps)
-                            all_data.append({
-                                "user_id": uid,
-                                "date": step_entry.get("date"),
-                                "steps": steps
-                            })
-                    
-                    # Detect anomalies
-                    if daily_counts:
-                        avg_steps = sum(daily_counts) / len(daily_counts)
-                        max_steps = max(daily_counts)
-                        
-                        # Flag if daily steps > 50,000 (unrealistic for most people)
-                        if max_steps > 50000:
-                            anomalies.append({
-                                "user_id": uid,
-                                "type": "unrealistic_daily_count",
-                                "max_steps": max_steps,
-                                "date": next((d["date"] for d in all_data if d["user_id"] == uid and d["steps"] == max_steps), None),
-                                "severity": "high"
-                            })
-                        
-                        # Flag if average > 30,000 (sustained high activity)
-                        if avg_steps > 30000:
-                            anomalies.append({
-                                "user_id": uid,
-                                "type": "sustained_high_activity",
-                                "avg_steps": avg_steps,
-                                "severity": "medium"
-                            })
+                    anomalies = [a for a in anomalies if a.get("user_id") == user_id]
                 
                 return {
                     "comp_id": comp_id,
-                    "users_analyzed": len(all_user_ids),
-                    "total_data_points": len(all_data),
+                    "users_analyzed": (1 if user_id in all_user_ids else 0) if user_id else len(users),
+                    "total_data_points": analysis["data_points"],
+                    "method": analysis["method"],
+                    "population": analysis["population"],
                     "anomalies": anomalies,
                     "anomaly_count": len(anomalies),
                     "status": "anomalies_detected" if anomalies else "no_anomalies"
@@ -499,63 +448,17 @@ class FairnessAgent:
         def check_patterns(comp_id: str) -> Dict[str, Any]:
             """Check for suspicious patterns across all users"""
             try:
-                # Get all data for competition
-                teams = get_teams_for_competition(comp_id)
-                all_user_ids = set()
-                for team in teams:
-                    all_user_ids.update(team.get("members", []))
-                
-                patterns = {
-                    "identical_values": [],  # Multiple users with exact same step counts
-                    "round_numbers": [],  # Suspicious round numbers (10000, 20000, etc.)
-                    "perfect_days": []  # Users with only perfect round numbers
-                }
-                
-                daily_data = {}  # date -> {steps: [user_ids]}
+                snapshot = snapshot_for(comp_id)
                 
-                for uid in all_user_ids:
-                    user_steps = get_user_steps(uid, comp_id)
-                    round_count = 0
-                    for step_entry in user_steps:
-                        steps = step_entry.get("steps", 0)
-                        date = step_entry.get("date")
-                        
-                        # Check for round numbers
-                        if steps % 10000 == 0 and steps > 0:
-                            patterns["round_numbers"].append({
-                                "user_id": uid,
-                                "date": date,
-                                "steps": steps
-                            })
-                            round_count += 1
-                        
-                        # Track by date for identical value detection
-                        if date not in daily_data:
-                            daily_data[date] = {}
-                        if steps not in daily_data[date]:
-                            daily_data[date][steps] = []
-                        daily_data[date][steps].append(uid)
-                
-                # Find identical values (multiple users with same steps on same day)
-                for date, step_counts in daily_data.items():
-                    for steps, user_ids in step_counts.items():
-                        if len(user_ids) > 2 and steps > 10000:  # Suspicious if >2 users have same high count
-                            patterns["identical_values"].append({
-                                "date": date,
-                                "steps": steps,
-                                "users": user_ids,
-                                "count": len(user_ids)
-                            })
-                
-                suspicious_count = (
-                    len(patterns["identical_values"]) +
-                    len(patterns["round_numbers"]) +
-                    len(patterns["perfect_days"])
-                )
+                # One pass over every member's steps; findings are counted as they stream
+                # in and only a bounded number of examples per type is kept
+                summary = summarize_patterns(iter_patterns(snapshot.members, snapshot.steps_by_user))
+                suspicious_count = summary["suspicious_count"]
                 
                 return {
                     "comp_id": comp_id,
-                    "patterns": patterns,
+                    "patterns": summary["patterns"],
+                    "pattern_counts": summary["pattern_counts"],
                     "suspicious_count": suspicious_count,
                     "status": "suspicious_patterns_detected" if suspicious_count > 0 else "no_suspicious_patterns"
                 }
@@ -579,74 +482,143 @@ class FairnessAgent:
             func=check_patterns
         )
     
-    def run(self, comp_id: str, user_id: Optional[str] = None) -> Dict[str, Any]:
+    def _run_incremental(self, snapshot: CompetitionSnapshot, state: Dict[str, Any], started_at: str):
+        """
+        Score the step entries written since the stored watermark and update the statistics
+        
+        Returns:
+            (analysis result, pattern result) shaped like the tools' results
+        """
+        comp_id = snapshot.comp_id
+        users = state["users"]
+        since = watermark_query_start(state["watermark"])
+        if snapshot.step_writes is not None:
+            entries = snapshot.step_writes.written_since(since, snapshot.members, snapshot.start_date.isoformat())
+        else:
+            entries = get_steps_written_since(since, snapshot.members, snapshot.start_date.isoformat())
+        increment = score_increment(users, entries, snapshot.members, snapshot.start_date, snapshot.end_date)
+        save_fairness_state(comp_id, started_at, users, changed=increment["changed"])
+        anomalies = increment["anomalies"]
+        analysis_result = {
+            "comp_id": comp_id,
+            "mode": "incremental",
+            "since": state["watermark"],
+            "users_analyzed": len(increment["changed"]),
+            "total_data_points": increment["data_points"],
+            "method": "running_stats",
+            "population": increment["population"],
+            "anomalies": anomalies,
+            "anomaly_count": len(anomalies),
+            "status": "anomalies_detected" if anomalies else "no_anomalies"
+        }
+        
+        # Patterns over the recent days kept in the statistics
+        summary = summarize_patterns(iter_patterns(snapshot.members, recent_steps_by_user(users, snapshot.members)))
+        pattern_result = {
+            "comp_id": comp_id,
+            "mode": "incremental",
+            "patterns": summary["patterns"],
+            "pattern_counts": summary["pattern_counts"],
+            "suspicious_count": summary["suspicious_count"],
+            "status": "suspicious_patterns_detected" if summary["suspicious_count"] > 0 else "no_suspicious_patterns"
+        }
+        return analysis_result, pattern_result
+    
+    def _save_full_state(self, snapshot: CompetitionSnapshot, started_at: str) -> None:
+        """Store the statistics of a full analysis so the next run can be incremental"""
+        try:
+            users = build_user_stats(snapshot.members, snapshot.steps_by_user, snapshot.start_date, snapshot.end_date)
+            save_fairness_state(snapshot.comp_id, started_at, users, replace=True)
+        except Exception as e:
+            logging.warning(f"Failed to save fairness state for {snapshot.comp_id}: {e}")
+    
+    def run(self, comp_id: str, user_id: Optional[str] = None, snapshot: Optional[CompetitionSnapshot] = None,
+            full_scan: bool = False) -> Dict[str, Any]:
         """
         Run fairness agent workflow
         
+        After a full analysis of the competition, later runs only score the step
+        entries written since the previous run (see incremental_fairness).
+        
         Args:
             comp_id: Competition ID to analyze
-            user_id: Optional specific user ID to analyze
+            user_id: Optional specific user ID to analyze (always a full analysis)
+            snapshot: Competition data already loaded for this run (loaded here if omitted)
+            full_scan: Re-analyze the whole history even if a watermark is stored
         
         Returns:
             Dictionary with fairness agent flags and findings
         """
         flags = []
         findings = []
-        
-        # Use tools to analyze data
-        if self.tools:
-            # Analyze step data
-            analyze_tool = next((t for t in self.tools if t.name == "analyze_step_data"), None)
-            if analyze_tool:
-                analysis_result = analyze_tool.func(comp_id, user_id)
-                findings.append(analysis_result)
+        # Entries written after this are left to the next run
+        started_at = datetime.utcnow().isoformat()
+        snapshot = snapshot or load_competition_snapshot(comp_id)
+        incremental_enabled = bool(FAIRNESS_INCREMENTAL and not user_id and snapshot.start_date and snapshot.end_date)
+        
+        state = None
+        if incremental_enabled and not full_scan:
+            state = get_fairness_state(comp_id)
+        mode = "incremental" if state and state.get("watermark") else "full"
+        
+        analysis_result = None
+        pattern_result = None
+        with use_snapshot(snapshot):
+            if mode == "incremental":
+                analysis_result, pattern_result = self._run_incremental(snapshot, state, started_at)
+            elif self.tools:
+                # Analyze step data
+                analyze_tool = next((t for t in self.tools if t.name == "analyze_step_data"), None)
+                if analyze_tool:
+                    analysis_result = analyze_tool.func(comp_id, user_id)
+                
+                # Check for patterns
+                pattern_tool = next((t for t in self.tools if t.name == "check_patterns"), None)
+                if pattern_tool:
+                    pattern_result = pattern_tool.func(comp_id)
                 
-                # Flag anomalies
-                for anomaly in analysis_result.get("anomalies", []):
+                if incremental_enabled and analysis_result is not None and "error" not in analysis_result:
+                    self._save_full_state(snapshot, started_at)
+        
+        if analysis_result is not None:
+            findings.append(analysis_result)
+            
+            # Flag anomalies
+            for anomaly in analysis_result.get("anomalies", []):
+                flags.append({
+                    "type": anomaly.get("type"),
+                    "user_id": anomaly.get("user_id"),
+                    "severity": anomaly.get("severity"),
+                    "details": anomaly
+                })
+        
+        if pattern_result is not None:
+            findings.append(pattern_result)
+            
+            # Add suspicious patterns to flags
+            patterns = pattern_result.get("patterns", {})
+            for pattern_type, pattern_data in patterns.items():
+                if pattern_data:
                     flags.append({
-                        "type": anomaly.get("type"),
-                        "user_id": anomaly.get("user_id"),
-                        "severity": anomaly.get("severity"),
-                        "details": anomaly
+                        "type": f"suspicious_pattern_{pattern_type}",
+                        "severity": "medium",
+                        "count": pattern_result.get("pattern_counts", {}).get(pattern_type, len(pattern_data)),
+                        "details": pattern_data
                     })
-            
-            # Check for patterns
-            pattern_tool = next((t for t in self.tools if t.name == "check_patterns"), None)
-            if pattern_tool:
-                pattern_result = pattern_tool.func(comp_id)
-                findings.append(pattern_result)
-                
-                # Add suspicious patterns to flags
-                patterns = pattern_result.get("patterns", {})
-                for pattern_type, pattern_data in patterns.items():
-                    if pattern_data:
-                        flags.append({
-                            "type": f"suspicious_pattern_{pattern_type}",
-                            "severity": "medium",
-                            "details": pattern_data
-                        })
         
-        # Use Gemini for intelligent analysis if available
-        if gemini_model and findings:
-            try:
-                prompt = f"""
-                Analyze this step competition data for fairness violations:
-                {findings}
-                
-                Provide 2-3 recommendations for ensuring data integrity.
-                """
-                response = gemini_model.generate_content(prompt)
-                recommendations = response.text if response else None
-            except Exception as e:
-                logging.warning(f"Gemini analysis failed: {e}")
-                recommendations = None
-        else:
-            recommendations = None
+        # Use Gemini for intelligent analysis if available (digest of the findings, cached)
+        recommendations = cached_recommendations(
+            gemini_model,
+            "fairness",
+            "Analyze this step competition data for fairness violations and provide 2-3 recommendations for ensuring data integrity.",
+            findings
+        )
         
         return {
             "ok": True,
             "agent": "fairness",
             "comp_id": comp_id,
+            "mode": mode,
             "flags": flags,
             "findings": findings,
             "flag_count": len(flags),
@@ -666,7 +638,8 @@ def create_multi_agent_workflow(sync_agent: SyncAgent, fairness_agent: FairnessA
     Returns:
         Workflow function that runs both agents in sequence
     """
-    def run_workflow(comp_id: str, date: Optional[str] = None) -> Dict[str, Any]:
+    def run_workflow(comp_id: str, date: Optional[str] = None, snapshot: Optional[CompetitionSnapshot] = None,
+                     full_scan: bool = False) -> Dict[str, Any]:
         """
         Run multi-agent workflow:
         1. Sync agent detects missing/late data
@@ -681,9 +654,17 @@ def create_multi_agent_workflow(sync_agent: SyncAgent, fairness_agent: FairnessA
             "steps": []
         }
         
+        # Load the competition once (unless the caller did); both agents and all their tools share it
+        snapshot = snapshot or load_competition_snapshot(comp_id)
+        workflow_results["snapshot"] = {
+            "members": len(snapshot.members),
+            "teams": len(snapshot.teams),
+            "loaded_at": snapshot.loaded_at
+        }
+        
         # Step 1: Sync agent runs
         logging.info(f"Running sync agent for competition {comp_id}")
-        sync_result = sync_agent.run(comp_id, date)
+        sync_result = sync_agent.run(comp_id, date, snapshot=snapshot)
         workflow_results["steps"].append({
             "step": 1,
             "agent": "sync",
@@ -709,7 +690,7 @@ def create_multi_agent_workflow(sync_agent: SyncAgent, fairness_agent: FairnessA
         
         # Step 3: Fairness agent runs
         logging.info(f"Running fairness agent for competition {comp_id}")
-        fairness_result = fairness_agent.run(comp_id)
+        fairness_result = fairness_agent.run(comp_id, snapshot=snapshot, full_scan=full_scan)
         workflow_results["steps"].append({
             "step": 3,
             "agent": "fairness",
@@ -717,7 +698,10 @@ def create_multi_agent_workflow(sync_agent: SyncAgent, fairness_agent: FairnessA
         })
         
         # Step 4: Combine results
+        rollup = get_daily_rollup(comp_id, workflow_results["date"])
         workflow_results["summary"] = {
+            "day_total_steps": rollup.get("total_steps") if rollup else None,
+            "day_active_submitters": rollup.get("active_submitters") if rollup else None,
             "sync_actions": len(sync_result.get("actions", [])),
             "fairness_flags": len(fairness_result.get("flags", [])),
             "total_issues": len(sync_result.get("actions", [])) + len(fairness_result.get("flags", [])),
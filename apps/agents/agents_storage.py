@@ -3,22 +3,39 @@ Storage helper functions for agents to access Firestore data
 """
 
 import os
+import sys
+import time
+import zlib
+from datetime import datetime, timezone
 from typing import List, Dict, Optional
 from google.cloud import firestore
 
+from gcp_clients import fs
+from read_model import open_read_model
+
+# Submission bitmaps are decoded by the API module that writes them (appended, so local modules win)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.submission_bitmaps import bits_from_doc
+
 GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
+# Steps newer than the read-model snapshot are read from Firestore and reused this long
+READ_MODEL_TAIL_TTL_SECONDS = int(os.getenv("READ_MODEL_TAIL_TTL_SECONDS", "60"))
+
+# Most values a Firestore "in" filter accepts
+FIRESTORE_IN_LIMIT = 30
+
+# Per-user fairness statistics are spread over this many documents per competition
+FAIRNESS_STATE_SHARDS = int(os.getenv("FAIRNESS_STATE_SHARDS", "16"))
+
+_competition_steps_cache: Dict[str, tuple] = {}  # comp_id -> (version, loaded_at, steps by user)
+# Local fallback for the fairness watermark state: comp_id -> {"watermark", "users"}
+FAIRNESS_STATE: Dict[str, Dict] = {}
 
 def _fs_coll(name: str):
-    """Get Firestore collection reference"""
-    if not GCP_ENABLED:
-        return None
-    try:
-        # IMPORTANT: Use Firebase project ID for Firestore, not GCP project ID
-        firebase_project_id = os.getenv("FIREBASE_PROJECT_ID") or "stepsquad-46d14"
-        client = firestore.Client(project=firebase_project_id)
-        return client.collection(name)
-    except Exception:
+    """Get Firestore collection reference from the shared client"""
+    if not GCP_ENABLED or not fs():
         return None
+    return fs().collection(name)
 
 
 def get_competitions(comp_id: Optional[str] = None) -> List[Dict]:
@@ -37,27 +54,87 @@ def get_competitions(comp_id: Optional[str] = None) -> List[Dict]:
     return []
 
 
+def get_active_competitions() -> List[Dict]:
+    """Get every competition with status ACTIVE"""
+    if GCP_ENABLED and _fs_coll("competitions"):
+        docs = _fs_coll("competitions").where("status", "==", "ACTIVE").stream()
+        return [{"comp_id": doc.id, **doc.to_dict()} for doc in docs]
+    return []
+
+
 def get_teams_for_competition(comp_id: str) -> List[Dict]:
     """Get all teams for a competition"""
     teams = []
     if GCP_ENABLED and _fs_coll("teams"):
         query = _fs_coll("teams").where("comp_id", "==", comp_id)
-        team_docs = query.stream()
+        team_docs = list(query.stream())
+        # Fetch every team's members in one batched read
+        member_refs = [_fs_coll("team_members").document(team_doc.id) for team_doc in team_docs]
+        members_by_team = {
+            snapshot.id: snapshot.to_dict().get("members", [])
+            for snapshot in (fs().get_all(member_refs) if member_refs else [])
+            if snapshot.exists
+        }
         for team_doc in team_docs:
             team_data = team_doc.to_dict()
             team_data["team_id"] = team_doc.id
-            # Get members
-            members_ref = _fs_coll("team_members").document(team_doc.id).get()
-            if members_ref.exists:
-                team_data["members"] = members_ref.to_dict().get("members", [])
-            else:
-                team_data["members"] = []
+            team_data["members"] = members_by_team.get(team_doc.id, [])
             teams.append(team_data)
     return teams
 
 
+def get_competition_steps(comp_id: str, start_date: Optional[str] = None,
+                          members: Optional[List[str]] = None) -> Optional[Dict[str, List[Dict]]]:
+    """
+    Get every member's steps for a competition from its read model, or None without one
+
+    The snapshot covers days through its export; later days are read per
+    FIRESTORE_IN_LIMIT members (user_id "in" + date range). An export with no
+    days yet (through is None) only bounds that tail by the competition's
+    start_date; without either bound this returns None so callers use the
+    per-user reads.
+
+    Args:
+        comp_id: Competition id
+        start_date: Competition start (YYYY-MM-DD)
+        members: Current members (default: the snapshot's)
+    """
+    model = open_read_model(comp_id)
+    if model is None or not (model.through or start_date):
+        return None
+    
+    cached = _competition_steps_cache.get(comp_id)
+    if cached and cached[0] == model.version and time.monotonic() - cached[1] < READ_MODEL_TAIL_TTL_SECONDS:
+        return cached[2]
+    
+    steps_by_user = {uid: list(entries) for uid, entries in model.steps_by_user().items()}
+    if GCP_ENABLED and _fs_coll("daily_steps"):
+        members = sorted(members if members is not None else model.members())
+        for i in range(0, len(members), FIRESTORE_IN_LIMIT):
+            query = _fs_coll("daily_steps").where("user_id", "in", members[i:i + FIRESTORE_IN_LIMIT])
+            if model.through:
+                query = query.where("date", ">", model.through)
+            else:
+                query = query.where("date", ">=", str(start_date).split("T")[0])
+            for doc in query.stream():
+                step_data = doc.to_dict()
+                steps_by_user.setdefault(step_data["user_id"], []).append({
+                    "user_id": step_data.get("user_id"),
+                    "date": step_data.get("date"),
+                    "steps": step_data.get("steps", 0)
+                })
+    
+    _competition_steps_cache[comp_id] = (model.version, time.monotonic(), steps_by_user)
+    return steps_by_user
+
+
 def get_user_steps(uid: str, comp_id: Optional[str] = None) -> List[Dict]:
     """Get user's step history, optionally filtered by competition"""
+    if comp_id:
+        competition_steps = get_competition_steps(comp_id)
+        if competition_steps is not None:
+            return sorted(competition_steps.get(uid, []), key=lambda x: x.get("date", ""), reverse=True)
+    
     steps = []
     if GCP_ENABLED and _fs_coll("daily_steps"):
         query = _fs_coll("daily_steps").where("user_id", "==", uid)
@@ -72,6 +149,136 @@ def get_user_steps(uid: str, comp_id: Optional[str] = None) -> List[Dict]:
     return sorted(steps, key=lambda x: x.get("date", ""), reverse=True)
 
 
+def get_daily_rollup(comp_id: str, date: str) -> Optional[Dict]:
+    """Get the rollup job's summary for one competition day, if it has run for that day"""
+    if GCP_ENABLED and _fs_coll("daily_rollups"):
+        doc = _fs_coll("daily_rollups").document(f"{comp_id}_{date}").get()
+        if doc.exists:
+            return doc.to_dict()
+    return None
+
+
+def get_missing_submitters(comp_id: str, date: str, members: List[str], not_before: Optional[str] = None) -> Optional[set]:
+    """
+    Members without a submission for the day, from the API's submission bitmap
+    (apps/api/submission_bitmaps.py), or None if the day has no bitmap or its
+    last update is older than not_before (e.g. the day's rollup, whose rebuild it missed)
+    """
+    if not GCP_ENABLED or not _fs_coll("submission_bitmaps"):
+        return None
+    doc = _fs_coll("submission_bitmaps").document(f"{comp_id}_{date}").get()
+    if not doc.exists:
+        return None
+    data = doc.to_dict() or {}
+    if not_before and data.get("updated_at", "") < not_before:
+        return None
+    submitted = bits_from_doc(data)
+    index_doc = _fs_coll("submission_index").document(comp_id).get()
+    index = (index_doc.to_dict() or {}).get("members", []) if index_doc.exists else []
+    positions = {uid: i for i, uid in enumerate(index)}
+    # Members without an index position have never submitted to the competition
+    return {uid for uid in members if uid not in positions or not (submitted >> positions[uid]) & 1}
+
+
+def get_steps_written_since(since: str, user_ids: List[str], start_date: Optional[str] = None) -> List[Dict]:
+    """
+    Get the users' step entries written (daily_steps.updated_at) after `since`
+
+    Queried per FIRESTORE_IN_LIMIT users (user_id "in" + updated_at range,
+    composite index on daily_steps (user_id, updated_at)), so a competition
+    reads its members' writes only. updated_at is returned as a naive UTC
+    ISO string, like the watermarks it is compared with.
+    """
+    steps = []
+    if GCP_ENABLED and _fs_coll("daily_steps") and user_ids:
+        since_ts = datetime.fromisoformat(since).replace(tzinfo=timezone.utc)
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), FIRESTORE_IN_LIMIT):
+            query = _fs_coll("daily_steps").where("user_id", "in", user_ids[i:i + FIRESTORE_IN_LIMIT]).where("updated_at", ">", since_ts)
+            for doc in query.stream():
+                step_data = doc.to_dict()
+                if start_date and step_data.get("date", "") < start_date:
+                    continue
+                updated_at = step_data.get("updated_at")
+                steps.append({
+                    "user_id": step_data.get("user_id"),
+                    "date": step_data.get("date"),
+                    "steps": step_data.get("steps", 0),
+                    "updated_at": updated_at.astimezone(timezone.utc).replace(tzinfo=None).isoformat() if updated_at else None
+                })
+    return steps
+
+
+def get_fairness_watermark(comp_id: str) -> Optional[str]:
+    """Get the fairness watermark of a competition without its per-user statistics"""
+    if GCP_ENABLED and _fs_coll("fairness_state"):
+        doc = _fs_coll("fairness_state").document(comp_id).get()
+        return (doc.to_dict() or {}).get("watermark") if doc.exists else None
+    return (FAIRNESS_STATE.get(comp_id) or {}).get("watermark")
+
+
+def get_fairness_state(comp_id: str) -> Optional[Dict]:
+    """
+    Get the fairness agent's watermark and per-user statistics for a competition
+
+    Returns:
+        {"watermark": str, "users": {uid: stats}} or None before the first full run
+    """
+    if GCP_ENABLED and _fs_coll("fairness_state"):
+        doc_ref = _fs_coll("fairness_state").document(comp_id)
+        doc = doc_ref.get()
+        if not doc.exists:
+            return None
+        users = {}
+        for shard in doc_ref.collection("user_stats").stream():
+            users.update((shard.to_dict() or {}).get("users", {}))
+        return {**doc.to_dict(), "users": users}
+    state = FAIRNESS_STATE.get(comp_id)
+    return {**state, "users": dict(state["users"])} if state else None
+
+
+def save_fairness_state(comp_id: str, watermark: str, users: Dict[str, Dict], changed: Optional[List[str]] = None,
+                        replace: bool = False) -> None:
+    """
+    Save the fairness watermark and per-user statistics
+
+    Args:
+        comp_id: Competition id
+        watermark: Write time up to which entries have been analyzed
+        users: uid -> statistics
+        changed: Users whose statistics changed (default: all of them)
+        replace: Drop previously stored users (full re-scan)
+    """
+    changed = list(users) if changed is None else changed
+    if GCP_ENABLED and _fs_coll("fairness_state"):
+        from datetime import datetime
+        doc_ref = _fs_coll("fairness_state").document(comp_id)
+        shards: Dict[int, Dict[str, Dict]] = {}
+        for uid in changed:
+            shards.setdefault(zlib.crc32(uid.encode("utf-8")) % FAIRNESS_STATE_SHARDS, {})[uid] = users[uid]
+        batch = fs().batch()
+        if replace:
+            for shard in doc_ref.collection("user_stats").list_documents():
+                if int(shard.id) not in shards:
+                    batch.delete(shard)
+        for shard, shard_users in shards.items():
+            # Merging the users map rewrites only the changed users
+            batch.set(doc_ref.collection("user_stats").document(str(shard)), {"users": shard_users}, merge=not replace)
+        batch.set(doc_ref, {
+            "comp_id": comp_id,
+            "watermark": watermark,
+            "user_count": len(users),
+            "updated_at": datetime.utcnow().isoformat()
+        })
+        batch.commit()
+        return
+    state = FAIRNESS_STATE.get(comp_id)
+    if replace or state is None:
+        state = FAIRNESS_STATE[comp_id] = {"comp_id": comp_id, "users": {}}
+    state["watermark"] = watermark
+    state["users"].update({uid: users[uid] for uid in changed})
+
+
 def flag_unfair_data(user_id: str, comp_id: str, date: str, reason: str) -> Dict:
     """Flag a data entry as potentially unfair"""
     from datetime import datetime
@@ -0,0 +1,122 @@
+"""
+Batch agent runs across competitions
+
+Runs one agent (or the workflow) over every ACTIVE competition, or a given
+list, on a bounded thread pool. Snapshots of all competitions in the batch
+share a UserStepsCache, so a user in several competitions is read once, and
+a StepWritesCache, so incremental fairness runs read each member's recent
+step writes once for the whole batch. The batch returns one aggregated summary instead of
+every full result.
+"""
+
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Any
+
+from agents_storage import get_active_competitions, get_fairness_watermark
+from snapshot import UserStepsCache, StepWritesCache, load_competition_snapshot
+from incremental_fairness import FAIRNESS_INCREMENTAL, watermark_query_start
+
+logger = logging.getLogger(__name__)
+
+AGENT_BATCH_WORKERS = int(os.getenv("AGENT_BATCH_WORKERS", "4"))
+
+
+def _issue_counts(agent: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """The numbers the batch summary reports for one competition's result"""
+    if agent == "sync":
+        actions = result.get("actions", [])
+        return {"issues": len(actions), "sync_actions": len(actions)}
+    if agent == "fairness":
+        return {"issues": result.get("flag_count", 0), "fairness_flags": result.get("flag_count", 0)}
+    summary = result.get("summary", {})
+    return {
+        "issues": summary.get("total_issues", 0),
+        "sync_actions": summary.get("sync_actions", 0),
+        "fairness_flags": summary.get("fairness_flags", 0),
+    }
+
+
+def run_batch(
+    agent: str,
+    runners: Dict[str, Callable[..., Dict[str, Any]]],
+    comp_ids: Optional[List[str]] = None,
+    date: Optional[str] = None,
+    max_workers: int = AGENT_BATCH_WORKERS,
+    include_results: bool = False,
+) -> Dict[str, Any]:
+    """
+    Run an agent over many competitions
+
+    Args:
+        agent: "sync", "fairness" or "workflow"
+        runners: Agent name -> callable(comp_id, date, snapshot) running it
+        comp_ids: Competitions to run (default: every ACTIVE competition)
+        date: Date passed to the sync agent / workflow
+        max_workers: Competitions processed concurrently
+        include_results: Also return each competition's full result
+
+    Returns:
+        Aggregated summary with per-competition status and issue counts
+    """
+    started = time.monotonic()
+    if comp_ids is None:
+        comp_ids = [c["comp_id"] for c in get_active_competitions()]
+    runner = runners[agent]
+    cache = UserStepsCache()
+    step_writes = None
+    if agent in ("fairness", "workflow") and FAIRNESS_INCREMENTAL:
+        # From the earliest watermark, so one scan serves every competition
+        watermarks = [w for w in (get_fairness_watermark(comp_id) for comp_id in comp_ids) if w]
+        if watermarks:
+            step_writes = StepWritesCache(min(watermark_query_start(w) for w in watermarks))
+
+    def run_one(comp_id: str) -> Dict[str, Any]:
+        run_started = time.monotonic()
+        try:
+            snapshot = load_competition_snapshot(comp_id, user_steps_cache=cache, step_writes=step_writes)
+            if not snapshot.competition:
+                return {"comp_id": comp_id, "status": "error", "error": "Competition not found"}
+            result = runner(comp_id, date, snapshot)
+            entry = {
+                "comp_id": comp_id,
+                "status": "ok",
+                "members": len(snapshot.members),
+                **_issue_counts(agent, result),
+                "duration_ms": round((time.monotonic() - run_started) * 1000),
+            }
+            if include_results:
+                entry["result"] = result
+            return entry
+        except Exception as e:
+            logger.error(f"Batch {agent} run failed for {comp_id}: {e}", exc_info=True)
+            return {"comp_id": comp_id, "status": "error", "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(comp_ids) or 1))) as executor:
+        competitions = list(executor.map(run_one, comp_ids))
+
+    succeeded = [c for c in competitions if c["status"] == "ok"]
+    summary = {
+        "ok": True,
+        "agent": agent,
+        "date": date,
+        "competitions": competitions,
+        "competition_count": len(competitions),
+        "succeeded": len(succeeded),
+        "failed": len(competitions) - len(succeeded),
+        "total_issues": sum(c.get("issues", 0) for c in succeeded),
+        "competitions_with_issues": sum(1 for c in succeeded if c.get("issues")),
+        "user_step_loads": cache.loads,
+        "shared_user_loads": cache.hits,
+        "step_write_scans": step_writes.scans if step_writes else 0,
+        "duration_ms": round((time.monotonic() - started) * 1000),
+        "timestamp": datetime.now().isoformat(),
+    }
+    logger.info(
+        f"Batch {agent} run: {summary['succeeded']}/{summary['competition_count']} competitions, "
+        f"{summary['total_issues']} issues in {summary['duration_ms']}ms"
+    )
+    return summary
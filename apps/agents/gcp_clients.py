@@ -4,19 +4,38 @@ GCP clients initialization for agents service
 
 import os
 import logging
+import threading
 
 GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
 firestore_client = None
 bigquery_client = None
+_initialized = False
+_init_lock = threading.Lock()
 
 
 def init_clients():
-    """Initialize GCP clients"""
-    global firestore_client, bigquery_client
+    """
+    Initialize GCP clients
+    
+    The clients are process-wide and thread-safe: every storage helper and
+    request thread shares them (and their gRPC channels). Safe to call more
+    than once, only the first call creates clients.
+    """
+    global _initialized
     
     if not GCP_ENABLED:
         return
     
+    with _init_lock:
+        if _initialized:
+            return
+        _initialized = True
+        _create_clients()
+
+
+def _create_clients():
+    global firestore_client, bigquery_client
+    
     # IMPORTANT: Use Firebase project ID for Firestore, not GCP project ID
     # Firestore is part of Firebase and uses the Firebase project ID
     firebase_project_id = os.getenv("FIREBASE_PROJECT_ID") or "stepsquad-46d14"
@@ -50,12 +69,32 @@ def init_clients():
         bigquery_client = None
 
 
+def warm_up_clients():
+    """
+    Open the Firestore connection before the first request
+    
+    The first RPC on a new client pays for channel setup, auth token fetch and
+    TLS; doing it at service start keeps that off the first agent run.
+    """
+    if not fs():
+        return
+    try:
+        list(fs().collection("competitions").limit(1).stream())
+        logging.info("Firestore connection warmed up")
+    except Exception as e:
+        logging.warning(f"Firestore warm-up failed: {e}")
+
+
 def fs():
-    """Get Firestore client"""
+    """Get Firestore client (initialized on first use if init_clients wasn't called)"""
+    if firestore_client is None and not _initialized:
+        init_clients()
     return firestore_client
 
 
 def bq():
     """Get BigQuery client"""
+    if bigquery_client is None and not _initialized:
+        init_clients()
     return bigquery_client
 
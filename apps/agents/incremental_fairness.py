@@ -0,0 +1,224 @@
+"""
+Incremental fairness analysis
+
+After a full analysis the fairness agent stores, per competition, a watermark
+(the run's start time) and running statistics per member: count, sum and sum
+of squares of their daily steps, their maximum and the values of their last
+FAIRNESS_RECENT_DAYS days. The next run reads only the members' step entries
+written after the watermark (daily_steps.updated_at, a server timestamp),
+scores them against those statistics and updates them, so a daily run costs
+one day of the competition's data instead of its whole history. Pattern checks in this mode look at the
+recent days kept in the statistics.
+
+The per-user baseline here is mean/standard deviation (running sums) rather
+than the median/MAD of the full analysis, which needs every value; the
+population comparisons still use median/MAD of the day's new entries.
+Each user's statistics also keep a bitset of the days folded in (offsets
+from "origin", hex-encoded), so an entry read again - through the watermark
+overlap or a rewrite - is never counted twice. A re-submitted day within the
+recent window replaces its old value; a revision of an older day is ignored
+(its old value is gone) until a full re-scan rebuilds everything.
+"""
+
+import os
+import math
+import logging
+import statistics
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Tuple, Any
+
+from step_analysis import (
+    ANOMALY_DAILY_CAP, ANOMALY_SUSTAINED_AVG, ANOMALY_ROBUST_Z, ANOMALY_MIN_STEPS,
+    ANOMALY_JUMP_STEPS, ANOMALY_JUMP_RATIO, ANOMALY_POPULATION_PERCENTILE, ANOMALY_MIN_POPULATION,
+    ANOMALY_MIN_SCALE, MAD_SCALE, severity_label,
+)
+
+logger = logging.getLogger(__name__)
+
+FAIRNESS_INCREMENTAL = os.getenv("FAIRNESS_INCREMENTAL", "true").lower() == "true"
+# Days of values kept per user (re-submissions within it replace the old value; pattern window)
+FAIRNESS_RECENT_DAYS = int(os.getenv("FAIRNESS_RECENT_DAYS", "7"))
+# Days of history a user needs before new days are scored against their own baseline
+FAIRNESS_MIN_HISTORY = int(os.getenv("FAIRNESS_MIN_HISTORY", "5"))
+# Entries written this long before the watermark are read again (clock skew between writers)
+FAIRNESS_WATERMARK_OVERLAP_SECONDS = int(os.getenv("FAIRNESS_WATERMARK_OVERLAP_SECONDS", "300"))
+
+
+def new_user_stats(origin: date) -> Dict[str, Any]:
+    return {"count": 0, "sum": 0.0, "sumsq": 0.0, "max": 0, "recent": {}, "origin": origin.isoformat(), "days": "0"}
+
+
+def mean_std(stats: Dict[str, Any]) -> Tuple[float, float]:
+    if not stats["count"]:
+        return 0.0, 0.0
+    mean = stats["sum"] / stats["count"]
+    return mean, math.sqrt(max(0.0, stats["sumsq"] / stats["count"] - mean * mean))
+
+
+def add_entry(stats: Dict[str, Any], day: str, steps: int) -> bool:
+    """
+    Fold one day's steps into a user's statistics
+
+    Returns:
+        False if nothing changed: the day was already recorded with this
+        value, or it was folded in before and has left the recent window
+    """
+    offset = (date.fromisoformat(day) - date.fromisoformat(stats["origin"])).days
+    if offset < 0:
+        return False
+    folded = int(stats["days"], 16)
+    recent = stats["recent"]
+    old = recent.get(day)
+    if old == steps:
+        return False
+    if old is not None:
+        stats["sum"] += steps - old
+        stats["sumsq"] += steps * steps - old * old
+    elif (folded >> offset) & 1:
+        return False
+    else:
+        stats["count"] += 1
+        stats["sum"] += steps
+        stats["sumsq"] += steps * steps
+        stats["days"] = format(folded | (1 << offset), "x")
+    stats["max"] = max(stats["max"], steps)
+    recent[day] = steps
+
+    cutoff = (date.fromisoformat(max(recent)) - timedelta(days=FAIRNESS_RECENT_DAYS - 1)).isoformat()
+    for stale in [d for d in recent if d < cutoff]:
+        del recent[stale]
+    return True
+
+
+def _in_range(entry: Dict[str, Any], start: str, end: str) -> bool:
+    return bool(entry.get("date")) and start <= entry["date"] <= end
+
+
+def build_user_stats(members: Iterable[str], steps_by_user: Dict[str, List[Dict[str, Any]]], start: date, end: date) -> Dict[str, Dict[str, Any]]:
+    """Statistics of every member from their full history (full analysis runs)"""
+    start_s, end_s = start.isoformat(), end.isoformat()
+    users = {}
+    for uid in members:
+        stats = users[uid] = new_user_stats(start)
+        for entry in sorted((e for e in steps_by_user.get(uid, []) if _in_range(e, start_s, end_s)), key=lambda e: e["date"]):
+            add_entry(stats, entry["date"], int(entry.get("steps", 0)))
+    return users
+
+
+def _score(z: float) -> float:
+    return min(1.0, max(0.0, 0.5 + (z - ANOMALY_ROBUST_Z) / (2 * ANOMALY_ROBUST_Z)))
+
+
+def _robust(values: List[float]) -> Tuple[float, float]:
+    median = statistics.median(values)
+    mad = statistics.median(abs(v - median) for v in values)
+    return median, max(MAD_SCALE * mad, ANOMALY_MIN_SCALE)
+
+
+def score_increment(users: Dict[str, Dict[str, Any]], entries: List[Dict[str, Any]], members: Iterable[str],
+                    start: date, end: date) -> Dict[str, Any]:
+    """
+    Score new step entries against the stored statistics and fold them in
+
+    Args:
+        users: uid -> statistics (updated in place)
+        entries: Step entries written since the watermark
+        members: Current competition members (others are ignored)
+        start, end: Competition date range
+
+    Returns:
+        {"anomalies", "changed" (uids), "data_points", "population"}
+    """
+    members = set(members)
+    start_s, end_s = start.isoformat(), end.isoformat()
+    latest: Dict[Tuple[str, str], int] = {}
+    for entry in entries:
+        if entry.get("user_id") in members and _in_range(entry, start_s, end_s):
+            key = (entry["user_id"], entry["date"])
+            latest[key] = max(latest.get(key, 0), int(entry.get("steps", 0)))
+
+    # The day's population among the new entries
+    by_day: Dict[str, List[float]] = {}
+    for (_, day), steps in latest.items():
+        by_day.setdefault(day, []).append(steps)
+    day_baseline = {day: _robust(values) for day, values in by_day.items() if len(values) >= 3}
+
+    worst: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def report(anomaly: Dict[str, Any]) -> None:
+        key = (anomaly["user_id"], anomaly["type"])
+        if key not in worst or anomaly["severity_score"] > worst[key]["severity_score"]:
+            worst[key] = anomaly
+
+    changed = set()
+    for (uid, day), steps in sorted(latest.items(), key=lambda item: item[0][1]):
+        stats = users.setdefault(uid, new_user_stats(start))
+        history = stats["count"] - (1 if day in stats["recent"] else 0)
+        mean, std = mean_std(stats)
+        previous = stats["recent"].get((date.fromisoformat(day) - timedelta(days=1)).isoformat())
+        if not add_entry(stats, day, steps):
+            continue
+        changed.add(uid)
+
+        if steps > ANOMALY_DAILY_CAP:
+            report({"user_id": uid, "type": "unrealistic_daily_count", "max_steps": steps, "date": day,
+                    "severity": "high", "severity_score": 1.0})
+            continue
+
+        if history >= FAIRNESS_MIN_HISTORY and steps >= ANOMALY_MIN_STEPS and day in day_baseline:
+            z_user = (steps - mean) / max(std, ANOMALY_MIN_SCALE)
+            day_median, day_scale = day_baseline[day]
+            z_day = (steps - day_median) / day_scale
+            if min(z_user, z_day) >= ANOMALY_ROBUST_Z:
+                score = _score(min(z_user, z_day))
+                report({"user_id": uid, "type": "statistical_outlier", "date": day, "steps": steps,
+                        "z_user": round(z_user, 2), "z_population": round(z_day, 2),
+                        "severity": severity_label(score), "severity_score": round(score, 3)})
+
+        if previous is not None and steps >= ANOMALY_MIN_STEPS and steps - previous >= ANOMALY_JUMP_STEPS:
+            ratio = steps / max(previous, 1)
+            if ratio >= ANOMALY_JUMP_RATIO:
+                score = min(1.0, max(0.5, 0.5 + math.log(ratio / ANOMALY_JUMP_RATIO, ANOMALY_JUMP_RATIO) / 2))
+                report({"user_id": uid, "type": "sudden_jump", "date": day, "steps": steps,
+                        "previous_steps": previous, "jump_ratio": round(ratio, 2),
+                        "severity": severity_label(score), "severity_score": round(score, 3)})
+
+    # Averages of every user with data, compared for the users that changed
+    means = {uid: mean_std(stats)[0] for uid, stats in users.items() if stats["count"] and uid in members}
+    population = None
+    if means:
+        ordered = sorted(means.values())
+        quantile = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        population = {"users_with_data": len(ordered), "p50": quantile(0.5), "p90": quantile(0.9), "p99": quantile(0.99)}
+        median, scale = _robust(ordered)
+        for uid in changed:
+            mean = means.get(uid)
+            if mean is None:
+                continue
+            if mean > ANOMALY_SUSTAINED_AVG:
+                report({"user_id": uid, "type": "sustained_high_activity", "avg_steps": mean,
+                        "severity": "medium", "severity_score": 0.7})
+            if len(ordered) >= ANOMALY_MIN_POPULATION:
+                percentile = 100.0 * sum(1 for m in ordered if m <= mean) / len(ordered)
+                z_mean = (mean - median) / scale
+                if percentile >= ANOMALY_POPULATION_PERCENTILE and z_mean >= ANOMALY_ROBUST_Z:
+                    score = _score(z_mean)
+                    report({"user_id": uid, "type": "population_outlier", "avg_steps": round(mean, 1),
+                            "percentile": round(percentile, 2), "z_population": round(z_mean, 2),
+                            "severity": severity_label(score), "severity_score": round(score, 3)})
+
+    anomalies = sorted(worst.values(), key=lambda a: -a["severity_score"])
+    return {"anomalies": anomalies, "changed": sorted(changed), "data_points": len(latest), "population": population}
+
+
+def recent_steps_by_user(users: Dict[str, Dict[str, Any]], members: Iterable[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """The recent days kept in the statistics, as step entries (pattern checks)"""
+    return {
+        uid: [{"user_id": uid, "date": day, "steps": steps} for day, steps in sorted(users[uid]["recent"].items())]
+        for uid in members if uid in users
+    }
+
+
+def watermark_query_start(watermark: str) -> str:
+    """Where to start reading entries for a watermark (overlap for writer clock skew)"""
+    return (datetime.fromisoformat(watermark) - timedelta(seconds=FAIRNESS_WATERMARK_OVERLAP_SECONDS)).isoformat()
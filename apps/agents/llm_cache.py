@@ -0,0 +1,177 @@
+"""
+Compact prompts and a response cache for the agents' Gemini calls
+
+Agent findings are reduced to a bounded digest before prompting: counts and
+statuses are kept, lists are cut to a few examples with their length, long
+strings are truncated and per-run values (timestamps) dropped. Prompt size
+therefore stays flat as competitions grow.
+
+Responses are cached under a hash of the agent, its instructions and the
+digest for LLM_CACHE_TTL_SECONDS, in process and (with GCP enabled) in the
+Firestore llm_cache collection shared by all instances, so re-running an
+agent on unchanged data makes no Gemini call.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Any
+
+from gcp_clients import fs
+
+logger = logging.getLogger(__name__)
+
+GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", "21600"))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))
+LLM_CACHE_COLLECTION = "llm_cache"
+# Digest bounds
+PROMPT_MAX_EXAMPLES = int(os.getenv("PROMPT_MAX_EXAMPLES", "5"))
+PROMPT_MAX_KEYS = int(os.getenv("PROMPT_MAX_KEYS", "20"))
+PROMPT_MAX_STRING = int(os.getenv("PROMPT_MAX_STRING", "200"))
+PROMPT_MAX_DEPTH = 4
+
+# Per-run values that would make every digest unique ("since": the incremental fairness watermark)
+VOLATILE_KEYS = {"timestamp", "today", "loaded_at", "created_at", "flagged_at", "since"}
+
+
+def _compact(value: Any, depth: int = 0) -> Any:
+    if isinstance(value, dict):
+        if depth >= PROMPT_MAX_DEPTH:
+            return f"{{{len(value)} fields}}"
+        keys = [k for k in value if k not in VOLATILE_KEYS]
+        compacted = {k: _compact(value[k], depth + 1) for k in keys[:PROMPT_MAX_KEYS]}
+        if len(keys) > PROMPT_MAX_KEYS:
+            compacted["_omitted_fields"] = len(keys) - PROMPT_MAX_KEYS
+        return compacted
+    if isinstance(value, (list, tuple, set)):
+        items = sorted(value) if isinstance(value, set) else list(value)
+        if depth >= PROMPT_MAX_DEPTH:
+            return f"[{len(items)} items]"
+        examples = [_compact(item, depth + 1) for item in items[:PROMPT_MAX_EXAMPLES]]
+        if len(items) > PROMPT_MAX_EXAMPLES:
+            return {"count": len(items), "examples": examples}
+        return examples
+    if isinstance(value, str) and len(value) > PROMPT_MAX_STRING:
+        return value[:PROMPT_MAX_STRING] + "..."
+    if isinstance(value, float):
+        return round(value, 2)
+    return value
+
+
+def digest_findings(findings: Any) -> Any:
+    """Bounded-size summary of agent findings for a prompt"""
+    return _compact(findings)
+
+
+def digest_key(agent: str, instructions: str, digest: Any) -> str:
+    payload = json.dumps({"agent": agent, "instructions": instructions, "digest": digest}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU of LLM responses with a TTL, backed by Firestore when available"""
+
+    def __init__(self, max_entries: int = LLM_CACHE_SIZE, ttl_seconds: int = LLM_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, text)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _coll(self):
+        return fs().collection(LLM_CACHE_COLLECTION) if GCP_ENABLED and fs() else None
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+
+        if self._coll():
+            try:
+                doc = self._coll().document(key).get()
+                data = doc.to_dict() if doc.exists else None
+                if data and data.get("expires_at_ts", 0) > now:
+                    self._remember(key, data.get("text"), data["expires_at_ts"])
+                    with self._lock:
+                        self.hits += 1
+                    return data.get("text")
+            except Exception as e:
+                logger.warning(f"Failed to read LLM cache entry: {e}")
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key: str, text: str, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (expires_at, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def set(self, key: str, text: str) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, text, expires_at)
+        if self._coll():
+            try:
+                self._coll().document(key).set({
+                    "text": text,
+                    "expires_at_ts": expires_at,
+                    # Firestore TTL policy field
+                    "expire_at": datetime.utcnow() + timedelta(seconds=self.ttl_seconds),
+                })
+            except Exception as e:
+                logger.warning(f"Failed to write LLM cache entry: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "ttl_seconds": self.ttl_seconds}
+
+
+response_cache = ResponseCache()
+
+
+def cached_recommendations(model, agent: str, instructions: str, findings: Any) -> Optional[str]:
+    """
+    Ask the model for recommendations on a digest of the findings, reusing cached answers
+
+    Args:
+        model: Gemini GenerativeModel (or None)
+        agent: Which agent is asking (part of the cache key)
+        instructions: What to analyze and what to return
+        findings: The agent's raw findings
+
+    Returns:
+        Response text, or None without a model or on failure
+    """
+    if model is None or not findings:
+        return None
+
+    digest = digest_findings(findings)
+    key = digest_key(agent, instructions, digest)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+
+    prompt = f"{instructions}\n\nFindings (summarized):\n{json.dumps(digest, indent=1, default=str)}"
+    try:
+        response = model.generate_content(prompt)
+    except Exception as e:
+        logger.warning(f"Gemini analysis failed: {e}")
+        return None
+    text = response.text if response else None
+    if text:
+        response_cache.set(key, text)
+    return text
@@ -12,8 +12,8 @@ with each other to complete workflows.
 import os
 import logging
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Literal, Optional
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 
 try:
     from agents import SyncAgent, FairnessAgent, create_multi_agent_workflow, ADK_AVAILABLE, GEMINI_AVAILABLE
@@ -26,7 +26,9 @@ except ImportError as e:
     FairnessAgent = None
     create_multi_agent_workflow = None
 
-from gcp_clients import init_clients
+from gcp_clients import init_clients, warm_up_clients
+from llm_cache import response_cache
+from batch import run_batch, AGENT_BATCH_WORKERS
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
@@ -35,8 +37,9 @@ logger = logging.getLogger(__name__)
 # Initialize FastAPI app
 app = FastAPI(title="StepSquad Agents", version="0.3.0")
 
-# Initialize GCP clients
+# Initialize GCP clients once per process and open the Firestore connection up front
 init_clients()
+warm_up_clients()
 
 # Initialize agents (with error handling)
 try:
@@ -55,6 +58,8 @@ class RunPayload(BaseModel):
     comp_id: Optional[str] = None
     date: Optional[str] = None
     user_id: Optional[str] = None
+    # Fairness: re-analyze the whole history instead of entries written since the last run
+    full_scan: bool = False
 
 
 @app.post("/run")
@@ -81,14 +86,14 @@ def run(payload: RunPayload):
         
         elif payload.agent == "fairness":
             logger.info(f"Running fairness agent for competition {payload.comp_id}")
-            result = fairness_agent.run(payload.comp_id, payload.user_id)
+            result = fairness_agent.run(payload.comp_id, payload.user_id, full_scan=payload.full_scan)
             return result
         
         elif payload.agent == "workflow":
             if not workflow:
                 raise HTTPException(status_code=503, detail="Workflow not initialized")
             logger.info(f"Running multi-agent workflow for competition {payload.comp_id}")
-            result = workflow(payload.comp_id, payload.date)
+            result = workflow(payload.comp_id, payload.date, full_scan=payload.full_scan)
             return result
         
         else:
@@ -101,6 +106,47 @@ def run(payload: RunPayload):
         raise HTTPException(status_code=500, detail=f"Agent execution failed: {str(e)}")
 
 
+class BatchRunPayload(BaseModel):
+    agent: Literal["sync", "fairness", "workflow"] = "fairness"
+    comp_ids: Optional[List[str]] = None
+    date: Optional[str] = None
+    max_workers: int = Field(default=AGENT_BATCH_WORKERS, ge=1, le=32)
+    include_results: bool = False
+    full_scan: bool = False
+
+
+@app.post("/run/batch")
+def run_batch_endpoint(payload: BatchRunPayload):
+    """
+    Run an agent or workflow over every ACTIVE competition (or the given comp_ids)
+    
+    Competitions run on a bounded worker pool and share per-user step loads;
+    the response aggregates issue counts per competition.
+    """
+    if not sync_agent or not fairness_agent:
+        raise HTTPException(status_code=503, detail="Agents not initialized. Check logs for errors.")
+    if payload.agent == "workflow" and not workflow:
+        raise HTTPException(status_code=503, detail="Workflow not initialized")
+    
+    runners = {
+        "sync": lambda comp_id, date, snapshot: sync_agent.run(comp_id, date, snapshot=snapshot),
+        "fairness": lambda comp_id, date, snapshot: fairness_agent.run(comp_id, snapshot=snapshot, full_scan=payload.full_scan),
+        "workflow": lambda comp_id, date, snapshot: workflow(comp_id, date, snapshot=snapshot, full_scan=payload.full_scan),
+    }
+    try:
+        return run_batch(
+            payload.agent,
+            runners,
+            comp_ids=payload.comp_ids,
+            date=payload.date,
+            max_workers=payload.max_workers,
+            include_results=payload.include_results
+        )
+    except Exception as e:
+        logger.error(f"Error running batch: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Batch execution failed: {str(e)}")
+
+
 @app.get("/health")
 def health():
     """Health check endpoint"""
@@ -112,6 +158,7 @@ def health():
         "gemini_available": GEMINI_AVAILABLE if 'GEMINI_AVAILABLE' in globals() else False,
         "agents_initialized": sync_agent is not None and fairness_agent is not None,
         "tools_count": len(sync_agent.tools) if sync_agent and sync_agent.tools else 0,
+        "llm_cache": response_cache.stats(),
         "version": "0.3.0"
     }
 
@@ -124,6 +171,7 @@ def root():
         "version": "0.3.0",
         "endpoints": {
             "health": "/health",
-            "run": "/run"
+            "run": "/run",
+            "run_batch": "/run/batch"
         }
     }
@@ -0,0 +1,158 @@
+"""
+Suspicious pattern detection for the fairness agent
+
+One pass over a competition's step entries feeds hash aggregations:
+
+- (date, steps) -> users: several users reporting the same high count on a day
+- rolling hashes of every run of PATTERN_SEQUENCE_DAYS consecutive days ->
+  (user, start date): identical multi-day sequences across users, also when
+  copied onto other dates
+- per-user round-number counters
+
+Findings are yielded as they are known (round numbers during the pass,
+groups after it) so callers can keep counts and a bounded number of
+examples instead of every match. Work and memory are linear in the number
+of entries.
+"""
+
+import os
+from datetime import date
+from typing import Dict, Iterator, List, Tuple, Any
+
+# Several users with the same count on a day: at least this many users, above this count
+PATTERN_IDENTICAL_MIN_USERS = int(os.getenv("PATTERN_IDENTICAL_MIN_USERS", "3"))
+PATTERN_IDENTICAL_MIN_STEPS = int(os.getenv("PATTERN_IDENTICAL_MIN_STEPS", "10000"))
+PATTERN_ROUND_STEP = int(os.getenv("PATTERN_ROUND_STEP", "10000"))
+# Users whose every entry is a round number, with at least this many entries
+PATTERN_PERFECT_MIN_DAYS = int(os.getenv("PATTERN_PERFECT_MIN_DAYS", "3"))
+# Length of the day sequences compared across users, and their minimum total
+PATTERN_SEQUENCE_DAYS = int(os.getenv("PATTERN_SEQUENCE_DAYS", "3"))
+PATTERN_SEQUENCE_MIN_STEPS = int(os.getenv("PATTERN_SEQUENCE_MIN_STEPS", "15000"))
+# Findings kept per pattern type in results (all are counted)
+PATTERN_MAX_EXAMPLES = int(os.getenv("PATTERN_MAX_EXAMPLES", "50"))
+
+PATTERN_TYPES = ("identical_values", "round_numbers", "perfect_days", "identical_sequences")
+
+# Polynomial rolling hash modulo a Mersenne prime
+_HASH_BASE = 1_000_003
+_HASH_MOD = (1 << 61) - 1
+
+
+def _sequence_windows(runs: List[Tuple[int, int]], length: int) -> Iterator[Tuple[int, int]]:
+    """
+    Yield (start ordinal, hash) of every `length` consecutive-day window
+
+    Args:
+        runs: (day ordinal, steps) sorted by day
+    """
+    top = pow(_HASH_BASE, length - 1, _HASH_MOD)
+    window_hash = 0
+    size = 0
+    previous_day = None
+    for i, (day, steps) in enumerate(runs):
+        if previous_day is not None and day != previous_day + 1:
+            window_hash, size = 0, 0
+        previous_day = day
+        if size == length:
+            window_hash = (window_hash - runs[i - length][1] * top) % _HASH_MOD
+            size -= 1
+        window_hash = (window_hash * _HASH_BASE + steps) % _HASH_MOD
+        size += 1
+        if size == length:
+            yield day - length + 1, window_hash
+
+
+def iter_patterns(users: List[str], steps_by_user: Dict[str, List[Dict[str, Any]]]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yield (pattern type, finding) for a competition's members
+
+    Pattern types: round_numbers, perfect_days, identical_values, identical_sequences
+    """
+    same_day_counts: Dict[Tuple[str, int], List[str]] = {}
+    sequences: Dict[int, List[Tuple[str, int]]] = {}
+    values_by_user: Dict[str, Dict[int, int]] = {}
+    ordinals: Dict[str, int] = {}
+
+    for uid in users:
+        entries = steps_by_user.get(uid, [])
+        round_count = 0
+        days: Dict[int, int] = {}
+        for entry in entries:
+            steps = entry.get("steps", 0)
+            day = entry.get("date")
+
+            if steps > 0 and steps % PATTERN_ROUND_STEP == 0:
+                round_count += 1
+                yield "round_numbers", {"user_id": uid, "date": day, "steps": steps}
+
+            if steps > PATTERN_IDENTICAL_MIN_STEPS:
+                same_day_counts.setdefault((day, steps), []).append(uid)
+
+            if day not in ordinals:
+                try:
+                    ordinals[day] = date.fromisoformat(day).toordinal()
+                except (TypeError, ValueError):
+                    ordinals[day] = None
+            if ordinals[day] is not None:
+                days[ordinals[day]] = max(days.get(ordinals[day], 0), steps)
+
+        if len(entries) >= PATTERN_PERFECT_MIN_DAYS and round_count == len(entries):
+            yield "perfect_days", {"user_id": uid, "days": len(entries)}
+
+        runs = sorted(days.items())
+        for start, window_hash in _sequence_windows(runs, PATTERN_SEQUENCE_DAYS):
+            if sum(days[start + offset] for offset in range(PATTERN_SEQUENCE_DAYS)) >= PATTERN_SEQUENCE_MIN_STEPS:
+                sequences.setdefault(window_hash, []).append((uid, start))
+        values_by_user[uid] = days
+
+    for (day, steps), uids in same_day_counts.items():
+        if len(uids) >= PATTERN_IDENTICAL_MIN_USERS:
+            yield "identical_values", {"date": day, "steps": steps, "users": uids, "count": len(uids)}
+
+    def window(uid: str, start: int) -> Tuple[int, ...]:
+        return tuple(values_by_user[uid][start + offset] for offset in range(PATTERN_SEQUENCE_DAYS))
+
+    matched = []
+    for occurrences in sequences.values():
+        if len({uid for uid, _ in occurrences}) < 2:
+            continue
+        # Group by the actual values so a hash collision never reports unrelated users
+        groups: Dict[Tuple[int, ...], List[Tuple[str, int]]] = {}
+        for uid, start in occurrences:
+            groups.setdefault(window(uid, start), []).append((uid, start))
+        matched.extend(
+            (min(start for _, start in matches), values, frozenset(matches))
+            for values, matches in groups.items() if len({uid for uid, _ in matches}) >= 2
+        )
+
+    # Overlapping windows of one longer copied run are reported once
+    runs_by_matches: Dict[frozenset, Dict[str, Any]] = {}
+    findings = []
+    for _, values, matches in sorted(matched, key=lambda m: m[0]):
+        previous = frozenset((uid, start - 1) for uid, start in matches)
+        finding = runs_by_matches.pop(previous, None)
+        if finding is None:
+            finding = {
+                "steps": list(values),
+                "matches": [{"user_id": uid, "start_date": date.fromordinal(start).isoformat()} for uid, start in sorted(matches)],
+                "users": len({uid for uid, _ in matches}),
+            }
+            findings.append(finding)
+        else:
+            finding["steps"].append(values[-1])
+        runs_by_matches[matches] = finding
+
+    for finding in findings:
+        finding["days"] = len(finding["steps"])
+        yield "identical_sequences", finding
+
+
+def summarize_patterns(findings: Iterator[Tuple[str, Dict[str, Any]]], max_examples: int = PATTERN_MAX_EXAMPLES) -> Dict[str, Any]:
+    """Count a stream of findings per type, keeping the first `max_examples` of each"""
+    patterns: Dict[str, List[Dict[str, Any]]] = {pattern_type: [] for pattern_type in PATTERN_TYPES}
+    counts = {pattern_type: 0 for pattern_type in PATTERN_TYPES}
+    for pattern_type, finding in findings:
+        counts[pattern_type] += 1
+        if len(patterns[pattern_type]) < max_examples:
+            patterns[pattern_type].append(finding)
+    return {"patterns": patterns, "pattern_counts": counts, "suspicious_count": sum(counts.values())}
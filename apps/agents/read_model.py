@@ -0,0 +1,129 @@
+"""
+Reader for the competition read model exported by the API
+(apps/api/read_model_export.py)
+
+Follows {READ_MODEL_PATH}/{comp_id}/CURRENT to the latest snapshot and
+memory-maps its Arrow IPC files, so a whole competition's steps are scanned
+without Firestore reads and without copying the columns into Python objects
+until they are used. Snapshot files are immutable: bucket files are
+downloaded once to READ_MODEL_CACHE_DIR and mapped from there.
+
+Also usable for offline analysis:
+
+    from read_model import open_read_model
+    model = open_read_model("comp-123", root="gs://bucket/read-model")
+    df = model.steps.to_pandas()
+"""
+
+import os
+import json
+import logging
+import threading
+from typing import Dict, List, Optional, Any
+
+try:
+    import pyarrow as pa
+    import pyarrow.fs as pafs
+    import pyarrow.ipc as ipc
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+READ_MODEL_PATH = os.getenv("READ_MODEL_PATH", "")
+READ_MODEL_CACHE_DIR = os.getenv("READ_MODEL_CACHE_DIR", "/tmp/stepsquad-read-model")
+
+
+class CompetitionReadModel:
+    """One consistent snapshot of a competition: users, memberships and steps tables"""
+
+    def __init__(self, manifest: Dict[str, Any], users, memberships, steps):
+        self.comp_id = manifest["comp_id"]
+        self.version = manifest["version"]
+        self.through = manifest.get("through")
+        self.users = users
+        self.memberships = memberships
+        self.steps = steps
+        self._steps_by_user: Optional[Dict[str, List[Dict[str, Any]]]] = None
+        self._lock = threading.Lock()
+
+    def members(self) -> List[str]:
+        return sorted(set(self.memberships.column("user_id").to_pylist()))
+
+    def steps_by_user(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Step entries grouped by user (built once per snapshot)"""
+        with self._lock:
+            if self._steps_by_user is None:
+                grouped: Dict[str, List[Dict[str, Any]]] = {}
+                columns = (self.steps.column(name).to_pylist() for name in ("user_id", "date", "steps"))
+                for uid, day, steps in zip(*columns):
+                    grouped.setdefault(uid, []).append({"user_id": uid, "date": day.isoformat(), "steps": steps})
+                self._steps_by_user = grouped
+            return self._steps_by_user
+
+
+_models: Dict[str, CompetitionReadModel] = {}
+_models_lock = threading.Lock()
+
+
+def _filesystem(root: str):
+    if "://" in root:
+        return pafs.FileSystem.from_uri(root)
+    return pafs.LocalFileSystem(), os.path.abspath(root)
+
+
+def _map_table(filesystem, comp_dir: str, relative_path: str, local: bool):
+    """Memory-map one snapshot file (downloading it to the cache first if remote)"""
+    if local:
+        path = f"{comp_dir}/{relative_path}"
+    else:
+        path = os.path.join(READ_MODEL_CACHE_DIR, os.path.basename(comp_dir), relative_path)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pafs.copy_files(f"{comp_dir}/{relative_path}", f"{path}.part", source_filesystem=filesystem)
+            os.replace(f"{path}.part", path)
+    return ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def open_read_model(comp_id: str, root: Optional[str] = None) -> Optional[CompetitionReadModel]:
+    """
+    Open the latest snapshot of a competition
+
+    Returns None when no read model is configured or exported for it. The
+    opened snapshot is cached until CURRENT points at a newer version.
+    """
+    root = root or READ_MODEL_PATH
+    if pa is None or not root:
+        return None
+
+    try:
+        filesystem, base = _filesystem(root)
+        comp_dir = f"{base}/{comp_id}"
+        with filesystem.open_input_stream(f"{comp_dir}/CURRENT") as source:
+            manifest = json.loads(source.read().decode("utf-8"))
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+
+    with _models_lock:
+        cached = _models.get(comp_id)
+        if cached is not None and cached.version == manifest["version"]:
+            return cached
+
+    local = "://" not in root
+    try:
+        parts = [_map_table(filesystem, comp_dir, part["path"], local) for part in manifest.get("steps_parts", [])]
+        model = CompetitionReadModel(
+            manifest,
+            users=_map_table(filesystem, comp_dir, manifest["users"], local),
+            memberships=_map_table(filesystem, comp_dir, manifest["memberships"], local),
+            # Concatenation keeps the mapped buffers, nothing is copied
+            steps=pa.concat_tables(parts) if parts else pa.table({"user_id": [], "date": pa.array([], pa.date32()), "steps": pa.array([], pa.int64())}),
+        )
+    except Exception as e:
+        logging.warning(f"Failed to open read model for {comp_id} v{manifest.get('version')}: {e}")
+        return None
+
+    with _models_lock:
+        _models[comp_id] = model
+    logger.info(f"Opened read model {comp_id} v{model.version} ({model.steps.num_rows} step rows through {model.through})")
+    return model
@@ -0,0 +1,205 @@
+"""
+Per-run competition snapshot shared by the agents' tools
+
+A workflow loads the competition, its teams, members and every member's
+steps once (steps on first use, so runs that don't need them never read
+them) and activates the snapshot for the run; each tool then asks
+snapshot_for(comp_id) instead of querying storage itself. The active
+snapshot lives in a context variable rather than a tool argument, so tool
+signatures stay plain JSON types for ADK and concurrent runs (FastAPI's
+threadpool) never see each other's data. Outside a run, snapshot_for loads
+a fresh snapshot, so tools still work standalone.
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, date
+from typing import Callable, Dict, List, Optional, Any
+
+from agents_storage import get_competitions, get_teams_for_competition, get_user_steps, get_competition_steps, get_steps_written_since
+from step_analysis import build_step_matrix, competition_days, np
+
+logger = logging.getLogger(__name__)
+
+
+class CompetitionSnapshot:
+    """Competition, teams, members and steps of one competition, loaded once"""
+
+    def __init__(self, comp_id: str, competition: Optional[Dict[str, Any]], teams: List[Dict[str, Any]],
+                 steps_by_user: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+                 steps_loader: Optional[Callable[[], Dict[str, List[Dict[str, Any]]]]] = None,
+                 step_writes: Optional["StepWritesCache"] = None):
+        self.comp_id = comp_id
+        self.competition = competition
+        self.teams = teams
+        self.members = sorted({uid for team in teams for uid in team.get("members", [])})
+        self.loaded_at = datetime.now().isoformat()
+        self._steps_by_user = steps_by_user
+        self._steps_loader = steps_loader
+        self._matrix = None
+        self._lock = threading.RLock()
+        # Step writes shared by a batch run (incremental fairness), if any
+        self.step_writes = step_writes
+
+    @property
+    def steps_by_user(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Every member's step entries, loaded on first access"""
+        with self._lock:
+            if self._steps_by_user is None:
+                self._steps_by_user = self._steps_loader() if self._steps_loader else {}
+            return self._steps_by_user
+
+    @property
+    def start_date(self) -> Optional[date]:
+        return self._date("start_date")
+
+    @property
+    def end_date(self) -> Optional[date]:
+        return self._date("end_date")
+
+    def _date(self, field: str) -> Optional[date]:
+        if not self.competition or not self.competition.get(field):
+            return None
+        return datetime.strptime(str(self.competition[field]).split("T")[0], "%Y-%m-%d").date()
+
+    def user_steps(self, uid: str) -> List[Dict[str, Any]]:
+        """A member's entries, newest first (like agents_storage.get_user_steps)"""
+        return sorted(self.steps_by_user.get(uid, []), key=lambda x: x.get("date", ""), reverse=True)
+
+    def step_matrix(self):
+        """The members x competition days StepMatrix, built on first use (None without NumPy)"""
+        if np is None or not self.start_date or not self.end_date:
+            return None
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = build_step_matrix(self.members, competition_days(self.start_date, self.end_date), self.steps_by_user)
+            return self._matrix
+
+
+class UserStepsCache:
+    """
+    Users' step histories shared by the snapshots of one batch run
+
+    A user in several competitions is read once; concurrent loads of the same
+    user wait for the first one.
+    """
+
+    def __init__(self):
+        self._steps: Dict[str, List[Dict[str, Any]]] = {}
+        self._loading: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.hits = 0
+
+    def get(self, uid: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            if uid in self._steps:
+                self.hits += 1
+                return self._steps[uid]
+            event = self._loading.get(uid)
+            owner = event is None
+            if owner:
+                event = self._loading[uid] = threading.Event()
+        if not owner:
+            event.wait()
+            with self._lock:
+                steps = self._steps.get(uid)
+                if steps is not None:
+                    self.hits += 1
+                    return steps
+            # The first load failed
+            return get_user_steps(uid)
+        try:
+            steps = get_user_steps(uid)
+            with self._lock:
+                self._steps[uid] = steps
+                self.loads += 1
+            return steps
+        finally:
+            with self._lock:
+                del self._loading[uid]
+            event.set()
+
+
+class StepWritesCache:
+    """
+    Members' step entries written since the earliest fairness watermark of a batch run
+
+    A user's writes are read once from `since`, for the first competition of
+    the batch that needs them; every competition filters its own window.
+    """
+
+    def __init__(self, since: str):
+        self.since = since
+        self.scans = 0
+        self._by_user: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def written_since(self, since: str, user_ids: List[str], start_date: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Like agents_storage.get_steps_written_since"""
+        if since < self.since:
+            return get_steps_written_since(since, user_ids, start_date)
+        with self._lock:
+            missing = [uid for uid in user_ids if uid not in self._by_user]
+            if missing:
+                self._by_user.update((uid, []) for uid in missing)
+                for entry in get_steps_written_since(self.since, missing):
+                    self._by_user.setdefault(entry["user_id"], []).append(entry)
+                self.scans += 1
+            entries = [entry for uid in user_ids for entry in self._by_user[uid]]
+        return [
+            entry for entry in entries
+            if (entry.get("updated_at") or "") > since and (not start_date or (entry.get("date") or "") >= start_date)
+        ]
+
+
+def load_competition_snapshot(comp_id: str, user_steps_cache: Optional[UserStepsCache] = None,
+                              step_writes: Optional[StepWritesCache] = None) -> CompetitionSnapshot:
+    """
+    Load a competition with one competitions read and one teams read; the
+    members' steps are loaded once, when a tool first needs them
+
+    Args:
+        comp_id: Competition to load
+        user_steps_cache: Share per-user step reads with other snapshots (batch runs)
+        step_writes: Share the scan of recent step writes with other snapshots (batch runs)
+    """
+    competitions = get_competitions(comp_id=comp_id)
+    competition = competitions[0] if competitions else None
+    teams = get_teams_for_competition(comp_id) if competition else []
+    members = sorted({uid for team in teams for uid in team.get("members", [])})
+
+    def load_steps() -> Dict[str, List[Dict[str, Any]]]:
+        started = time.monotonic()
+        steps_by_user = get_competition_steps(comp_id, competition.get("start_date"), members) if competition else None
+        if steps_by_user is None:
+            load = user_steps_cache.get if user_steps_cache else get_user_steps
+            steps_by_user = {uid: load(uid) for uid in members}
+        logger.info(f"Loaded steps of {comp_id}: {len(members)} members in {time.monotonic() - started:.2f}s")
+        return steps_by_user
+
+    return CompetitionSnapshot(comp_id, competition, teams, steps_loader=load_steps, step_writes=step_writes)
+
+
+_active_snapshot: ContextVar[Optional[CompetitionSnapshot]] = ContextVar("active_snapshot", default=None)
+
+
+@contextmanager
+def use_snapshot(snapshot: CompetitionSnapshot):
+    """Make `snapshot` the one tools see for the duration of a run"""
+    token = _active_snapshot.set(snapshot)
+    try:
+        yield snapshot
+    finally:
+        _active_snapshot.reset(token)
+
+
+def snapshot_for(comp_id: str) -> CompetitionSnapshot:
+    """The active snapshot of comp_id, or a freshly loaded one"""
+    snapshot = _active_snapshot.get()
+    if snapshot is not None and snapshot.comp_id == comp_id:
+        return snapshot
+    return load_competition_snapshot(comp_id)
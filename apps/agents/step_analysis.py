@@ -0,0 +1,266 @@
+"""
+Vectorized step anomaly detection for the fairness agent
+
+A competition's steps are loaded once into a users x days matrix (NaN where a
+user didn't submit) and every statistic is computed on whole arrays:
+
+- robust z-scores of each day against the user's own median/MAD
+- robust z-scores of each day against that day's population median/MAD
+- day-over-day jumps
+- percentile of each user's average in the population
+
+A day is a statistical outlier only when it stands out both from the user's
+own history and from everyone else that day, so consistently active users and
+busy days (a weekend hike) don't trip it. Every anomaly carries a
+severity_score in [0, 1] next to the severity label.
+
+Without NumPy only the fixed thresholds are checked.
+"""
+
+import os
+import math
+import warnings
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Any
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Hard limits (kept from the original checks)
+ANOMALY_DAILY_CAP = int(os.getenv("ANOMALY_DAILY_CAP", "50000"))
+ANOMALY_SUSTAINED_AVG = int(os.getenv("ANOMALY_SUSTAINED_AVG", "30000"))
+# Robust z-score above which a day is an outlier
+ANOMALY_ROBUST_Z = float(os.getenv("ANOMALY_ROBUST_Z", "3.5"))
+# Days below this many steps are never flagged statistically
+ANOMALY_MIN_STEPS = int(os.getenv("ANOMALY_MIN_STEPS", "15000"))
+# Day-over-day jump: at least this many more steps and this factor over the previous day
+ANOMALY_JUMP_STEPS = int(os.getenv("ANOMALY_JUMP_STEPS", "15000"))
+ANOMALY_JUMP_RATIO = float(os.getenv("ANOMALY_JUMP_RATIO", "4"))
+# Users whose average is above this population percentile (with enough users to compare)
+ANOMALY_POPULATION_PERCENTILE = float(os.getenv("ANOMALY_POPULATION_PERCENTILE", "99.5"))
+ANOMALY_MIN_POPULATION = int(os.getenv("ANOMALY_MIN_POPULATION", "20"))
+# Lower bound for MAD-based scales, in steps (a user logging 8000 every day has MAD 0)
+ANOMALY_MIN_SCALE = float(os.getenv("ANOMALY_MIN_SCALE", "1000"))
+
+# MAD -> standard deviation for normally distributed data
+MAD_SCALE = 1.4826
+
+
+class StepMatrix:
+    """A competition's steps as a users x days float matrix, NaN where nothing was submitted"""
+
+    def __init__(self, users: List[str], days: List[str], steps):
+        self.users = users
+        self.days = days
+        self.steps = steps
+
+    @property
+    def data_points(self) -> int:
+        return int((~np.isnan(self.steps)).sum())
+
+
+def competition_days(start: date, end: date) -> List[str]:
+    return [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+
+
+def build_step_matrix(users: List[str], days: List[str], steps_by_user: Dict[str, List[Dict[str, Any]]]) -> StepMatrix:
+    """
+    Load step entries into a StepMatrix (entries outside `days` are dropped)
+
+    Dates are matched as strings against the day index, so entries are not
+    parsed one by one; duplicate (user, day) entries keep the highest count.
+    """
+    day_index = {day: i for i, day in enumerate(days)}
+    rows, cols, values = [], [], []
+    for row, uid in enumerate(users):
+        for entry in steps_by_user.get(uid, []):
+            col = day_index.get(entry.get("date"))
+            if col is not None:
+                rows.append(row)
+                cols.append(col)
+                values.append(entry.get("steps", 0))
+
+    steps = np.full((len(users), len(days)), np.nan)
+    if values:
+        np.fmax.at(steps, (np.asarray(rows), np.asarray(cols)), np.asarray(values, dtype=float))
+    return StepMatrix(users, days, steps)
+
+
+def severity_score(z) -> Any:
+    """Map a robust z-score at or above ANOMALY_ROBUST_Z onto [0.5, 1]"""
+    return np.clip(0.5 + (z - ANOMALY_ROBUST_Z) / (2 * ANOMALY_ROBUST_Z), 0.0, 1.0)
+
+
+def severity_label(score: float) -> str:
+    if score >= 0.8:
+        return "high"
+    if score >= 0.6:
+        return "medium"
+    return "low"
+
+
+def _robust_z(values, axis: int):
+    """(x - median) / (1.4826 * MAD) along an axis, NaN-aware, with ANOMALY_MIN_SCALE as the floor"""
+    median = np.nanmedian(values, axis=axis, keepdims=True)
+    mad = np.nanmedian(np.abs(values - median), axis=axis, keepdims=True)
+    scale = np.fmax(MAD_SCALE * mad, ANOMALY_MIN_SCALE)
+    return (values - median) / scale
+
+
+def detect_anomalies(matrix: StepMatrix) -> Dict[str, Any]:
+    """
+    Find anomalous users and days in a StepMatrix
+
+    Returns:
+        {"anomalies": [...] sorted by severity_score, "population": {...}}
+    """
+    x = matrix.steps
+    submitted = ~np.isnan(x)
+    counts = submitted.sum(axis=1)
+    active = counts > 0
+    anomalies: List[Dict[str, Any]] = []
+
+    with warnings.catch_warnings():
+        # All-NaN rows/columns (users or days without submissions) yield NaN, which never compares true
+        warnings.simplefilter("ignore", RuntimeWarning)
+        user_max = np.nanmax(x, axis=1)
+        user_mean = np.nanmean(x, axis=1)
+        z_self = _robust_z(x, axis=1)
+        z_day = _robust_z(x, axis=0)
+        means = user_mean[active]
+        population = {
+            "users_with_data": int(active.sum()),
+            "p50": float(np.percentile(means, 50)) if means.size else None,
+            "p90": float(np.percentile(means, 90)) if means.size else None,
+            "p99": float(np.percentile(means, 99)) if means.size else None,
+        }
+        # Percentile rank of each user's average among users with data
+        percentile = np.full(len(matrix.users), np.nan)
+        if means.size:
+            percentile[active] = 100.0 * np.searchsorted(np.sort(means), means, side="right") / means.size
+        z_mean = _robust_z(user_mean, axis=0) if means.size else np.full(len(matrix.users), np.nan)
+
+    # Hard limits
+    for row in np.flatnonzero(user_max > ANOMALY_DAILY_CAP):
+        col = int(np.nanargmax(x[row]))
+        anomalies.append({
+            "user_id": matrix.users[row],
+            "type": "unrealistic_daily_count",
+            "max_steps": int(user_max[row]),
+            "date": matrix.days[col],
+            "severity": "high",
+            "severity_score": 1.0,
+        })
+    for row in np.flatnonzero(user_mean > ANOMALY_SUSTAINED_AVG):
+        anomalies.append({
+            "user_id": matrix.users[row],
+            "type": "sustained_high_activity",
+            "avg_steps": float(user_mean[row]),
+            "severity": "medium",
+            "severity_score": 0.7,
+        })
+
+    # Days far above both the user's own history and that day's population
+    z_both = np.fmin(z_self, z_day)
+    outlier = (z_both >= ANOMALY_ROBUST_Z) & (x >= ANOMALY_MIN_STEPS) & (x <= ANOMALY_DAILY_CAP)
+    for row in np.flatnonzero(outlier.any(axis=1)):
+        cols = np.flatnonzero(outlier[row])
+        worst = int(cols[np.argmax(z_both[row, cols])])
+        score = float(severity_score(z_both[row, worst]))
+        anomalies.append({
+            "user_id": matrix.users[row],
+            "type": "statistical_outlier",
+            "date": matrix.days[worst],
+            "steps": int(x[row, worst]),
+            "z_user": round(float(z_self[row, worst]), 2),
+            "z_population": round(float(z_day[row, worst]), 2),
+            "outlier_days": int(cols.size),
+            "severity": severity_label(score),
+            "severity_score": round(score, 3),
+        })
+
+    # Sudden jumps from one day to the next (both submitted)
+    if x.shape[1] > 1:
+        previous, current = x[:, :-1], x[:, 1:]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratio = current / np.fmax(previous, 1.0)
+            jump = (current - previous >= ANOMALY_JUMP_STEPS) & (ratio >= ANOMALY_JUMP_RATIO) & (current >= ANOMALY_MIN_STEPS)
+        for row in np.flatnonzero(jump.any(axis=1)):
+            cols = np.flatnonzero(jump[row])
+            worst = int(cols[np.argmax(ratio[row, cols])])
+            score = float(np.clip(0.5 + math.log(ratio[row, worst] / ANOMALY_JUMP_RATIO, ANOMALY_JUMP_RATIO) / 2, 0.5, 1.0))
+            anomalies.append({
+                "user_id": matrix.users[row],
+                "type": "sudden_jump",
+                "date": matrix.days[worst + 1],
+                "steps": int(current[row, worst]),
+                "previous_steps": int(previous[row, worst]),
+                "jump_ratio": round(float(ratio[row, worst]), 2),
+                "severity": severity_label(score),
+                "severity_score": round(score, 3),
+            })
+
+    # Users whose average is extreme for the population
+    if population["users_with_data"] >= ANOMALY_MIN_POPULATION:
+        extreme = active & (percentile >= ANOMALY_POPULATION_PERCENTILE) & (z_mean >= ANOMALY_ROBUST_Z)
+        for row in np.flatnonzero(extreme):
+            score = float(severity_score(z_mean[row]))
+            anomalies.append({
+                "user_id": matrix.users[row],
+                "type": "population_outlier",
+                "avg_steps": round(float(user_mean[row]), 1),
+                "percentile": round(float(percentile[row]), 2),
+                "z_population": round(float(z_mean[row]), 2),
+                "severity": severity_label(score),
+                "severity_score": round(score, 3),
+            })
+
+    anomalies.sort(key=lambda a: -a["severity_score"])
+    return {"anomalies": anomalies, "population": population}
+
+
+def _detect_thresholds(users: List[str], days: List[str], steps_by_user: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Fixed-threshold checks only (NumPy unavailable)"""
+    in_range = set(days)
+    anomalies = []
+    data_points = 0
+    for uid in users:
+        entries = [e for e in steps_by_user.get(uid, []) if e.get("date") in in_range]
+        data_points += len(entries)
+        if not entries:
+            continue
+        peak = max(entries, key=lambda e: e.get("steps", 0))
+        avg_steps = sum(e.get("steps", 0) for e in entries) / len(entries)
+        if peak.get("steps", 0) > ANOMALY_DAILY_CAP:
+            anomalies.append({"user_id": uid, "type": "unrealistic_daily_count", "max_steps": peak.get("steps", 0),
+                              "date": peak.get("date"), "severity": "high", "severity_score": 1.0})
+        if avg_steps > ANOMALY_SUSTAINED_AVG:
+            anomalies.append({"user_id": uid, "type": "sustained_high_activity", "avg_steps": avg_steps,
+                              "severity": "medium", "severity_score": 0.7})
+    return {"anomalies": anomalies, "population": None, "data_points": data_points}
+
+
+def analyze_steps(users: List[str], start: date, end: date, steps_by_user: Dict[str, List[Dict[str, Any]]],
+                  matrix: Optional[StepMatrix] = None) -> Dict[str, Any]:
+    """
+    Run anomaly detection over a competition's steps
+
+    Args:
+        users: Users to analyze
+        start, end: Competition date range
+        steps_by_user: Step entries per user
+        matrix: These users' StepMatrix over the range, if already built
+
+    Returns:
+        {"method", "anomalies", "population", "data_points"}
+    """
+    days = competition_days(start, end)
+    if np is None:
+        return {"method": "thresholds", **_detect_thresholds(users, days, steps_by_user)}
+
+    if matrix is None:
+        matrix = build_step_matrix(users, days, steps_by_user)
+    result = detect_anomalies(matrix)
+    return {"method": "vectorized", **result, "data_points": matrix.data_points}
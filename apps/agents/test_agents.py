@@ -148,6 +148,418 @@ def test_workflow():
         return False
 
 
+def test_step_analysis():
+    """Test vectorized anomaly detection"""
+    print("Testing step anomaly detection...")
+    try:
+        from datetime import date
+        from step_analysis import analyze_steps, np
+        
+        users = [f"user{i}@example.com" for i in range(30)]
+        steps_by_user = {
+            uid: [{"user_id": uid, "date": f"2025-03-{day:02d}", "steps": 7000 + 150 * i + 40 * day} for day in range(1, 11)]
+            for i, uid in enumerate(users)
+        }
+        # A user who is suddenly far above their own history and everyone else
+        steps_by_user[users[3]][6]["steps"] = 42000
+        # A user over the hard daily cap
+        steps_by_user[users[7]][2]["steps"] = 65000
+        
+        result = analyze_steps(users, date(2025, 3, 1), date(2025, 3, 10), steps_by_user)
+        found = {(a["user_id"], a["type"]) for a in result["anomalies"]}
+        
+        assert result["data_points"] == 300, f"Expected 300 data points, got {result['data_points']}"
+        assert (users[7], "unrealistic_daily_count") in found, "Hard cap should still be flagged"
+        if np is not None:
+            assert result["method"] == "vectorized"
+            assert (users[3], "statistical_outlier") in found, f"Outlier day not flagged: {found}"
+            assert (users[3], "sudden_jump") in found, f"Jump not flagged: {found}"
+            assert {uid for uid, _ in found} == {users[3], users[7]}, f"Unexpected anomalies: {found}"
+            assert all(0 <= a["severity_score"] <= 1 for a in result["anomalies"])
+        
+        print(f"  ✅ Anomalies detected ({result['method']}): {sorted(found)}")
+        return True
+    except Exception as e:
+        print(f"  ❌ Step analysis test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_pattern_detection():
+    """Test hash-grouped pattern detection"""
+    print("Testing pattern detection...")
+    try:
+        from pattern_detection import iter_patterns, summarize_patterns
+        
+        def entries(uid, start_day, counts):
+            return [{"user_id": uid, "date": f"2025-04-{start_day + i:02d}", "steps": steps} for i, steps in enumerate(counts)]
+        
+        copied = [8123, 9456, 7789, 10234, 6543]
+        steps_by_user = {
+            "original": entries("original", 1, copied),
+            # Same five days copied onto later dates
+            "copier": entries("copier", 10, copied),
+            "honest": entries("honest", 1, [8124, 9450, 7700, 10200, 6500]),
+            "round": entries("round", 1, [20000, 20000, 30000]),
+            "same1": entries("same1", 1, [20000]),
+            "same2": entries("same2", 1, [20000]),
+        }
+        
+        summary = summarize_patterns(iter_patterns(list(steps_by_user), steps_by_user), max_examples=2)
+        counts = summary["pattern_counts"]
+        
+        assert counts["identical_sequences"] == 1, f"Expected one copied run, got {summary['patterns']['identical_sequences']}"
+        sequence = summary["patterns"]["identical_sequences"][0]
+        assert sequence["days"] == 5 and sequence["steps"] == copied
+        assert {m["user_id"] for m in sequence["matches"]} == {"original", "copier"}
+        assert counts["identical_values"] == 1, "Three users with 20000 on one day"
+        assert counts["perfect_days"] == 1
+        assert counts["round_numbers"] == 5 and len(summary["patterns"]["round_numbers"]) == 2, "Examples are bounded"
+        
+        print(f"  ✅ Patterns detected: {counts}")
+        return True
+    except Exception as e:
+        print(f"  ❌ Pattern detection test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_shared_snapshot():
+    """Test that tools reuse the run's competition snapshot"""
+    print("Testing shared competition snapshot...")
+    try:
+        from snapshot import CompetitionSnapshot, use_snapshot, snapshot_for
+        from agents import FairnessAgent
+        
+        teams = [{"team_id": "t1", "members": ["a@example.com", "b@example.com"]}]
+        steps = {uid: [{"user_id": uid, "date": "2025-05-02", "steps": 9000}] for uid in ["a@example.com", "b@example.com"]}
+        snapshot = CompetitionSnapshot("snap-comp", {"comp_id": "snap-comp", "start_date": "2025-05-01", "end_date": "2025-05-07"}, teams, steps)
+        
+        with use_snapshot(snapshot):
+            assert snapshot_for("snap-comp") is snapshot, "Active snapshot should be reused"
+        
+        # The competition only exists in the snapshot, so the tools must not reload it
+        result = FairnessAgent().run("snap-comp", snapshot=snapshot)
+        analysis = result["findings"][0]
+        assert analysis.get("users_analyzed") == 2, f"Unexpected analysis: {analysis}"
+        assert analysis.get("total_data_points") == 2
+        
+        print("  ✅ Tools share the run's snapshot")
+        return True
+    except Exception as e:
+        print(f"  ❌ Shared snapshot test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_llm_cache():
+    """Test prompt digests and the response cache"""
+    print("Testing LLM digest and response cache...")
+    try:
+        from llm_cache import cached_recommendations, digest_findings, PROMPT_MAX_EXAMPLES
+        
+        class FakeResponse:
+            def __init__(self, text):
+                self.text = text
+        
+        class FakeModel:
+            def __init__(self):
+                self.calls = 0
+                self.prompts = []
+            
+            def generate_content(self, prompt):
+                self.calls += 1
+                self.prompts.append(prompt)
+                return FakeResponse(f"answer {self.calls}")
+        
+        findings = [{
+            "comp_id": "cache-comp",
+            "missing_users": [f"user{i}@example.com" for i in range(5000)],
+            "missing_count": 5000,
+            "timestamp": "2025-01-01T00:00:00",
+        }]
+        digest = digest_findings(findings)
+        assert digest[0]["missing_users"]["count"] == 5000
+        assert len(digest[0]["missing_users"]["examples"]) == PROMPT_MAX_EXAMPLES
+        assert "timestamp" not in digest[0]
+        
+        model = FakeModel()
+        first = cached_recommendations(model, "sync-test", "Recommend", findings)
+        # Same data in a later run (new timestamp) is served from the cache
+        rerun = [{**findings[0], "timestamp": "2025-01-02T00:00:00"}]
+        second = cached_recommendations(model, "sync-test", "Recommend", rerun)
+        assert first == second == "answer 1" and model.calls == 1, f"Expected one call, got {model.calls}"
+        assert len(model.prompts[0]) < 2000, f"Prompt too large: {len(model.prompts[0])} chars"
+        
+        # An incremental fairness run's watermark moves every run
+        fairness = [{"comp_id": "cache-comp", "mode": "incremental", "since": "2025-01-01T00:00:00", "anomaly_count": 0}]
+        cached_recommendations(model, "fairness-test", "Recommend", fairness)
+        cached_recommendations(model, "fairness-test", "Recommend", [{**fairness[0], "since": "2025-01-02T00:00:00"}])
+        assert model.calls == 2, f"Expected the fairness rerun to be cached, got {model.calls} calls"
+        
+        changed = [{**findings[0], "missing_count": 4999}]
+        assert cached_recommendations(model, "sync-test", "Recommend", changed) == "answer 3"
+        
+        print(f"  ✅ Digest bounded ({len(model.prompts[0])} chars), repeated findings cached")
+        return True
+    except Exception as e:
+        print(f"  ❌ LLM cache test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_batch_run():
+    """Test batch runs and shared user loads"""
+    print("Testing batch agent run...")
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        import snapshot
+        from batch import run_batch
+        
+        loads = []
+        original = snapshot.get_user_steps
+        snapshot.get_user_steps = lambda uid: loads.append(uid) or [{"user_id": uid, "date": "2025-05-01", "steps": 5000}]
+        try:
+            cache = snapshot.UserStepsCache()
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(cache.get, ["a", "b", "a", "a", "b", "c"] * 5))
+        finally:
+            snapshot.get_user_steps = original
+        assert sorted(loads) == ["a", "b", "c"], f"Each user should be read once, got {loads}"
+        assert all(r[0]["steps"] == 5000 for r in results)
+        
+        # Unknown competitions are reported per competition, not raised
+        runners = {"fairness": lambda comp_id, date, snap: {"flag_count": 0}}
+        summary = run_batch("fairness", runners, comp_ids=["missing-1", "missing-2"], max_workers=2)
+        assert summary["competition_count"] == 2 and summary["failed"] == 2
+        assert summary["competitions"][0]["error"] == "Competition not found"
+        
+        print("  ✅ Batch run aggregates results and shares user loads")
+        return True
+    except Exception as e:
+        print(f"  ❌ Batch run test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_incremental_fairness():
+    """Test watermark-based incremental fairness runs"""
+    print("Testing incremental fairness analysis...")
+    try:
+        import agents
+        import agents_storage
+        from snapshot import CompetitionSnapshot
+        
+        competition = {"comp_id": "inc-test", "start_date": "2025-05-01", "end_date": "2025-05-31"}
+        members = [f"u{i}" for i in range(30)]
+        teams = [{"team_id": "t1", "members": members}]
+        history = {
+            uid: [{"user_id": uid, "date": f"2025-05-{day:02d}", "steps": 8000 + 37 * i + 11 * day} for day in range(1, 11)]
+            for i, uid in enumerate(members)
+        }
+        fairness_agent = agents.FairnessAgent()
+        agents_storage.FAIRNESS_STATE.pop("inc-test", None)
+        
+        result = fairness_agent.run("inc-test", snapshot=CompetitionSnapshot("inc-test", competition, teams, history))
+        assert result["mode"] == "full"
+        assert agents_storage.FAIRNESS_STATE["inc-test"]["users"]["u0"]["count"] == 10
+        
+        loaded = []
+        def lazy_snapshot():
+            return CompetitionSnapshot("inc-test", competition, teams, steps_loader=lambda: loaded.append(1) or history)
+        
+        new_entries = [{"user_id": uid, "date": "2025-05-11", "steps": 8500 + 13 * i} for i, uid in enumerate(members)]
+        new_entries[3]["steps"] = 45000
+        original = agents.get_steps_written_since
+        agents.get_steps_written_since = lambda since, user_ids, start_date=None: new_entries
+        try:
+            result = fairness_agent.run("inc-test", snapshot=lazy_snapshot())
+            assert result["mode"] == "incremental"
+            assert not loaded, "An incremental run should not load the full history"
+            flagged = {(f.get("user_id"), f["type"]) for f in result["flags"]}
+            assert ("u3", "statistical_outlier") in flagged, f"Expected u3 to be flagged, got {flagged}"
+            assert agents_storage.FAIRNESS_STATE["inc-test"]["users"]["u0"]["count"] == 11
+            
+            # Entries read again through the watermark overlap change nothing
+            result = fairness_agent.run("inc-test", snapshot=lazy_snapshot())
+            assert result["findings"][0]["users_analyzed"] == 0
+            assert agents_storage.FAIRNESS_STATE["inc-test"]["users"]["u0"]["count"] == 11
+            
+            # A day that has left the recent window is never counted twice
+            before = dict(agents_storage.FAIRNESS_STATE["inc-test"]["users"]["u0"])
+            new_entries[:] = [{"user_id": "u0", "date": "2025-05-02", "steps": 9100}]
+            fairness_agent.run("inc-test", snapshot=lazy_snapshot())
+            after = agents_storage.FAIRNESS_STATE["inc-test"]["users"]["u0"]
+            assert (after["count"], after["sum"]) == (before["count"], before["sum"])
+            
+            # A batch's snapshots read each member's step writes once
+            import snapshot as snapshot_module
+            scans = []
+            original_scan = snapshot_module.get_steps_written_since
+            snapshot_module.get_steps_written_since = lambda since, user_ids, start_date=None: scans.append(list(user_ids)) or []
+            try:
+                shared = snapshot_module.StepWritesCache("2025-05-01T00:00:00")
+                for _ in range(3):
+                    fairness_agent.run("inc-test", snapshot=CompetitionSnapshot("inc-test", competition, teams, steps_loader=lambda: history, step_writes=shared))
+                assert shared.scans == 1 and scans == [sorted(members)], f"Expected one read of the members, got {scans}"
+                shared.written_since("2025-05-02T00:00:00", ["u0", "u-other"])
+                assert scans[1:] == [["u-other"]], f"Only users not read yet should be queried, got {scans[1:]}"
+            finally:
+                snapshot_module.get_steps_written_since = original_scan
+            
+            result = fairness_agent.run("inc-test", snapshot=lazy_snapshot(), full_scan=True)
+            assert result["mode"] == "full" and loaded
+            assert agents_storage.FAIRNESS_STATE["inc-test"]["users"]["u0"]["count"] == 10
+        finally:
+            agents.get_steps_written_since = original
+            agents_storage.FAIRNESS_STATE.pop("inc-test", None)
+        
+        print("  ✅ Incremental runs score only new entries, count each day once and full_scan rebuilds the state")
+        return True
+    except Exception as e:
+        print(f"  ❌ Incremental fairness test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_read_model_tail():
+    """Test that the read model's Firestore tail is bounded and member-scoped"""
+    print("Testing read model tail queries...")
+    try:
+        import agents_storage
+        
+        class FakeModel:
+            def __init__(self, through):
+                self.version = f"v-{through}"
+                self.through = through
+            
+            def members(self):
+                return ["old@example.com"]
+            
+            def steps_by_user(self):
+                return {}
+        
+        class FakeQuery:
+            def __init__(self, log, filters=()):
+                self.log = log
+                self.filters = filters
+            
+            def where(self, *condition):
+                return FakeQuery(self.log, self.filters + (condition,))
+            
+            def stream(self):
+                self.log.append(self.filters)
+                return []
+        
+        queries = []
+        originals = (agents_storage.open_read_model, agents_storage._fs_coll, agents_storage.GCP_ENABLED)
+        members = [f"tail{i}@example.com" for i in range(agents_storage.FIRESTORE_IN_LIMIT + 5)]
+        agents_storage._fs_coll = lambda name: FakeQuery(queries)
+        agents_storage.GCP_ENABLED = True
+        try:
+            agents_storage.open_read_model = lambda comp_id: FakeModel(None)
+            assert agents_storage.get_competition_steps("tail-comp") is None, "No export and no start date: per-user path"
+            
+            agents_storage._competition_steps_cache.clear()
+            agents_storage.get_competition_steps("tail-comp", "2025-05-01", members)
+            assert len(queries) == 2, f"Expected one query per {agents_storage.FIRESTORE_IN_LIMIT} members, got {len(queries)}"
+            assert all(q[1] == ("date", ">=", "2025-05-01") for q in queries), queries
+            assert sorted(uid for q in queries for uid in q[0][2]) == sorted(members)
+            
+            queries.clear()
+            agents_storage._competition_steps_cache.clear()
+            agents_storage.open_read_model = lambda comp_id: FakeModel("2025-05-10")
+            agents_storage.get_competition_steps("tail-comp", "2025-05-01")
+            assert queries == [(("user_id", "in", ["old@example.com"]), ("date", ">", "2025-05-10"))], queries
+        finally:
+            agents_storage.open_read_model, agents_storage._fs_coll, agents_storage.GCP_ENABLED = originals
+            agents_storage._competition_steps_cache.clear()
+        
+        print("  ✅ Tail queries are bounded by date and scoped to members")
+        return True
+    except Exception as e:
+        print(f"  ❌ Read model tail test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_shared_clients():
+    """Test that storage helpers share one lazily created Firestore client"""
+    print("Testing shared GCP clients...")
+    try:
+        import threading
+        from types import SimpleNamespace
+        import gcp_clients
+        import agents_storage
+        
+        class FakeFirestore:
+            def __init__(self):
+                self.collections = []
+                self.get_all_calls = 0
+            
+            def collection(self, name):
+                self.collections.append(name)
+                return SimpleNamespace(
+                    where=lambda *condition: SimpleNamespace(stream=lambda: [
+                        SimpleNamespace(id=f"team-{i}", to_dict=lambda: {"comp_id": "shared-comp"}) for i in range(3)
+                    ]),
+                    document=lambda doc_id: SimpleNamespace(id=doc_id),
+                )
+            
+            def get_all(self, refs):
+                self.get_all_calls += 1
+                return [SimpleNamespace(id=ref.id, exists=True, to_dict=lambda ref=ref: {"members": [f"{ref.id}@example.com"]}) for ref in refs]
+        
+        created = []
+        
+        def create_clients():
+            created.append(FakeFirestore())
+            gcp_clients.firestore_client = created[-1]
+        
+        originals = (gcp_clients.GCP_ENABLED, gcp_clients._initialized, gcp_clients.firestore_client,
+                     gcp_clients._create_clients, agents_storage.GCP_ENABLED)
+        gcp_clients.GCP_ENABLED = True
+        gcp_clients._initialized = False
+        gcp_clients.firestore_client = None
+        gcp_clients._create_clients = create_clients
+        agents_storage.GCP_ENABLED = True
+        try:
+            # Concurrent first uses create the client once
+            seen = []
+            threads = [threading.Thread(target=lambda: seen.append(gcp_clients.fs())) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            gcp_clients.init_clients()
+            assert len(created) == 1, f"Expected one client, created {len(created)}"
+            assert all(client is created[0] for client in seen), "Every caller should get the shared client"
+            
+            # Storage helpers go through the same client, team members in one batched read
+            teams = agents_storage.get_teams_for_competition("shared-comp")
+            assert len(created) == 1
+            assert [team["members"] for team in teams] == [[f"team-{i}@example.com"] for i in range(3)]
+            assert created[0].get_all_calls == 1, f"Expected one get_all, got {created[0].get_all_calls}"
+        finally:
+            (gcp_clients.GCP_ENABLED, gcp_clients._initialized, gcp_clients.firestore_client,
+             gcp_clients._create_clients, agents_storage.GCP_ENABLED) = originals
+        
+        print("  ✅ One Firestore client is created on first use and shared")
+        return True
+    except Exception as e:
+        print(f"  ❌ Shared clients test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
 def test_main_endpoints():
     """Test main.py endpoints structure"""
     print("Testing main.py endpoints...")
@@ -189,6 +601,14 @@ def main():
         ("Agent Creation", test_agent_creation),
         ("Agent Tools", test_agent_tools),
         ("Workflow", test_workflow),
+        ("Step Analysis", test_step_analysis),
+        ("Pattern Detection", test_pattern_detection),
+        ("Shared Snapshot", test_shared_snapshot),
+        ("LLM Cache", test_llm_cache),
+        ("Batch Run", test_batch_run),
+        ("Incremental Fairness", test_incremental_fairness),
+        ("Read Model Tail", test_read_model_tail),
+        ("Shared Clients", test_shared_clients),
         ("Main Endpoints", test_main_endpoints),
     ]
     
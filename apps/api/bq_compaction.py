@@ -0,0 +1,86 @@
+"""
+Compaction of the BigQuery step facts
+
+fact_daily_steps is append-only: every write path (API ingest, device sync,
+ingest worker) streams a row, so one (user_id, date) accumulates many rows.
+compact_daily_steps() MERGEs them into daily_steps_curated with one row per
+(user_id, date) holding max(steps), the same rule write_daily_steps applies.
+Analytics should read the curated table.
+
+Both tables are partitioned by date and clustered by user_id (see
+infra/bq/create_tables.sql); the MERGE only touches the recent partitions
+unless a full rebuild is requested.
+"""
+
+import os
+import time
+import logging
+from datetime import date, timedelta
+from typing import Dict, Any, Optional
+
+from gcp_clients import bq
+
+logger = logging.getLogger(__name__)
+
+BQ_DATASET = os.getenv("BQ_DATASET", "stepsquad")
+FACT_TABLE = "fact_daily_steps"
+CURATED_TABLE = "daily_steps_curated"
+# Days re-compacted by a scheduled run; late syncs and catch-ups land within this window
+COMPACTION_LOOKBACK_DAYS = int(os.getenv("COMPACTION_LOOKBACK_DAYS", "35"))
+
+COMPACT_DAILY_STEPS_SQL = """
+MERGE `{dataset}.{curated}` AS target
+USING (
+  SELECT user_id, date, MAX(steps) AS steps
+  FROM `{dataset}.{fact}`
+  WHERE date >= @start_date
+  GROUP BY user_id, date
+) AS source
+ON target.user_id = source.user_id
+  AND target.date = source.date
+  AND target.date >= @start_date
+WHEN MATCHED AND target.steps < source.steps THEN
+  UPDATE SET steps = source.steps, updated_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN
+  INSERT (user_id, date, steps, updated_at)
+  VALUES (source.user_id, source.date, source.steps, CURRENT_TIMESTAMP())
+"""
+
+
+def compact_daily_steps(lookback_days: Optional[int] = COMPACTION_LOOKBACK_DAYS) -> Dict[str, Any]:
+    """
+    MERGE recent fact rows into the curated table
+
+    Args:
+        lookback_days: Re-compact dates from this many days ago onward;
+            None compacts the whole fact table (initial load / rebuild)
+
+    Returns:
+        Summary with the start date, affected rows and bytes processed
+
+    Raises:
+        RuntimeError: If BigQuery is not configured
+    """
+    if not bq():
+        raise RuntimeError("BigQuery is not configured")
+
+    from google.cloud import bigquery
+
+    start_date = date.min if lookback_days is None else date.today() - timedelta(days=lookback_days)
+    sql = COMPACT_DAILY_STEPS_SQL.format(dataset=BQ_DATASET, curated=CURATED_TABLE, fact=FACT_TABLE)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("start_date", "DATE", start_date)]
+    )
+
+    started = time.monotonic()
+    job = bq().query(sql, job_config=job_config)
+    job.result()
+
+    summary = {
+        "start_date": None if lookback_days is None else start_date.isoformat(),
+        "affected_rows": job.num_dml_affected_rows or 0,
+        "bytes_processed": job.total_bytes_processed or 0,
+        "seconds": round(time.monotonic() - started, 2),
+    }
+    logger.info(f"Compacted {FACT_TABLE} into {CURATED_TABLE}: {summary}")
+    return summary
@@ -0,0 +1,201 @@
+"""
+Per-provider circuit breakers for device API calls
+
+While Fitbit or Garmin is down, every request would otherwise wait out its
+full timeout. Each provider gets a breaker that tracks the outcome of its most
+recent calls; a call counts as failed on a connection error, a 5xx or when it
+is slower than CIRCUIT_SLOW_CALL_SECONDS. Once enough of the window fails the
+breaker opens and calls fail fast with CircuitOpenError. After
+CIRCUIT_OPEN_SECONDS it lets a probe through (half-open): a successful probe
+closes the breaker again, a failed one re-opens it.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional, Any
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_WINDOW_SIZE = int(os.getenv("CIRCUIT_WINDOW_SIZE", "20"))  # Recent calls considered
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))  # Don't trip on fewer calls than this
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(ValueError):
+    """The provider's breaker is open; the call was not attempted"""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"{name.capitalize()} API unavailable (circuit open), retry after {int(retry_after + 0.999)}s")
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker driven by failure rate and latency"""
+
+    def __init__(
+        self,
+        name: str,
+        window_size: int = CIRCUIT_WINDOW_SIZE,
+        min_calls: int = CIRCUIT_MIN_CALLS,
+        failure_rate: float = CIRCUIT_FAILURE_RATE,
+        slow_call_seconds: float = CIRCUIT_SLOW_CALL_SECONDS,
+        open_seconds: float = CIRCUIT_OPEN_SECONDS
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window_size)  # True = success
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _retry_after(self, now: float) -> float:
+        return max(0.0, self.opened_at + self.open_seconds - now)
+
+    def _trip(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.times_opened += 1
+        self._probe_in_flight = False
+        logger.warning(f"Circuit for {self.name} opened, failing fast for {self.open_seconds:.0f}s")
+
+    def check(self) -> None:
+        """Raise CircuitOpenError if a call would be rejected right now (doesn't claim a probe)"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and self._retry_after(now) > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self._retry_after(now))
+            if self.state == HALF_OPEN and self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.open_seconds)
+
+    def _before_call(self) -> bool:
+        """Admit a call; returns True if it is the half-open probe"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if self._retry_after(now) > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self._retry_after(now))
+                self.state = HALF_OPEN
+                logger.info(f"Circuit for {self.name} half-open, probing")
+            if self.state == HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.open_seconds)
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def _record(self, success: bool, probe: bool):
+        with self._lock:
+            now = time.monotonic()
+            if probe:
+                self._probe_in_flight = False
+                if success:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"Circuit for {self.name} closed, provider recovered")
+                else:
+                    self._trip(now)
+                return
+
+            if self.state != CLOSED:
+                return
+            self._outcomes.append(success)
+            if len(self._outcomes) >= self.min_calls:
+                failures = self._outcomes.count(False)
+                if failures / len(self._outcomes) >= self.failure_rate:
+                    self._trip(now)
+
+    def call(self, fn: Callable[..., requests.Response], *args, **kwargs) -> requests.Response:
+        """
+        Run an HTTP call through the breaker
+
+        Connection errors, 5xx responses and slow calls count as failures.
+        Other responses (including 4xx and 429) count as successes, since the
+        provider itself is up.
+
+        Raises:
+            CircuitOpenError: If the breaker is open
+        """
+        probe = self._before_call()
+        start = time.monotonic()
+        try:
+            response = fn(*args, **kwargs)
+        except requests.RequestException:
+            self._record(False, probe)
+            raise
+        except Exception:
+            # Not a provider failure, just release the probe slot
+            self._record(True, probe)
+            raise
+
+        elapsed = time.monotonic() - start
+        self._record(response.status_code < 500 and elapsed <= self.slow_call_seconds, probe)
+        return response
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current state for health reporting"""
+        with self._lock:
+            now = time.monotonic()
+            state = self.state
+            if state == OPEN and self._retry_after(now) <= 0:
+                state = HALF_OPEN  # Next call will probe
+            failures = self._outcomes.count(False)
+            return {
+                "state": state,
+                "recent_calls": len(self._outcomes),
+                "recent_failures": failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "retry_after": round(self._retry_after(now), 1) if state == OPEN else 0,
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Get the shared breaker for a provider, creating it on first use"""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            _breakers[name] = breaker
+        return breaker
+
+
+def set_breaker(name: str, breaker: Optional[CircuitBreaker]) -> None:
+    """Replace (or with None, reset) a provider's breaker, e.g. in tests"""
+    with _breakers_lock:
+        if breaker is None:
+            _breakers.pop(name, None)
+        else:
+            _breakers[name] = breaker
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    """Snapshot of every breaker, for /health"""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: breaker.snapshot() for name, breaker in breakers.items()}
@@ -23,7 +23,12 @@ def _fs_coll(name: str):
     return fs().collection(name) if fs() and GCP_ENABLED else None
 
 
-def store_device_tokens(uid: str, provider: str, tokens: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+def store_device_tokens(
+    uid: str,
+    provider: str,
+    tokens: Optional[Dict[str, Any]] = None,
+    refresh: bool = False
+) -> Dict[str, Any]:
     """
     Store OAuth tokens for a user's device (or connect virtual device)
     
@@ -32,10 +37,32 @@ def store_device_tokens(uid: str, provider: str, tokens: Optional[Dict[str, Any]
         provider: Provider name ("garmin", "fitbit", or "virtual")
         tokens: OAuth token data (access_token, refresh_token, expires_at, etc.)
                For virtual devices, tokens can be None
+        refresh: True when storing refreshed tokens for an already linked device.
+               Only the token fields are written, so linked_at/last_sync are kept.
     
     Returns:
         Stored device data
     """
+    device_id = f"{uid}_{provider}"
+    
+    if refresh:
+        update_data = {
+            "tokens": tokens if tokens else {},
+            "tokens_refreshed_at": datetime.utcnow().isoformat(),
+            "token_refresh_claimed_until": None,
+        }
+        if GCP_ENABLED and _fs_coll("device_tokens"):
+            _fs_coll("device_tokens").document(device_id).set(update_data, merge=True)
+            logger.info(f"Stored refreshed {provider} tokens for user {uid} in Firestore")
+            return update_data
+        
+        device_data = DEVICE_TOKENS.get(uid, {}).get(provider)
+        if device_data is not None:
+            device_data.update(update_data)
+            logger.info(f"Stored refreshed {provider} tokens for user {uid} in memory")
+            return device_data
+        # Device not linked in memory yet, fall through to a full store
+    
     device_data = {
         "uid": uid,
         "provider": provider,
@@ -45,8 +72,6 @@ def store_device_tokens(uid: str, provider: str, tokens: Optional[Dict[str, Any]
         "sync_enabled": True,
     }
     
-    device_id = f"{uid}_{provider}"
-    
     if GCP_ENABLED and _fs_coll("device_tokens"):
         # Store in Firestore
         # Note: In production, encrypt tokens before storing
@@ -189,6 +214,48 @@ def update_device_sync_time(uid: str, provider: str, sync_time: Optional[datetim
         return False
 
 
+def try_claim_token_refresh(uid: str, provider: str, ttl_seconds: int = 30) -> bool:
+    """
+    Claim the right to refresh a device's tokens across instances
+    
+    Fitbit refresh tokens are single-use, so two instances refreshing the same
+    device at once would invalidate each other. The claim is a short-lived
+    timestamp on the device document, set in a transaction. It is cleared when
+    refreshed tokens are stored and expires on its own if the holder crashes.
+    
+    Returns:
+        True if the caller may refresh, False if another instance holds the claim
+    """
+    device_id = f"{uid}_{provider}"
+    now = datetime.utcnow().timestamp()
+    
+    if GCP_ENABLED and _fs_coll("device_tokens"):
+        from google.cloud import firestore
+        doc_ref = _fs_coll("device_tokens").document(device_id)
+        
+        @firestore.transactional
+        def _claim(transaction) -> bool:
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            claimed_until = (snapshot.to_dict() or {}).get("token_refresh_claimed_until")
+            if claimed_until and claimed_until > now:
+                return False
+            transaction.update(doc_ref, {"token_refresh_claimed_until": now + ttl_seconds})
+            return True
+        
+        return _claim(fs().transaction())
+    
+    # Local storage: a single process, the caller's in-process lock is enough
+    return provider in DEVICE_TOKENS.get(uid, {})
+
+
+def release_token_refresh(uid: str, provider: str) -> None:
+    """Drop a refresh claim without storing new tokens (e.g. after a failed refresh)"""
+    if GCP_ENABLED and _fs_coll("device_tokens"):
+        _fs_coll("device_tokens").document(f"{uid}_{provider}").update({"token_refresh_claimed_until": None})
+
+
 def get_all_linked_devices() -> List[Dict[str, Any]]:
     """
     Get all linked devices across all users (for background sync)
@@ -213,3 +280,63 @@ def get_all_linked_devices() -> List[Dict[str, Any]]:
     
     return devices
 
+
+
+def set_device_subscription(uid: str, provider: str, subscription_id: str) -> bool:
+    """
+    Record the provider push subscription id for a device
+    
+    Webhook notifications carry this id (Fitbit) instead of our uid.
+    
+    Returns:
+        True if updated
+    """
+    update_data = {"subscription_id": subscription_id}
+    
+    if GCP_ENABLED and _fs_coll("device_tokens"):
+        _fs_coll("device_tokens").document(f"{uid}_{provider}").set(update_data, merge=True)
+        return True
+    
+    if uid in DEVICE_TOKENS and provider in DEVICE_TOKENS[uid]:
+        DEVICE_TOKENS[uid][provider].update(update_data)
+        return True
+    return False
+
+
+def find_device(provider: str, field: str, value: Any) -> Optional[Dict[str, Any]]:
+    """
+    Find a linked device by a field value, e.g. to map a webhook notification to a user
+    
+    Args:
+        provider: Provider name ("garmin" or "fitbit")
+        field: Field path, dotted for nested fields (e.g. "tokens.access_token")
+        value: Value to match
+    
+    Returns:
+        Device data or None if no device matches
+    """
+    if not value:
+        return None
+    
+    if GCP_ENABLED and _fs_coll("device_tokens"):
+        query = (
+            _fs_coll("device_tokens")
+            .where("provider", "==", provider)
+            .where(field, "==", value)
+            .limit(1)
+        )
+        for doc in query.stream():
+            return doc.to_dict()
+        return None
+    
+    # Local storage
+    for providers in DEVICE_TOKENS.values():
+        device_data = providers.get(provider)
+        if not device_data:
+            continue
+        current: Any = device_data
+        for part in field.split("."):
+            current = current.get(part) if isinstance(current, dict) else None
+        if current == value:
+            return device_data
+    return None
@@ -8,9 +8,12 @@ import os
 import logging
 import requests
 from typing import Dict, Optional, Any
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import secrets
 import base64
+import hashlib
+from http_sessions import get_session
+from rate_limiter import rate_limited_get, user_key_for
 
 logger = logging.getLogger(__name__)
 
@@ -18,9 +21,16 @@ logger = logging.getLogger(__name__)
 FITBIT_CLIENT_ID = os.getenv("FITBIT_CLIENT_ID", "")
 FITBIT_CLIENT_SECRET = os.getenv("FITBIT_CLIENT_SECRET", "")
 FITBIT_REDIRECT_URI = os.getenv("FITBIT_REDIRECT_URI", "http://localhost:8004/oauth/fitbit/callback")
-FITBIT_BASE_URL = "https://api.fitbit.com"
+# Base URL can be overridden to point the client at a local stub server
+FITBIT_BASE_URL = os.getenv("FITBIT_BASE_URL", "https://api.fitbit.com")
 FITBIT_AUTH_URL = "https://www.fitbit.com/oauth2/authorize"
-FITBIT_TOKEN_URL = "https://api.fitbit.com/oauth2/token"
+FITBIT_TOKEN_URL = os.getenv("FITBIT_TOKEN_URL", f"{FITBIT_BASE_URL}/oauth2/token")
+FITBIT_MAX_RANGE_DAYS = 1095  # Longest range the steps time-series endpoint accepts
+
+
+def _session() -> requests.Session:
+    """Shared keep-alive session for all Fitbit API calls"""
+    return get_session("fitbit")
 
 
 def generate_state_token(uid: str) -> str:
@@ -79,7 +89,7 @@ def exchange_fitbit_code(code: str) -> Dict[str, Any]:
     }
     
     try:
-        response = requests.post(FITBIT_TOKEN_URL, headers=headers, data=data, timeout=10)
+        response = _session().post(FITBIT_TOKEN_URL, headers=headers, data=data, timeout=10)
         response.raise_for_status()
         
         token_data = response.json()
@@ -127,7 +137,7 @@ def refresh_fitbit_token(refresh_token: str) -> Dict[str, Any]:
     }
     
     try:
-        response = requests.post(FITBIT_TOKEN_URL, headers=headers, data=data, timeout=10)
+        response = _session().post(FITBIT_TOKEN_URL, headers=headers, data=data, timeout=10)
         response.raise_for_status()
         
         token_data = response.json()
@@ -146,13 +156,14 @@ def refresh_fitbit_token(refresh_token: str) -> Dict[str, Any]:
         raise ValueError(f"Failed to refresh Fitbit token: {str(e)}")
 
 
-def get_fitbit_daily_steps(access_token: str, date: date) -> int:
+def get_fitbit_daily_steps(access_token: str, date: date, uid: Optional[str] = None) -> int:
     """
     Fetch daily step count from Fitbit API
     
     Args:
         access_token: OAuth access token
         date: Date to fetch steps for (YYYY-MM-DD format)
+        uid: User the token belongs to, keys the per-user rate limit
     
     Returns:
         Step count for the day
@@ -171,7 +182,7 @@ def get_fitbit_daily_steps(access_token: str, date: date) -> int:
     }
     
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = rate_limited_get("fitbit", _session(), url, user_key_for(uid, access_token), headers=headers, timeout=10)
         response.raise_for_status()
         
         data = response.json()
@@ -197,27 +208,92 @@ def get_fitbit_daily_steps(access_token: str, date: date) -> int:
         raise ValueError(f"Failed to fetch Fitbit data: {str(e)}")
 
 
-def get_fitbit_steps_range(access_token: str, start_date: date, end_date: date) -> Dict[str, int]:
+def get_fitbit_steps_range(access_token: str, start_date: date, end_date: date, uid: Optional[str] = None) -> Dict[str, int]:
     """
     Fetch step counts for a date range from Fitbit
     
+    Uses the activity time-series endpoint, so a range costs one call per
+    FITBIT_MAX_RANGE_DAYS window instead of one call per day.
+    
     Returns:
         Dictionary mapping date (ISO format) to step count
     """
+    if not access_token:
+        raise ValueError("Access token required")
+    
+    if end_date < start_date:
+        return {}
+    
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Accept": "application/json",
+    }
+    
     steps_data = {}
     
-    current_date = start_date
-    while current_date <= end_date:
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(end_date, chunk_start + timedelta(days=FITBIT_MAX_RANGE_DAYS - 1))
+        
+        # Format: /1/user/-/activities/steps/date/{start}/{end}.json
+        url = f"{FITBIT_BASE_URL}/1/user/-/activities/steps/date/{chunk_start.isoformat()}/{chunk_end.isoformat()}.json"
+        
         try:
-            steps = get_fitbit_daily_steps(access_token, current_date)
-            steps_data[current_date.isoformat()] = steps
-        except Exception as e:
-            logger.warning(f"Failed to fetch steps for {current_date}: {e}")
-            # Continue with next date
+            response = rate_limited_get("fitbit", _session(), url, user_key_for(uid, access_token), headers=headers, timeout=10)
+            response.raise_for_status()
+            
+            # Structure: {"activities-steps": [{"dateTime": "2025-01-01", "value": "12345"}]}
+            for entry in response.json().get("activities-steps", []):
+                entry_date = entry.get("dateTime")
+                if entry_date:
+                    steps_data[entry_date] = int(entry.get("value", 0))
+        
+        except requests.RequestException as e:
+            logger.error(f"Error fetching Fitbit steps for {chunk_start} to {chunk_end}: {e}")
+            
+            # Handle token expiry
+            if hasattr(e, 'response') and e.response is not None:
+                if e.response.status_code == 401:
+                    raise ValueError("Fitbit access token expired or invalid")
+            
+            raise ValueError(f"Failed to fetch Fitbit data: {str(e)}")
         
-        # Move to next day
-        from datetime import timedelta
-        current_date += timedelta(days=1)
+        chunk_start = chunk_end + timedelta(days=1)
     
+    logger.info(f"Fetched Fitbit steps for {len(steps_data)} days from {start_date} to {end_date}")
     return steps_data
 
+
+def fitbit_subscription_id(uid: str) -> str:
+    """Stable subscription id for a user (Fitbit limits ids to 50 characters)"""
+    return hashlib.sha1(uid.encode("utf-8")).hexdigest()[:32]
+
+
+def create_fitbit_subscription(access_token: str, subscription_id: str) -> Dict[str, Any]:
+    """
+    Subscribe to activity notifications for the token's user
+    
+    Fitbit then POSTs to our subscriber endpoint whenever the user's activity
+    data changes. Subscribing again with the same id is a no-op (409 from Fitbit
+    for an existing subscription is treated as success).
+    """
+    if not access_token:
+        raise ValueError("Access token required")
+    
+    url = f"{FITBIT_BASE_URL}/1/user/-/activities/apiSubscriptions/{subscription_id}.json"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Accept": "application/json",
+    }
+    
+    try:
+        response = _session().post(url, headers=headers, timeout=10)
+        if response.status_code == 409:
+            return {"subscription_id": subscription_id, "existing": True}
+        response.raise_for_status()
+        logger.info(f"Created Fitbit activity subscription {subscription_id}")
+        return {"subscription_id": subscription_id, **(response.json() or {})}
+    
+    except requests.RequestException as e:
+        logger.error(f"Error creating Fitbit subscription: {e}")
+        raise ValueError(f"Failed to create Fitbit subscription: {str(e)}")
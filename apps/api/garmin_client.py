@@ -8,8 +8,12 @@ import os
 import logging
 import requests
 from typing import Dict, Optional, Any
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import secrets
+from http_sessions import get_session
+from rate_limiter import rate_limited_get, RateLimitExceeded
+from circuit_breaker import CircuitOpenError
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +21,14 @@ logger = logging.getLogger(__name__)
 GARMIN_CLIENT_ID = os.getenv("GARMIN_CLIENT_ID", "")
 GARMIN_CLIENT_SECRET = os.getenv("GARMIN_CLIENT_SECRET", "")
 GARMIN_REDIRECT_URI = os.getenv("GARMIN_REDIRECT_URI", "http://localhost:8004/oauth/garmin/callback")
-GARMIN_BASE_URL = "https://connectapi.garmin.com"
+# Base URL can be overridden to point the client at a local stub server
+GARMIN_BASE_URL = os.getenv("GARMIN_BASE_URL", "https://connectapi.garmin.com")
+GARMIN_RANGE_CONCURRENCY = int(os.getenv("GARMIN_RANGE_CONCURRENCY", "4"))  # Parallel per-day fetches for ranges
+
+
+def _session() -> requests.Session:
+    """Shared keep-alive session for all Garmin API calls"""
+    return get_session("garmin")
 
 # Note: Garmin requires Consumer Key and Consumer Secret for OAuth 1.0a
 # For OAuth 2.0, use Garmin Health API (if available)
@@ -85,13 +96,14 @@ def refresh_garmin_token(refresh_token: str) -> Dict[str, Any]:
     pass
 
 
-def get_garmin_daily_steps(access_token: str, date: date) -> int:
+def get_garmin_daily_steps(access_token: str, date: date, uid: Optional[str] = None) -> int:
     """
     Fetch daily step count from Garmin Connect API
     
     Args:
         access_token: OAuth access token
         date: Date to fetch steps for
+        uid: User the token belongs to (Garmin limits are app-wide, kept for symmetry with Fitbit)
     
     Returns:
         Step count for the day
@@ -113,7 +125,7 @@ def get_garmin_daily_steps(access_token: str, date: date) -> int:
     }
     
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = rate_limited_get("garmin", _session(), url, uid, headers=headers, params=params, timeout=10)
         response.raise_for_status()
         
         data = response.json()
@@ -129,27 +141,33 @@ def get_garmin_daily_steps(access_token: str, date: date) -> int:
         raise ValueError(f"Failed to fetch Garmin data: {str(e)}")
 
 
-def get_garmin_steps_range(access_token: str, start_date: date, end_date: date) -> Dict[str, int]:
+def get_garmin_steps_range(access_token: str, start_date: date, end_date: date, uid: Optional[str] = None) -> Dict[str, int]:
     """
     Fetch step counts for a date range from Garmin
     
+    The daily summary endpoint has no multi-day variant, so days are fetched
+    concurrently (bounded by GARMIN_RANGE_CONCURRENCY) over the shared session.
+    
     Returns:
         Dictionary mapping date (ISO format) to step count
     """
+    if end_date < start_date:
+        return {}
+    
+    dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
     steps_data = {}
     
-    current_date = start_date
-    while current_date <= end_date:
-        try:
-            steps = get_garmin_daily_steps(access_token, current_date)
-            steps_data[current_date.isoformat()] = steps
-        except Exception as e:
-            logger.warning(f"Failed to fetch steps for {current_date}: {e}")
-            # Continue with next date
-        
-        # Move to next day
-        from datetime import timedelta
-        current_date += timedelta(days=1)
+    with ThreadPoolExecutor(max_workers=max(1, min(GARMIN_RANGE_CONCURRENCY, len(dates)))) as executor:
+        futures = {executor.submit(get_garmin_daily_steps, access_token, day, uid): day for day in dates}
+        for future, day in futures.items():
+            try:
+                steps_data[day.isoformat()] = future.result()
+            except (RateLimitExceeded, CircuitOpenError):
+                # Don't return a partial range, the whole sync is deferred instead
+                raise
+            except Exception as e:
+                logger.warning(f"Failed to fetch steps for {day}: {e}")
+                # Continue with next date
     
     return steps_data
 
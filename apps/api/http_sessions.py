@@ -0,0 +1,87 @@
+"""
+Pooled HTTP sessions for device provider APIs (Garmin, Fitbit)
+
+Each provider gets one shared requests.Session so TCP/TLS connections are kept
+alive and reused across fetch and token calls instead of paying a fresh
+handshake per request. Sessions are safe to share between the sync worker's
+threads as long as callers don't mutate session state (headers, cookies).
+"""
+
+import os
+import logging
+import threading
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Connection pool tuning
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))  # Max kept-alive connections per host
+# Retries of failed connection attempts only (see build_session)
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.5"))
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def build_session(pool_size: int = HTTP_POOL_SIZE, max_retries: int = HTTP_MAX_RETRIES) -> requests.Session:
+    """
+    Build a keep-alive session with a tuned connection pool and retry adapter
+
+    Only failed connection attempts are retried (the request never reached
+    the provider, e.g. a stale pooled connection). Read errors and 5xx
+    responses are not: each call then fails once, straight into the
+    provider's circuit breaker, and the task queue's backoff owns retrying.
+    Token POSTs are never retried because Fitbit refresh tokens are
+    single-use.
+    """
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def get_session(provider: str) -> requests.Session:
+    """Get the shared session for a provider, creating it on first use"""
+    session = _sessions.get(provider)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(provider)
+        if session is None:
+            session = build_session()
+            _sessions[provider] = session
+            logger.info(f"Created pooled HTTP session for {provider}")
+        return session
+
+
+def set_session(provider: str, session: Optional[requests.Session]) -> None:
+    """
+    Inject a session for a provider (e.g. in tests pointing at a stub server)
+
+    Passing None drops the current session; a fresh pooled one is built on next use.
+    """
+    with _sessions_lock:
+        previous = _sessions.pop(provider, None)
+        if session is not None:
+            _sessions[provider] = session
+    if previous is not None and previous is not session:
+        previous.close()
@@ -0,0 +1,240 @@
+"""
+SQL aggregation for large leaderboards
+
+The leaderboard functions in storage.py stream every daily_steps document in
+the date range into Python, which stops scaling at a few hundred thousand
+rows. For large scans they hand the aggregation to a SQL engine instead:
+per-(team, user) totals over a date range, joined to the competition's
+memberships, computed where the data lives.
+
+Two engines implement the same interface:
+- BigQueryLeaderboardEngine (production) reads daily_steps_curated, the
+  compacted one-row-per-(user_id, date) table, plus the fact_daily_steps
+  rows of the days compaction still revisits (rows written since the last
+  MERGE), taking max(steps) per (user_id, date) over both
+- SqliteLeaderboardEngine (local dev/tests) runs the same query shape on an
+  embedded SQLite database mirroring the in-memory step store
+
+get_leaderboard_engine() picks the engine; use_sql_leaderboard() applies
+the size threshold.
+"""
+
+import os
+import sqlite3
+import logging
+import threading
+from datetime import date as date_type, timedelta
+from typing import Dict, List, Optional, Tuple, Any
+
+from gcp_clients import bq
+from bq_compaction import CURATED_TABLE, FACT_TABLE, COMPACTION_LOOKBACK_DAYS
+
+logger = logging.getLogger(__name__)
+
+GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
+BQ_DATASET = os.getenv("BQ_DATASET", "stepsquad")
+# "auto" uses SQL above the threshold, "sql" always, "python" never
+LEADERBOARD_ENGINE = os.getenv("LEADERBOARD_ENGINE", "auto")
+# Step documents a leaderboard would have to stream before it switches to SQL
+LEADERBOARD_SQL_MIN_ROWS = int(os.getenv("LEADERBOARD_SQL_MIN_ROWS", "100000"))
+# How long a counted scan size is reused for the same date filters ("auto" only)
+LEADERBOARD_COUNT_TTL_SECONDS = int(os.getenv("LEADERBOARD_COUNT_TTL_SECONDS", "300"))
+# SQLite database backing the local engine (a file path keeps it across restarts)
+LEADERBOARD_SQLITE_PATH = os.getenv("LEADERBOARD_SQLITE_PATH", ":memory:")
+
+# (user_id, team_id) pairs; team_id is None for leaderboards without teams
+Members = List[Tuple[str, Optional[str]]]
+
+MIN_DATE = "0001-01-01"
+MAX_DATE = "9999-12-31"
+
+
+def date_bounds(date: Optional[str], start_date: Optional[str], end_date: Optional[str]) -> Tuple[str, str]:
+    """Leaderboard date filters as an inclusive (start, end) range"""
+    if date:
+        return date, date
+    return start_date or MIN_DATE, end_date or MAX_DATE
+
+
+def use_sql_leaderboard(scan_rows) -> bool:
+    """
+    Whether a leaderboard that would scan scan_rows step documents should use SQL
+
+    scan_rows may be a callable; it is only called in "auto" mode, so a fixed
+    engine never pays for counting.
+    """
+    if LEADERBOARD_ENGINE == "sql":
+        return True
+    if LEADERBOARD_ENGINE == "python":
+        return False
+    return (scan_rows() if callable(scan_rows) else scan_rows) >= LEADERBOARD_SQL_MIN_ROWS
+
+
+class BigQueryLeaderboardEngine:
+    """Leaderboard aggregation on BigQuery"""
+
+    name = "bigquery"
+
+    def __init__(self, client, dataset: str = BQ_DATASET):
+        self.client = client
+        self.dataset = dataset
+
+    def member_totals(
+        self,
+        members: Optional[Members],
+        date: Optional[str] = None,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Total steps per (team_id, user_id) in the date range
+
+        Args:
+            members: Restrict to these (user_id, team_id) memberships; None for all users
+
+        Returns:
+            Rows of {"team_id", "user_id", "steps"}
+        """
+        from google.cloud import bigquery
+
+        start, end = date_bounds(date, start_date, end_date)
+        params = [
+            bigquery.ScalarQueryParameter("start_date", "DATE", date_type.fromisoformat(start)),
+            bigquery.ScalarQueryParameter("end_date", "DATE", date_type.fromisoformat(end)),
+            # Older fact partitions are no longer re-compacted, the curated rows are final there
+            bigquery.ScalarQueryParameter("tail_start", "DATE", date_type.today() - timedelta(days=COMPACTION_LOOKBACK_DAYS)),
+        ]
+        member_filter = "AND user_id IN (SELECT user_id FROM UNNEST(@members))" if members is not None else ""
+        days = f"""
+            SELECT user_id, date, MAX(steps) AS steps
+            FROM (
+                SELECT user_id, date, steps
+                FROM `{self.dataset}.{CURATED_TABLE}`
+                WHERE date BETWEEN @start_date AND @end_date {member_filter}
+                UNION ALL
+                SELECT user_id, date, steps
+                FROM `{self.dataset}.{FACT_TABLE}`
+                WHERE date BETWEEN GREATEST(@start_date, @tail_start) AND @end_date {member_filter}
+            )
+            GROUP BY user_id, date
+        """
+        if members is None:
+            sql = f"""
+                WITH days AS ({days})
+                SELECT CAST(NULL AS STRING) AS team_id, user_id, SUM(steps) AS steps
+                FROM days
+                GROUP BY user_id
+            """
+        else:
+            if not members:
+                return []
+            sql = f"""
+                WITH days AS ({days})
+                SELECT m.team_id, d.user_id, SUM(d.steps) AS steps
+                FROM days AS d
+                JOIN UNNEST(@members) AS m ON m.user_id = d.user_id
+                GROUP BY m.team_id, d.user_id
+            """
+            params.append(bigquery.ArrayQueryParameter("members", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("user_id", "STRING", uid),
+                    bigquery.ScalarQueryParameter("team_id", "STRING", team_id),
+                )
+                for uid, team_id in members
+            ]))
+
+        job = self.client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=params))
+        return [{"team_id": row["team_id"], "user_id": row["user_id"], "steps": int(row["steps"] or 0)} for row in job.result()]
+
+
+class SqliteLeaderboardEngine:
+    """
+    Leaderboard aggregation on an embedded SQLite database
+
+    Stands in for BigQuery locally: the in-memory step store is mirrored into
+    a daily_steps table (see sync) and queried with the same shape of SQL.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = LEADERBOARD_SQLITE_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._synced_version: Optional[Tuple[int, int]] = None
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS daily_steps ("
+                "user_id TEXT NOT NULL, date TEXT NOT NULL, steps INTEGER NOT NULL, "
+                "PRIMARY KEY (user_id, date))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS daily_steps_date ON daily_steps (date)")
+            self._conn.execute("CREATE TEMP TABLE query_members (user_id TEXT NOT NULL, team_id TEXT)")
+
+    def sync(self, steps: Dict[Tuple[str, str], int], version: int):
+        """Mirror the in-memory step store; a no-op while it hasn't changed"""
+        key = (version, len(steps))
+        if key == self._synced_version:
+            return
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM daily_steps")
+            self._conn.executemany(
+                "INSERT INTO daily_steps (user_id, date, steps) VALUES (?, ?, ?)",
+                [(uid, day, int(value)) for (uid, day), value in steps.items()],
+            )
+        self._synced_version = key
+
+    def member_totals(
+        self,
+        members: Optional[Members],
+        date: Optional[str] = None,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Same contract as BigQueryLeaderboardEngine.member_totals"""
+        start, end = date_bounds(date, start_date, end_date)
+        days = (
+            "SELECT user_id, date, MAX(steps) AS steps FROM daily_steps "
+            "WHERE date BETWEEN ? AND ? GROUP BY user_id, date"
+        )
+        with self._lock:
+            if members is None:
+                sql = f"WITH days AS ({days}) SELECT NULL, user_id, SUM(steps) FROM days GROUP BY user_id"
+                cursor = self._conn.execute(sql, (start, end))
+            else:
+                if not members:
+                    return []
+                self._conn.execute("DELETE FROM query_members")
+                self._conn.executemany("INSERT INTO query_members (user_id, team_id) VALUES (?, ?)", members)
+                sql = (
+                    f"WITH days AS ({days}) "
+                    "SELECT m.team_id, d.user_id, SUM(d.steps) FROM days AS d "
+                    "JOIN query_members AS m ON m.user_id = d.user_id "
+                    "GROUP BY m.team_id, d.user_id"
+                )
+                cursor = self._conn.execute(sql, (start, end))
+            return [{"team_id": team_id, "user_id": uid, "steps": int(steps or 0)} for team_id, uid, steps in cursor.fetchall()]
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_leaderboard_engine():
+    """The process-wide engine: BigQuery when configured, otherwise local SQLite"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            if GCP_ENABLED and bq():
+                _engine = BigQueryLeaderboardEngine(bq())
+            else:
+                _engine = SqliteLeaderboardEngine()
+            logger.info(f"Leaderboard SQL engine: {_engine.name}")
+        return _engine
+
+
+def set_leaderboard_engine(engine) -> None:
+    """Replace the engine (tests); None re-detects on next use"""
+    global _engine
+    with _engine_lock:
+        _engine = engine
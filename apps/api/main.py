@@ -26,13 +26,14 @@ from pubsub_bus import publish_ingest
 from firebase_auth import verify_id_token, get_user_info_from_token
 from device_storage import (
     store_device_tokens, get_device_tokens, get_user_devices,
-    remove_device_tokens, update_device_sync_time
+    remove_device_tokens, update_device_sync_time, set_device_subscription
 )
 from garmin_client import (
     generate_state_token,
     build_garmin_oauth_url,
     exchange_garmin_code,
     get_garmin_daily_steps,
+    get_garmin_steps_range,
     refresh_garmin_token
 )
 from fitbit_client import (
@@ -40,11 +41,21 @@ from fitbit_client import (
     build_fitbit_oauth_url,
     exchange_fitbit_code,
     get_fitbit_daily_steps,
-    refresh_fitbit_token
+    get_fitbit_steps_range,
+    refresh_fitbit_token,
+    fitbit_subscription_id,
+    create_fitbit_subscription
 )
+from token_manager import ensure_fresh_tokens
+from rate_limiter import RateLimitExceeded, rate_limit_stats
+from circuit_breaker import CircuitOpenError
+from webhooks import create_webhook_router, FITBIT_SUBSCRIBER_VERIFY_CODE
+from rollups import get_daily_rollups, summarize_rollups
+from submission_bitmaps import record_submission_safely, record_submission_groups
 
 app = FastAPI(title="StepSquad API", version="0.5.0")
 init_clients()
+app.include_router(create_webhook_router())
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +69,8 @@ app.add_middleware(
 
 COMP_TZ = os.getenv("COMP_TZ", "Europe/Bucharest")
 GRACE_DAYS = int(os.getenv("GRACE_DAYS", "2"))
+# Longest start_date..end_date range a manual device sync accepts (same setting as the sync worker's catch-up)
+MAX_CATCHUP_DAYS = int(os.getenv("MAX_CATCHUP_DAYS", "31"))
 
 class StepIngest(BaseModel):
     comp_id: str                   # Competition ID (required)
@@ -364,6 +377,47 @@ def get_competition_detail(comp_id: str, current_user: User = Depends(get_curren
         raise HTTPException(status_code=404, detail="Competition not found")
     return competition
 
+@app.get("/competitions/{comp_id}/stats")
+def get_competition_stats(
+    comp_id: str,
+    start_date: str | None = None,
+    end_date: str | None = None,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Competition stats and daily trend from the daily rollups (ADMIN only)
+    
+    Query parameters:
+    - start_date / end_date: Limit to a date range (YYYY-MM-DD), default the whole competition
+    
+    Days the rollup job hasn't processed yet (today, normally) are not included.
+    """
+    if current_user.role != "ADMIN":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    competition = get_competition(comp_id)
+    if not competition:
+        raise HTTPException(status_code=404, detail="Competition not found")
+    
+    rollups = get_daily_rollups(
+        comp_id,
+        start_date or competition.get("start_date"),
+        end_date or competition.get("end_date"),
+    )
+    return {
+        "comp_id": comp_id,
+        "summary": summarize_rollups(rollups),
+        "trend": [
+            {
+                "date": rollup["date"],
+                "total_steps": rollup["total_steps"],
+                "active_submitters": rollup["active_submitters"],
+                "member_count": rollup["member_count"],
+            }
+            for rollup in rollups
+        ],
+    }
+
 @app.post("/ingest/steps")
 def ingest_steps(e: StepIngest, current_user: User = Depends(get_current_user)):
     """
@@ -434,6 +488,7 @@ def ingest_steps(e: StepIngest, current_user: User = Depends(get_current_user)):
     
     # Store the steps
     write_daily_steps(uid, e.date, e.steps)
+    record_submission_safely(e.comp_id, e.date, uid)
     
     # Publish to Pub/Sub for async processing
     try:
@@ -1244,6 +1299,16 @@ async def fitbit_callback(
         # Store tokens for user
         store_device_tokens(uid, "fitbit", tokens)
         
+        # Subscribe to activity notifications so changes are pushed to /webhooks/fitbit
+        if FITBIT_SUBSCRIBER_VERIFY_CODE:
+            try:
+                subscription_id = fitbit_subscription_id(uid)
+                create_fitbit_subscription(tokens["access_token"], subscription_id)
+                set_device_subscription(uid, "fitbit", subscription_id)
+            except Exception as e:
+                # Non-fatal: the nightly sync still covers this device
+                logging.warning(f"Failed to create Fitbit subscription for {uid}: {e}")
+        
         # Get user info for logging
         user = get_user(uid)
         email = user.get("email", "unknown") if user else "unknown"
@@ -1284,6 +1349,15 @@ async def list_devices(current_user: User = Depends(get_current_user)):
         raise HTTPException(status_code=500, detail="Failed to list devices")
 
 
+@app.get("/devices/rate-limits")
+def get_device_rate_limits(current_user: User = Depends(get_current_user)):
+    """Provider quota usage counters for this instance (ADMIN only)"""
+    if current_user.role != "ADMIN":
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    return {"rate_limits": rate_limit_stats()}
+
+
 @app.post("/devices/virtual/connect")
 async def connect_virtual_device(
     current_user: User = Depends(get_current_user)
@@ -1391,6 +1465,7 @@ async def sync_virtual_device(
                 
                 # Write steps for this competition (will overwrite if they exist)
                 write_daily_steps(current_user.uid, sync_date.isoformat(), steps)
+                record_submission_safely(comp_id, sync_date.isoformat(), current_user.uid)
                 
                 # Publish to Pub/Sub
                 try:
@@ -1460,12 +1535,16 @@ async def sync_virtual_device(
 async def sync_device(
     provider: str,
     date: Optional[str] = Query(None),  # Optional: sync specific date (YYYY-MM-DD)
+    start_date: Optional[str] = Query(None),  # Optional: first day of a catch-up range (YYYY-MM-DD)
+    end_date: Optional[str] = Query(None),  # Optional: last day of a catch-up range (defaults to today)
     current_user: User = Depends(get_current_user)
 ):
     """
     Manually trigger device sync for a specific provider
     
-    Syncs steps from the linked device for today or specified date
+    Syncs steps from the linked device for today, a specified date, or a
+    start_date/end_date range. Ranges are fetched with one range request
+    (Fitbit time series) instead of one call per day.
     """
     if provider not in ["garmin", "fitbit"]:
         raise HTTPException(status_code=400, detail=f"Invalid provider: {provider}. Supported: garmin, fitbit")
@@ -1483,74 +1562,37 @@ async def sync_device(
         if not access_token:
             raise HTTPException(status_code=400, detail=f"{provider.capitalize()} access token not found")
         
-        # Check if token is expired and refresh if needed
-        expires_at = tokens.get("expires_at")
-        if expires_at and datetime.utcnow().timestamp() >= expires_at:
-            logger.info(f"Refreshing {provider} token for user {current_user.uid}")
-            try:
-                if provider == "fitbit" and tokens.get("refresh_token"):
-                    new_tokens = refresh_fitbit_token(tokens.get("refresh_token"))
-                    # Update stored tokens
-                    store_device_tokens(current_user.uid, provider, new_tokens)
-                    access_token = new_tokens.get("access_token")
-                    tokens = new_tokens
-                elif provider == "garmin":
-                    # Garmin OAuth 1.0a doesn't have refresh tokens
-                    raise HTTPException(
-                        status_code=401,
-                        detail="Garmin token expired, re-authentication required"
-                    )
-                else:
-                    raise HTTPException(
-                        status_code=401,
-                        detail=f"{provider.capitalize()} access token expired and no refresh token available"
-                    )
-            except Exception as e:
-                logger.error(f"Failed to refresh {provider} token: {e}")
-                raise HTTPException(
-                    status_code=401,
-                    detail=f"Token refresh failed: {str(e)}. Please reconnect your device."
-                )
-        
-        # Determine date to sync
-        if date:
-            try:
-                sync_date = datetime.strptime(date, "%Y-%m-%d").date()
-            except ValueError:
-                raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
-        else:
-            sync_date = datetime.now().date()
+        # Refresh the token if it is about to expire (no-op when the cron already refreshed it)
+        try:
+            tokens = ensure_fresh_tokens(current_user.uid, provider, device_data=device_data)
+            access_token = tokens.get("access_token")
+        except Exception as e:
+            logger.error(f"Failed to refresh {provider} token: {e}")
+            raise HTTPException(
+                status_code=401,
+                detail=f"Token refresh failed: {str(e)}. Please reconnect your device."
+            )
         
-        # Fetch steps from device API
+        # Determine date(s) to sync
         try:
-            if provider == "garmin":
-                steps = get_garmin_daily_steps(access_token, sync_date)
-            elif provider == "fitbit":
-                steps = get_fitbit_daily_steps(access_token, sync_date)
-            else:
-                raise HTTPException(status_code=400, detail=f"Unknown provider: {provider}")
-        except ValueError as e:
-            # Handle token expiration error from Fitbit API
-            if provider == "fitbit" and "expired" in str(e).lower() and tokens.get("refresh_token"):
-                logger.info(f"Token expired during API call, refreshing for user {current_user.uid}")
-                try:
-                    new_tokens = refresh_fitbit_token(tokens.get("refresh_token"))
-                    # Update stored tokens
-                    store_device_tokens(current_user.uid, provider, new_tokens)
-                    access_token = new_tokens.get("access_token")
-                    # Retry with new token
-                    steps = get_fitbit_daily_steps(access_token, sync_date)
-                except Exception as refresh_error:
-                    logger.error(f"Failed to refresh token after API error: {refresh_error}")
-                    raise HTTPException(
-                        status_code=401,
-                        detail=f"Token expired and refresh failed: {str(refresh_error)}. Please reconnect your device."
-                    )
+            if start_date:
+                sync_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+                range_end = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else datetime.now().date()
+            elif date:
+                sync_date = datetime.strptime(date, "%Y-%m-%d").date()
+                range_end = sync_date
             else:
-                # Re-raise other ValueError exceptions
-                raise HTTPException(status_code=400, detail=str(e))
+                sync_date = datetime.now().date()
+                range_end = sync_date
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
         
-        # Find user's active competitions and sync steps to each
+        if range_end < sync_date:
+            raise HTTPException(status_code=400, detail="end_date must be on or after start_date")
+        if (range_end - sync_date).days + 1 > MAX_CATCHUP_DAYS:
+            raise HTTPException(status_code=400, detail=f"Date range too long. Sync at most {MAX_CATCHUP_DAYS} days at a time")
+        
+        # Find user's active competitions
         # Get all competitions and check if user is in a team
         all_competitions = get_competitions()
         user_competitions = []
@@ -1568,70 +1610,155 @@ async def sync_device(
             if not is_user_in_team_for_competition(current_user.uid, comp_id):
                 continue
             
-            # Check if date is within competition range (with grace days)
             try:
                 comp_start = datetime.strptime(competition.get("start_date"), "%Y-%m-%d").date()
                 comp_end = datetime.strptime(competition.get("end_date"), "%Y-%m-%d").date()
                 grace_end = comp_end + timedelta(days=GRACE_DAYS)
-                
-                if comp_start <= sync_date <= grace_end:
-                    user_competitions.append(comp_id)
+                user_competitions.append((comp_id, comp_start, grace_end))
             except (ValueError, KeyError) as e:
                 logging.warning(f"Error checking date range for competition {comp_id}: {e}")
                 continue
         
-        # Submit steps to each active competition
-        submissions = []
-        for comp_id in user_competitions:
+        # The catch-up resumes from last_sync, so it only moves for ranges that reach yesterday
+        advances_sync_time = range_end >= datetime.now().date() - timedelta(days=1)
+        
+        # Only fetch the part of a range that some competition (with grace days) can use
+        fetch_needed = True
+        if start_date:
+            windows = [(start, grace_end) for _, start, grace_end in user_competitions if start <= range_end and sync_date <= grace_end]
+            if windows:
+                sync_date = max(sync_date, min(start for start, _ in windows))
+                range_end = min(range_end, max(grace_end for _, grace_end in windows))
+            else:
+                fetch_needed = False
+        
+        def fetch_steps(token: str) -> dict:
+            """Fetch steps for the requested day or range, keyed by ISO date"""
+            if provider == "garmin":
+                if sync_date == range_end:
+                    return {sync_date.isoformat(): get_garmin_daily_steps(token, sync_date, current_user.uid)}
+                return get_garmin_steps_range(token, sync_date, range_end, current_user.uid)
+            elif provider == "fitbit":
+                if sync_date == range_end:
+                    return {sync_date.isoformat(): get_fitbit_daily_steps(token, sync_date, current_user.uid)}
+                return get_fitbit_steps_range(token, sync_date, range_end, current_user.uid)
+            raise HTTPException(status_code=400, detail=f"Unknown provider: {provider}")
+        
+        def fetch_steps_or_defer(token: str) -> dict:
+            """fetch_steps, with rate limits and open circuits mapped to 429/503 + Retry-After"""
             try:
-                # Use existing ingest endpoint logic
-                # Check idempotency
-                idempotency_key = f"{provider}_{sync_date.isoformat()}_{current_user.uid}"
-                if not check_idempotency(idempotency_key, current_user.uid, sync_date.isoformat()):
-                    # Write steps for this competition
-                    write_daily_steps(current_user.uid, sync_date.isoformat(), steps)
-                    
-                    # Publish to Pub/Sub
-                    try:
-                        publish_ingest({
-                            "user_id": current_user.uid,
+                return fetch_steps(token) if fetch_needed else {}
+            except RateLimitExceeded as e:
+                raise HTTPException(
+                    status_code=429,
+                    detail=str(e),
+                    headers={"Retry-After": str(int(e.retry_after + 0.999))}
+                )
+            except CircuitOpenError as e:
+                raise HTTPException(
+                    status_code=503,
+                    detail=str(e),
+                    headers={"Retry-After": str(int(e.retry_after + 0.999))}
+                )
+        
+        # Fetch steps from device API
+        try:
+            steps_by_date = fetch_steps_or_defer(access_token)
+        except ValueError as e:
+            # Handle token expiration error from Fitbit API
+            if provider == "fitbit" and "expired" in str(e).lower() and tokens.get("refresh_token"):
+                logger.info(f"Token expired during API call, refreshing for user {current_user.uid}")
+                try:
+                    new_tokens = ensure_fresh_tokens(current_user.uid, provider, rejected_access_token=access_token)
+                    access_token = new_tokens.get("access_token")
+                except Exception as refresh_error:
+                    logger.error(f"Failed to refresh token after API error: {refresh_error}")
+                    raise HTTPException(
+                        status_code=401,
+                        detail=f"Token expired and refresh failed: {str(refresh_error)}. Please reconnect your device."
+                    )
+                # Retry with new token (outside the refresh handler, so 429/503 still apply)
+                try:
+                    steps_by_date = fetch_steps_or_defer(access_token)
+                except ValueError as retry_error:
+                    logger.error(f"Retry with refreshed token failed: {retry_error}")
+                    raise HTTPException(
+                        status_code=401,
+                        detail=f"Token expired and refresh failed: {str(retry_error)}. Please reconnect your device."
+                    )
+            else:
+                # Re-raise other ValueError exceptions
+                raise HTTPException(status_code=400, detail=str(e))
+        
+        steps = sum(steps_by_date.values())
+        
+        # Submit each day's steps to every competition whose range (with grace days) covers it
+        submissions = []
+        for day_str, day_steps in sorted(steps_by_date.items()):
+            day = datetime.strptime(day_str, "%Y-%m-%d").date()
+            for comp_id, comp_start, grace_end in user_competitions:
+                if not (comp_start <= day <= grace_end):
+                    continue
+                try:
+                    # Use existing ingest endpoint logic
+                    # Check idempotency
+                    idempotency_key = f"{provider}_{day_str}_{current_user.uid}"
+                    if not check_idempotency(idempotency_key, current_user.uid, day_str):
+                        # Write steps for this competition
+                        write_daily_steps(current_user.uid, day_str, day_steps)
+                        
+                        # Publish to Pub/Sub
+                        try:
+                            publish_ingest({
+                                "user_id": current_user.uid,
+                                "comp_id": comp_id,
+                                "date": day_str,
+                                "steps": day_steps,
+                                "provider": provider,
+                                "tz": COMP_TZ,
+                                "source_ts": datetime.utcnow().isoformat(),
+                                "idempotency_key": idempotency_key,
+                            })
+                        except Exception as pubsub_error:
+                            logging.warning(f"Failed to publish step ingestion event to Pub/Sub: {pubsub_error}")
+                        
+                        submissions.append({
                             "comp_id": comp_id,
-                            "date": sync_date.isoformat(),
-                            "steps": steps,
-                            "provider": provider,
-                            "tz": COMP_TZ,
-                            "source_ts": datetime.utcnow().isoformat(),
-                            "idempotency_key": idempotency_key,
+                            "date": day_str,
+                            "status": "submitted",
+                            "steps": day_steps
                         })
-                    except Exception as pubsub_error:
-                        logging.warning(f"Failed to publish step ingestion event to Pub/Sub: {pubsub_error}")
-                    
+                except Exception as e:
+                    logging.warning(f"Failed to submit steps to competition {comp_id}: {e}")
                     submissions.append({
                         "comp_id": comp_id,
-                        "status": "submitted",
-                        "steps": steps
+                        "date": day_str,
+                        "status": "error",
+                        "error": str(e)
                     })
-            except Exception as e:
-                logging.warning(f"Failed to submit steps to competition {comp_id}: {e}")
-                submissions.append({
-                    "comp_id": comp_id,
-                    "status": "error",
-                    "error": str(e)
-                })
         
-        # Update sync time
-        update_device_sync_time(current_user.uid, provider)
+        # One submission bitmap write per competition day
+        record_submission_groups(
+            (s["comp_id"], s["date"], current_user.uid) for s in submissions if s.get("status") == "submitted"
+        )
+        
+        # Update sync time (a past range would make the catch-up skip the days after it)
+        if advances_sync_time:
+            update_device_sync_time(current_user.uid, provider)
         
-        logging.info(f"User {current_user.email} synced {steps} steps from {provider} for {sync_date}, submitted to {len(submissions)} competitions")
+        logging.info(f"User {current_user.email} synced {steps} steps from {provider} for {sync_date} to {range_end}, submitted to {len(submissions)} competitions")
         
+        submitted_count = len([s for s in submissions if s.get("status") == "submitted"])
         return {
             "status": "success",
             "provider": provider,
             "date": sync_date.isoformat(),
+            "end_date": range_end.isoformat(),
             "steps": steps,
+            "days": steps_by_date,
             "competitions": submissions,
-            "submitted_count": len([s for s in submissions if s.get("status") == "submitted"]),
-            "message": f"Synced {steps} steps from {provider} and submitted to {len([s for s in submissions if s.get('status') == 'submitted'])} competition(s)"
+            "submitted_count": submitted_count,
+            "message": f"Synced {steps} steps from {provider} and submitted to {submitted_count} competition(s)"
         }
     
     except ValueError as e:
@@ -10,3 +10,21 @@ def publish_ingest(event: dict):
     data = json.dumps(event).encode("utf-8")
     future = publisher().publish(topic_path, data=data)
     return {"message_id": future.result()}
+def publish_ingest_batch(events: list):
+    if not GCP_ENABLED or not publisher():
+        return {"local": True, "count": len(events)}
+    topic_path = publisher().topic_path(PROJECT, PUBSUB_TOPIC_INGEST)
+    # Publish everything first, then wait, so the client batches the messages
+    futures = [publisher().publish(topic_path, data=json.dumps(event).encode("utf-8")) for event in events]
+    return {"message_ids": [future.result() for future in futures]}
+PUBSUB_TOPIC_DEVICE_SYNC = os.getenv("PUBSUB_TOPIC_DEVICE_SYNC", "device.sync")
+def publish_device_sync_tasks(tasks: list):
+    if not GCP_ENABLED or not publisher():
+        return {"local": True, "count": len(tasks)}
+    topic_path = publisher().topic_path(PROJECT, PUBSUB_TOPIC_DEVICE_SYNC)
+    # Attributes let the push handler log/route without decoding the payload
+    futures = [
+        publisher().publish(topic_path, data=json.dumps(task).encode("utf-8"), uid=task["uid"], provider=task["provider"])
+        for task in tasks
+    ]
+    return {"message_ids": [future.result() for future in futures]}
@@ -0,0 +1,298 @@
+"""
+Provider-aware rate limiting for device API calls
+
+Every Fitbit/Garmin data request takes a token from a per-provider bucket and,
+for Fitbit, from a per-user bucket sized to Fitbit's hourly per-user quota.
+The API's manual sync and the sync worker share these buckets through this
+module. Responses feed back into the buckets: Fitbit-Rate-Limit-* headers clamp
+a user's bucket to what Fitbit says is left, and a 429 blocks the bucket until
+Retry-After has passed. Short waits are absorbed here; anything longer raises
+RateLimitExceeded so the caller can defer the sync instead of burning quota.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Dict, Optional, Any, Tuple
+
+import requests
+
+from circuit_breaker import get_breaker
+
+logger = logging.getLogger(__name__)
+
+# Fitbit allows 150 requests per user per hour
+FITBIT_USER_REQUESTS_PER_HOUR = int(os.getenv("FITBIT_USER_REQUESTS_PER_HOUR", "150"))
+# App-wide request rates per provider (sustained per second, burst)
+PROVIDER_RATE_LIMITS = {
+    "fitbit": (float(os.getenv("FITBIT_REQUESTS_PER_SECOND", "20")), int(os.getenv("FITBIT_REQUEST_BURST", "40"))),
+    "garmin": (float(os.getenv("GARMIN_REQUESTS_PER_SECOND", "10")), int(os.getenv("GARMIN_REQUEST_BURST", "20"))),
+}
+# Longest a caller is made to wait for quota before the request is deferred
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "10"))
+# Retries after a 429 whose Retry-After fits in the wait budget
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "1"))
+
+
+class RateLimitExceeded(ValueError):
+    """Provider quota is exhausted; retry after retry_after seconds"""
+
+    def __init__(self, provider: str, retry_after: float):
+        self.provider = provider
+        self.retry_after = retry_after
+        super().__init__(f"{provider.capitalize()} rate limit reached, retry after {int(retry_after + 0.999)}s")
+
+
+class TokenBucket:
+    """Thread-safe token bucket that hands out reservations instead of blocking"""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """
+        Reserve one token
+
+        Returns:
+            Seconds to wait before using the token, or None (nothing reserved)
+            if that would exceed max_wait
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.refill_per_second)
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def refund(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def wait_time(self) -> float:
+        """Seconds until a token would be available"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.refill_per_second)
+            return wait
+
+    def block_for(self, seconds: float):
+        """Hand out nothing until seconds from now (provider said so)"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def clamp(self, remaining: int, reset_seconds: Optional[float]):
+        """Align the bucket with the provider's own count of remaining requests"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, float(remaining))
+        if remaining <= 0 and reset_seconds:
+            self.block_for(reset_seconds)
+
+
+_provider_buckets: Dict[str, TokenBucket] = {}
+_user_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+_buckets_lock = threading.Lock()
+_stats: Dict[str, Dict[str, Any]] = {}
+_stats_lock = threading.Lock()
+
+
+def _provider_bucket(provider: str) -> Optional[TokenBucket]:
+    limits = PROVIDER_RATE_LIMITS.get(provider)
+    if not limits:
+        return None
+    with _buckets_lock:
+        bucket = _provider_buckets.get(provider)
+        if bucket is None:
+            rate, burst = limits
+            bucket = TokenBucket(burst, rate)
+            _provider_buckets[provider] = bucket
+        return bucket
+
+
+def _user_bucket(provider: str, user_key: Optional[str]) -> Optional[TokenBucket]:
+    # Only Fitbit has per-user quotas
+    if provider != "fitbit" or not user_key:
+        return None
+    key = (provider, user_key)
+    with _buckets_lock:
+        bucket = _user_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(FITBIT_USER_REQUESTS_PER_HOUR, FITBIT_USER_REQUESTS_PER_HOUR / 3600.0)
+            _user_buckets[key] = bucket
+        return bucket
+
+
+def _count(provider: str, counter: str, amount: int = 1):
+    with _stats_lock:
+        stats = _stats.setdefault(provider, {"requests": 0, "delayed": 0, "deferred": 0, "throttled": 0})
+        stats[counter] = stats.get(counter, 0) + amount
+
+
+def user_key_for(uid: Optional[str], access_token: Optional[str]) -> Optional[str]:
+    """Per-user bucket key; falls back to a digest of the access token if the uid isn't known"""
+    if uid:
+        return uid
+    if access_token:
+        return "token:" + hashlib.sha256(access_token.encode("utf-8")).hexdigest()[:16]
+    return None
+
+
+def acquire(provider: str, user_key: Optional[str] = None, max_wait: float = RATE_LIMIT_MAX_WAIT_SECONDS) -> float:
+    """
+    Take a request slot from the provider and user buckets, sleeping if needed
+
+    Returns:
+        Seconds spent waiting
+
+    Raises:
+        RateLimitExceeded: If a slot won't be free within max_wait
+    """
+    buckets = [b for b in (_user_bucket(provider, user_key), _provider_bucket(provider)) if b is not None]
+
+    waits = []
+    for i, bucket in enumerate(buckets):
+        wait = bucket.reserve(max_wait)
+        if wait is None:
+            # Give back what we already took so the other bucket isn't drained
+            for taken in buckets[:i]:
+                taken.refund()
+            _count(provider, "deferred")
+            raise RateLimitExceeded(provider, bucket.wait_time())
+        waits.append(wait)
+
+    wait = max(waits, default=0.0)
+    if wait > 0:
+        _count(provider, "delayed")
+        time.sleep(wait)
+    _count(provider, "requests")
+    return wait
+
+
+def parse_retry_after(response: requests.Response) -> Optional[float]:
+    """Seconds to wait according to Retry-After (delta or HTTP date) or Fitbit-Rate-Limit-Reset"""
+    value = response.headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+                return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+
+    reset = response.headers.get("Fitbit-Rate-Limit-Reset")
+    if reset:
+        try:
+            return max(0.0, float(reset))
+        except ValueError:
+            pass
+    return None
+
+
+def record_response(provider: str, user_key: Optional[str], response: requests.Response) -> None:
+    """Feed quota headers and 429s from a provider response back into the buckets"""
+    user_bucket = _user_bucket(provider, user_key)
+
+    remaining = response.headers.get("Fitbit-Rate-Limit-Remaining")
+    if user_bucket is not None and remaining is not None:
+        try:
+            user_bucket.clamp(int(remaining), parse_retry_after(response))
+        except ValueError:
+            pass
+
+    if response.status_code == 429:
+        _count(provider, "throttled")
+        retry_after = parse_retry_after(response) or 60.0
+        # A 429 with per-user headers is a user quota, otherwise assume the app limit
+        bucket = user_bucket if (user_bucket is not None and remaining is not None) else _provider_bucket(provider)
+        if bucket is not None:
+            bucket.block_for(retry_after)
+        logger.warning(f"{provider.capitalize()} returned 429, backing off {retry_after:.0f}s")
+
+
+def rate_limited_get(
+    provider: str,
+    session: requests.Session,
+    url: str,
+    user_key: Optional[str] = None,
+    **kwargs
+) -> requests.Response:
+    """
+    GET through the provider's circuit breaker and rate limiter
+
+    Fails fast while the provider's breaker is open, otherwise waits for
+    quota, records the response's quota headers and retries a 429 whose
+    Retry-After fits the wait budget.
+
+    Raises:
+        CircuitOpenError: If the provider's breaker is open
+        RateLimitExceeded: If quota won't be available within the wait budget
+    """
+    breaker = get_breaker(provider)
+    attempt = 0
+    while True:
+        # Don't spend quota on a call the breaker would reject
+        breaker.check()
+        acquire(provider, user_key)
+        response = breaker.call(session.get, url, **kwargs)
+        record_response(provider, user_key, response)
+
+        if response.status_code != 429:
+            return response
+
+        retry_after = parse_retry_after(response) or 60.0
+        if attempt >= RATE_LIMIT_MAX_RETRIES or retry_after > RATE_LIMIT_MAX_WAIT_SECONDS:
+            raise RateLimitExceeded(provider, retry_after)
+        attempt += 1
+
+
+def rate_limit_stats() -> Dict[str, Any]:
+    """Quota usage counters per provider"""
+    with _stats_lock:
+        stats = {provider: dict(counters) for provider, counters in _stats.items()}
+
+    for provider in PROVIDER_RATE_LIMITS:
+        provider_stats = stats.setdefault(provider, {"requests": 0, "delayed": 0, "deferred": 0, "throttled": 0})
+        bucket = _provider_bucket(provider)
+        provider_stats["available"] = round(max(0.0, bucket.tokens), 1) if bucket else None
+
+    with _buckets_lock:
+        user_buckets = list(_user_buckets.items())
+    now = time.monotonic()
+    for (provider, _), bucket in user_buckets:
+        provider_stats = stats[provider]
+        provider_stats["users_tracked"] = provider_stats.get("users_tracked", 0) + 1
+        if bucket.blocked_until > now or bucket.tokens < 1:
+            provider_stats["users_exhausted"] = provider_stats.get("users_exhausted", 0) + 1
+
+    return stats
+
+
+def reset_rate_limits() -> None:
+    """Drop all buckets and counters (tests, config reloads)"""
+    with _buckets_lock:
+        _provider_buckets.clear()
+        _user_buckets.clear()
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,253 @@
+"""
+Arrow read-model export of competitions
+
+Writes a competition's users, memberships and daily steps as Arrow IPC files
+under READ_MODEL_PATH (a local directory or a gs:// bucket prefix). Arrow IPC
+rather than Parquet because readers memory-map the files and use the columns
+in place without decoding (apps/agents/read_model.py).
+
+Layout per competition:
+
+    {READ_MODEL_PATH}/{comp_id}/CURRENT               manifest of the latest version
+    {READ_MODEL_PATH}/{comp_id}/v000003/manifest.json
+    {READ_MODEL_PATH}/{comp_id}/v000003/users.arrow        user_id, email, display_name
+    {READ_MODEL_PATH}/{comp_id}/v000003/memberships.arrow  team_id, team_name, user_id
+    {READ_MODEL_PATH}/{comp_id}/v000003/steps-000002.arrow user_id, date, steps
+
+Exports are incremental: a new version re-exports only the days from
+READ_MODEL_RECOMPUTE_DAYS before the previous export onward, as a new steps
+part, and references the older parts of earlier versions (a change in
+membership triggers a full export). Files are never
+modified after they are written and CURRENT is replaced last, so a reader that
+follows CURRENT always sees one consistent snapshot.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Any, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.fs as pafs
+    import pyarrow.ipc as ipc
+except ImportError:
+    pa = None
+
+from storage import get_competition, get_teams, get_user, get_steps_between
+
+logger = logging.getLogger(__name__)
+
+READ_MODEL_PATH = os.getenv("READ_MODEL_PATH", "")
+# Days before the last export that are exported again (late submissions, grace period)
+READ_MODEL_RECOMPUTE_DAYS = int(os.getenv("READ_MODEL_RECOMPUTE_DAYS", str(int(os.getenv("GRACE_DAYS", "2")) + 1)))
+# Steps parts are merged into one once a snapshot has more than this many
+READ_MODEL_MAX_PARTS = int(os.getenv("READ_MODEL_MAX_PARTS", "8"))
+# Versions kept (older ones are deleted unless a kept version still uses their files)
+READ_MODEL_KEEP_VERSIONS = int(os.getenv("READ_MODEL_KEEP_VERSIONS", "3"))
+
+USERS_SCHEMA = None
+MEMBERSHIPS_SCHEMA = None
+STEPS_SCHEMA = None
+if pa is not None:
+    USERS_SCHEMA = pa.schema([("user_id", pa.string()), ("email", pa.string()), ("display_name", pa.string())])
+    MEMBERSHIPS_SCHEMA = pa.schema([("team_id", pa.string()), ("team_name", pa.string()), ("user_id", pa.string())])
+    STEPS_SCHEMA = pa.schema([("user_id", pa.string()), ("date", pa.date32()), ("steps", pa.int64())])
+
+
+def _filesystem(root: str) -> Tuple[Any, str]:
+    if "://" in root:
+        return pafs.FileSystem.from_uri(root)
+    return pafs.LocalFileSystem(), os.path.abspath(root)
+
+
+def _write_table(filesystem, path: str, table) -> None:
+    with filesystem.open_output_stream(path) as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _read_table(filesystem, path: str):
+    with filesystem.open_input_file(path) as source:
+        return ipc.open_file(source).read_all()
+
+
+def _read_json(filesystem, path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with filesystem.open_input_stream(path) as source:
+            return json.loads(source.read().decode("utf-8"))
+    except (FileNotFoundError, OSError):
+        return None
+
+
+def _write_json(filesystem, path: str, data: Dict[str, Any]) -> None:
+    with filesystem.open_output_stream(path) as sink:
+        sink.write(json.dumps(data, indent=2).encode("utf-8"))
+
+
+def _steps_table(rows: List[Dict[str, Any]]):
+    rows = sorted(rows, key=lambda r: (r["date"], r["user_id"]))
+    return pa.table({
+        "user_id": [r["user_id"] for r in rows],
+        "date": [date.fromisoformat(r["date"]) for r in rows],
+        "steps": [int(r["steps"]) for r in rows],
+    }, schema=STEPS_SCHEMA)
+
+
+def _rows_of(table) -> List[Dict[str, Any]]:
+    return [
+        {"user_id": uid, "date": day.isoformat(), "steps": steps}
+        for uid, day, steps in zip(table.column("user_id").to_pylist(), table.column("date").to_pylist(), table.column("steps").to_pylist())
+    ]
+
+
+def export_competition(comp_id: str, through: Optional[date] = None, full: bool = False, root: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Export a new read-model version of one competition
+
+    Args:
+        comp_id: Competition to export
+        through: Last day to export (default yesterday, capped at the competition end)
+        full: Re-export every day instead of appending to the previous version
+        root: Override READ_MODEL_PATH
+
+    Returns:
+        The new version's manifest
+
+    Raises:
+        RuntimeError: If pyarrow or READ_MODEL_PATH is missing
+        ValueError: If the competition doesn't exist
+    """
+    root = root or READ_MODEL_PATH
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    if not root:
+        raise RuntimeError("READ_MODEL_PATH is not configured")
+
+    competition = get_competition(comp_id)
+    if not competition:
+        raise ValueError(f"Competition {comp_id} not found")
+
+    filesystem, base = _filesystem(root)
+    comp_dir = f"{base}/{comp_id}"
+    current = _read_json(filesystem, f"{comp_dir}/CURRENT")
+    previous = None if full else current
+    version = (current or {}).get("version", 0) + 1
+    version_name = f"v{version:06d}"
+    version_dir = f"{comp_dir}/{version_name}"
+    filesystem.create_dir(version_dir, recursive=True)
+
+    comp_start = date.fromisoformat(str(competition["start_date"]).split("T")[0])
+    comp_end = date.fromisoformat(str(competition["end_date"]).split("T")[0])
+    through = min(through or datetime.now().date() - timedelta(days=1), comp_end)
+
+    # Memberships and users are small, rewritten in full
+    teams = get_teams(comp_id=comp_id)
+    memberships = [(team.get("team_id"), team.get("name"), uid) for team in teams for uid in dict.fromkeys(team.get("members", []))]
+    members = {uid for _, _, uid in memberships}
+    members_digest = hashlib.sha1("\n".join(sorted(members)).encode("utf-8")).hexdigest()
+    if previous and previous.get("members_digest") != members_digest:
+        # Earlier parts only hold the old members' steps
+        previous = None
+    _write_table(filesystem, f"{version_dir}/memberships.arrow", pa.table({
+        "team_id": [m[0] for m in memberships],
+        "team_name": [m[1] for m in memberships],
+        "user_id": [m[2] for m in memberships],
+    }, schema=MEMBERSHIPS_SCHEMA))
+    users = [(uid, get_user(uid) or {}) for uid in sorted(members)]
+    _write_table(filesystem, f"{version_dir}/users.arrow", pa.table({
+        "user_id": [uid for uid, _ in users],
+        "email": [user.get("email", uid) for uid, user in users],
+        "display_name": [user.get("display_name") for _, user in users],
+    }, schema=USERS_SCHEMA))
+
+    # Steps: keep earlier parts, re-export from the recompute window onward
+    export_from = comp_start
+    parts: List[Dict[str, Any]] = []
+    if previous and previous.get("through"):
+        last = date.fromisoformat(previous["through"])
+        export_from = max(comp_start, last - timedelta(days=READ_MODEL_RECOMPUTE_DAYS - 1))
+        for part in previous.get("steps_parts", []):
+            if part["end"] < export_from.isoformat():
+                parts.append(part)
+            elif part["start"] < export_from.isoformat():
+                # Keep the part's days before the window, the rest is re-exported
+                kept = [r for r in _rows_of(_read_table(filesystem, f"{comp_dir}/{part['path']}")) if r["date"] < export_from.isoformat()]
+                if not kept:
+                    continue
+                path = f"{version_name}/steps-{len(parts):06d}.arrow"
+                _write_table(filesystem, f"{comp_dir}/{path}", _steps_table(kept))
+                parts.append({"path": path, "start": part["start"], "end": (export_from - timedelta(days=1)).isoformat(), "rows": len(kept)})
+
+    if export_from <= through:
+        new_rows = [r for r in get_steps_between(export_from.isoformat(), through.isoformat()) if r["user_id"] in members]
+        path = f"{version_name}/steps-{len(parts):06d}.arrow"
+        _write_table(filesystem, f"{comp_dir}/{path}", _steps_table(new_rows))
+        parts.append({"path": path, "start": export_from.isoformat(), "end": through.isoformat(), "rows": len(new_rows)})
+
+    if len(parts) > READ_MODEL_MAX_PARTS:
+        merged = [r for part in parts for r in _rows_of(_read_table(filesystem, f"{comp_dir}/{part['path']}"))]
+        path = f"{version_name}/steps-merged.arrow"
+        _write_table(filesystem, f"{comp_dir}/{path}", _steps_table(merged))
+        parts = [{"path": path, "start": parts[0]["start"], "end": parts[-1]["end"], "rows": len(merged)}]
+
+    manifest = {
+        "comp_id": comp_id,
+        "version": version,
+        "through": through.isoformat() if through >= comp_start else None,
+        "users": f"{version_name}/users.arrow",
+        "memberships": f"{version_name}/memberships.arrow",
+        "steps_parts": parts,
+        "members_digest": members_digest,
+        "created_at": datetime.utcnow().isoformat(),
+    }
+    _write_json(filesystem, f"{version_dir}/manifest.json", manifest)
+    # Publishing the snapshot: CURRENT is replaced last
+    _write_json(filesystem, f"{comp_dir}/CURRENT.tmp", manifest)
+    filesystem.move(f"{comp_dir}/CURRENT.tmp", f"{comp_dir}/CURRENT")
+
+    _prune_versions(filesystem, comp_dir, version)
+    logger.info(f"Exported read model {comp_id} {version_name}: {sum(p['rows'] for p in parts)} step rows in {len(parts)} parts")
+    return manifest
+
+
+def _prune_versions(filesystem, comp_dir: str, current_version: int) -> None:
+    """Delete versions older than READ_MODEL_KEEP_VERSIONS whose files no kept version uses"""
+    kept = range(max(1, current_version - READ_MODEL_KEEP_VERSIONS + 1), current_version + 1)
+    in_use = set()
+    for version in kept:
+        manifest = _read_json(filesystem, f"{comp_dir}/v{version:06d}/manifest.json") or {}
+        in_use.update(part["path"].split("/")[0] for part in manifest.get("steps_parts", []))
+
+    for info in filesystem.get_file_info(pafs.FileSelector(comp_dir)):
+        name = info.base_name
+        if info.type != pafs.FileType.Directory or not name.startswith("v") or not name[1:].isdigit():
+            continue
+        if int(name[1:]) < kept.start and name not in in_use:
+            filesystem.delete_dir(info.path)
+
+
+def export_read_models(comp_ids: Optional[List[str]] = None, root: Optional[str] = None) -> Dict[str, Any]:
+    """Export every given (default: running or recently ended) competition, collecting errors"""
+    from rollups import competitions_running_on
+
+    if comp_ids is None:
+        # Ended competitions keep exporting until the recompute window has passed their end
+        yesterday = datetime.now().date() - timedelta(days=1)
+        comp_ids = list(dict.fromkeys(
+            c["comp_id"]
+            for offset in range(READ_MODEL_RECOMPUTE_DAYS)
+            for c in competitions_running_on(yesterday - timedelta(days=offset))
+        ))
+
+    results = {}
+    for comp_id in comp_ids:
+        try:
+            manifest = export_competition(comp_id, root=root)
+            results[comp_id] = {"status": "exported", "version": manifest["version"], "through": manifest["through"]}
+        except Exception as e:
+            logger.error(f"Failed to export read model for {comp_id}: {e}", exc_info=True)
+            results[comp_id] = {"status": "error", "error": str(e)}
+    return {"competitions": results}
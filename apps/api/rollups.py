@@ -0,0 +1,213 @@
+"""
+Daily per-competition rollups
+
+A scheduled job (POST /cron/daily-rollups on the sync worker) materializes,
+for every active competition (or ended one still in its grace period) running
+on a day: total steps, active submitters, per-team totals and per-user totals.
+Rollups are stored as
+
+- one Firestore summary document per (competition, day) in daily_rollups,
+  read by the stats/trend endpoint and the agents. Per-user totals are left
+  out, so a document stays small however many members a competition has
+- rows in the BigQuery daily_rollups table (one competition row plus one row
+  per team and per user), for analytics
+
+so those reads no longer re-scan the raw step facts. Each run recomputes the
+last few days, since steps keep arriving until the grace period ends.
+"""
+
+import os
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Any
+
+from gcp_clients import fs, bq
+from storage import get_competitions, get_teams, get_steps_for_date
+from submission_bitmaps import rebuild_submission_bitmaps
+
+logger = logging.getLogger(__name__)
+
+GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
+BQ_DATASET = os.getenv("BQ_DATASET", "stepsquad")
+ROLLUP_COLLECTION = "daily_rollups"
+ROLLUP_TABLE = "daily_rollups"
+GRACE_DAYS = int(os.getenv("GRACE_DAYS", "2"))
+# Days (ending yesterday) recomputed per run; covers the submission grace period
+ROLLUP_RECOMPUTE_DAYS = int(os.getenv("ROLLUP_RECOMPUTE_DAYS", str(GRACE_DAYS + 1)))
+
+# Local fallback: (comp_id, date) -> rollup
+DAILY_ROLLUPS: Dict[tuple, Dict[str, Any]] = {}
+
+
+def _parse_date(value: Any) -> Optional[date]:
+    try:
+        return datetime.strptime(str(value).split("T")[0], "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+
+def competitions_running_on(day: date, through: date) -> List[Dict[str, Any]]:
+    """
+    Competitions whose start_date <= day <= end_date that can still receive steps
+
+    Only ACTIVE competitions, and ENDED ones whose grace period hasn't passed
+    `through` (the last day of the run); drafts and archived ones are skipped.
+    """
+    running = []
+    for competition in get_competitions():
+        start, end = _parse_date(competition.get("start_date")), _parse_date(competition.get("end_date"))
+        if not start or not end:
+            continue
+        status = competition.get("status")
+        if status != "ACTIVE" and not (status == "ENDED" and through <= end + timedelta(days=GRACE_DAYS)):
+            continue
+        if start <= day <= end:
+            running.append(competition)
+    return running
+
+
+def compute_daily_rollup(comp_id: str, day: str, teams: List[Dict[str, Any]], steps_by_user: Dict[str, int]) -> Dict[str, Any]:
+    """
+    Aggregate one competition day
+
+    Args:
+        teams: The competition's teams with their members
+        steps_by_user: Every user's steps on the day
+
+    Returns:
+        Rollup with total_steps, active_submitters, member_count, team_totals and
+        user_totals (user_totals only goes to BigQuery)
+    """
+    members = {uid for team in teams for uid in team.get("members", [])}
+    user_totals = {uid: steps_by_user[uid] for uid in members if steps_by_user.get(uid, 0) > 0}
+    team_totals = {
+        team.get("team_id"): sum(user_totals.get(uid, 0) for uid in set(team.get("members", [])))
+        for team in teams
+    }
+    return {
+        "comp_id": comp_id,
+        "date": day,
+        "total_steps": sum(user_totals.values()),
+        "active_submitters": len(user_totals),
+        "member_count": len(members),
+        "team_totals": team_totals,
+        "user_totals": user_totals,
+    }
+
+
+def store_daily_rollups(day: str, rollups: List[Dict[str, Any]]) -> None:
+    """
+    Save one day's rollups (all competitions) to Firestore and BigQuery
+
+    Per-user totals are only written to BigQuery. The BigQuery day partition
+    is replaced as a whole, so re-running a day doesn't duplicate rows.
+    """
+    summaries = [{key: value for key, value in rollup.items() if key != "user_totals"} for rollup in rollups]
+    for summary in summaries:
+        DAILY_ROLLUPS[(summary["comp_id"], day)] = summary
+
+    if not GCP_ENABLED or not fs():
+        return
+
+    batch = fs().batch()
+    for summary in summaries:
+        doc = fs().collection(ROLLUP_COLLECTION).document(f"{summary['comp_id']}_{day}")
+        batch.set(doc, {**summary, "updated_at": datetime.utcnow().isoformat()})
+    batch.commit()
+
+    if bq():
+        rows = []
+        for rollup in rollups:
+            base = {"comp_id": rollup["comp_id"], "date": day}
+            rows.append({**base, "team_id": None, "user_id": None, "steps": rollup["total_steps"],
+                         "active_submitters": rollup["active_submitters"], "member_count": rollup["member_count"]})
+            rows.extend({**base, "team_id": team_id, "user_id": None, "steps": steps,
+                         "active_submitters": None, "member_count": None}
+                        for team_id, steps in rollup["team_totals"].items())
+            rows.extend({**base, "team_id": None, "user_id": uid, "steps": steps,
+                         "active_submitters": None, "member_count": None}
+                        for uid, steps in rollup["user_totals"].items())
+        try:
+            from google.cloud import bigquery
+            job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+            partition = f"{BQ_DATASET}.{ROLLUP_TABLE}${day.replace('-', '')}"
+            bq().load_table_from_json(rows, partition, job_config=job_config).result()
+        except Exception as bq_error:
+            # BigQuery is optional, the Firestore rollups are what the app reads
+            logger.warning(f"Failed to write rollups for {day} to BigQuery: {bq_error}")
+
+
+def run_daily_rollups(through: Optional[date] = None, days: int = ROLLUP_RECOMPUTE_DAYS) -> Dict[str, Any]:
+    """
+    Recompute rollups for the `days` days ending at `through` (default yesterday)
+
+    Each day's steps are read once and shared by every competition running that day.
+    """
+    if through is None:
+        through = datetime.now().date() - timedelta(days=1)
+
+    teams_by_comp: Dict[str, List[Dict[str, Any]]] = {}
+    summary = {"through": through.isoformat(), "days": []}
+    for offset in range(days - 1, -1, -1):
+        day = through - timedelta(days=offset)
+        competitions = competitions_running_on(day, through)
+        if not competitions:
+            continue
+
+        steps_by_user = get_steps_for_date(day.isoformat())
+        rollups = []
+        for competition in competitions:
+            comp_id = competition.get("comp_id")
+            if comp_id not in teams_by_comp:
+                teams_by_comp[comp_id] = get_teams(comp_id=comp_id)
+            rollups.append(compute_daily_rollup(comp_id, day.isoformat(), teams_by_comp[comp_id], steps_by_user))
+
+        store_daily_rollups(day.isoformat(), rollups)
+        # The same scan corrects the day's submission bitmaps (e.g. writes that bypassed ingest)
+        rebuild_submission_bitmaps(day.isoformat(), {c.get("comp_id"): teams_by_comp[c.get("comp_id")] for c in competitions}, steps_by_user)
+        summary["days"].append({"date": day.isoformat(), "competitions": len(rollups)})
+
+    logger.info(f"Daily rollups: {summary}")
+    return summary
+
+
+def get_daily_rollups(comp_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[Dict[str, Any]]:
+    """A competition's rollups in the date range, oldest first"""
+    if GCP_ENABLED and fs():
+        query = fs().collection(ROLLUP_COLLECTION).where("comp_id", "==", comp_id)
+        if start_date:
+            query = query.where("date", ">=", start_date)
+        if end_date:
+            query = query.where("date", "<=", end_date)
+        rollups = [doc.to_dict() for doc in query.stream()]
+    else:
+        rollups = [
+            rollup for (rollup_comp, day), rollup in DAILY_ROLLUPS.items()
+            if rollup_comp == comp_id and (not start_date or day >= start_date) and (not end_date or day <= end_date)
+        ]
+    return sorted(rollups, key=lambda r: r.get("date", ""))
+
+
+def summarize_rollups(rollups: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Competition stats over a range of daily rollups
+
+    The rollup documents have no per-user totals, so submitters are reported
+    as the busiest day's count (distinct submitters are in BigQuery).
+    """
+    team_totals: Dict[str, int] = {}
+    for rollup in rollups:
+        for team_id, steps in rollup.get("team_totals", {}).items():
+            team_totals[team_id] = team_totals.get(team_id, 0) + steps
+
+    total_steps = sum(r.get("total_steps", 0) for r in rollups)
+    peak = max(rollups, key=lambda r: r.get("total_steps", 0)) if rollups else None
+    return {
+        "days": len(rollups),
+        "total_steps": total_steps,
+        "avg_daily_steps": round(total_steps / len(rollups)) if rollups else 0,
+        "peak_day": {"date": peak["date"], "total_steps": peak["total_steps"]} if peak else None,
+        "peak_active_submitters": max((r.get("active_submitters", 0) for r in rollups), default=0),
+        "member_count": rollups[-1].get("member_count", 0) if rollups else 0,
+        "team_totals": team_totals,
+    }
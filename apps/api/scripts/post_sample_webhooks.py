@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Fitbit/Garmin push notifications
+
+Posts sample notifications, signed the way the providers sign them, to a
+running API or sync worker so the webhook flow can be exercised without
+registering real subscriptions. Locally, post to the sync worker: it runs the
+enqueued sync tasks on its in-process queue.
+
+Usage:
+    python scripts/post_sample_webhooks.py --provider fitbit --uid member@example.com
+    python scripts/post_sample_webhooks.py --provider garmin --garmin-token <access token> --date 2025-02-10
+    python scripts/post_sample_webhooks.py --url http://localhost:8004 ...
+
+Uses FITBIT_CLIENT_SECRET and GARMIN_WEBHOOK_SECRET from the environment to
+sign, matching the receiving service's configuration.
+"""
+
+import os
+import sys
+import json
+import hmac
+import base64
+import hashlib
+import argparse
+from datetime import date
+from pathlib import Path
+
+import requests
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from fitbit_client import fitbit_subscription_id
+
+
+def post_fitbit(url: str, uid: str, day: str) -> requests.Response:
+    """Post a Fitbit activity notification for a user's subscription"""
+    body = json.dumps([{
+        "collectionType": "activities",
+        "date": day,
+        "ownerId": "SAMPLE",
+        "ownerType": "user",
+        "subscriptionId": fitbit_subscription_id(uid),
+    }]).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    secret = os.getenv("FITBIT_CLIENT_SECRET", "")
+    if secret:
+        digest = hmac.new(f"{secret}&".encode("utf-8"), body, hashlib.sha1).digest()
+        headers["X-Fitbit-Signature"] = base64.b64encode(digest).decode()
+    return requests.post(f"{url}/webhooks/fitbit", data=body, headers=headers, timeout=10)
+
+
+def post_garmin(url: str, access_token: str, day: str, steps: int) -> requests.Response:
+    """Post a Garmin dailies push notification for a user's access token"""
+    body = json.dumps({
+        "dailies": [{
+            "userAccessToken": access_token,
+            "calendarDate": day,
+            "steps": steps,
+            "summaryId": f"sample-{day}",
+        }]
+    }).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    secret = os.getenv("GARMIN_WEBHOOK_SECRET", "")
+    if secret:
+        headers["X-Garmin-Signature"] = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return requests.post(f"{url}/webhooks/garmin", data=body, headers=headers, timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post sample provider webhook notifications")
+    parser.add_argument("--url", default="http://localhost:8080", help="Base URL of the receiving service")
+    parser.add_argument("--provider", choices=["fitbit", "garmin"], required=True)
+    parser.add_argument("--uid", help="User whose Fitbit subscription changed")
+    parser.add_argument("--garmin-token", help="Garmin access token of the linked device")
+    parser.add_argument("--date", default=date.today().isoformat(), help="Changed day (YYYY-MM-DD)")
+    parser.add_argument("--steps", type=int, default=8000, help="Steps in the Garmin summary")
+    args = parser.parse_args()
+
+    if args.provider == "fitbit":
+        if not args.uid:
+            parser.error("--uid is required for fitbit")
+        response = post_fitbit(args.url, args.uid, args.date)
+    else:
+        if not args.garmin_token:
+            parser.error("--garmin-token is required for garmin")
+        response = post_garmin(args.url, args.garmin_token, args.date, args.steps)
+
+    print(f"{args.provider} notification -> {response.status_code}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 from __future__ import annotations
 from typing import Dict, Tuple, List, Optional
 import os
+import time
 import logging
 from datetime import datetime, date as date_type
 from gcp_clients import fs, bq
+from leaderboard_engine import get_leaderboard_engine, use_sql_leaderboard, LEADERBOARD_COUNT_TTL_SECONDS
 GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
 BQ_DATASET = os.getenv("BQ_DATASET", "stepsquad")
 logger = logging.getLogger(__name__)
@@ -11,6 +13,7 @@ USERS: Dict[str, dict] = {}
 TEAMS: Dict[str, dict] = {}
 COMPETITIONS: Dict[str, dict] = {}
 DAILY_STEPS: Dict[Tuple[str, str], int] = {}
+DAILY_STEPS_VERSION = 0  # bumped on every write, lets the local SQL engine skip re-mirroring
 TEAM_MEMBERS: Dict[str, List[str]] = {}
 IDEMPOTENCY_KEYS: Dict[str, str] = {}  # idempotency_key -> date mapping
 OAUTH_STATE_TOKENS: Dict[str, Dict[str, str]] = {}  # state_token -> {uid, provider} mapping
@@ -324,10 +327,13 @@ def delete_competition(comp_id: str):
         _fs_coll("competitions").document(comp_id).delete()
     COMPETITIONS.pop(comp_id, None)
 def write_daily_steps(uid: str, date: str, steps: int):
+    global DAILY_STEPS_VERSION
     key = (uid, date); prev = DAILY_STEPS.get(key, 0); new_steps = max(prev, steps)
-    DAILY_STEPS[key] = new_steps
+    DAILY_STEPS[key] = new_steps; DAILY_STEPS_VERSION += 1
     if GCP_ENABLED and _fs_coll("daily_steps"):
-        _fs_coll("daily_steps").document(f"{uid}_{date}").set({"user_id":uid,"date":date,"steps":new_steps}, merge=True)
+        from google.cloud import firestore
+        # updated_at: server write time, the fairness agent's incremental watermark
+        _fs_coll("daily_steps").document(f"{uid}_{date}").set({"user_id":uid,"date":date,"steps":new_steps,"updated_at":firestore.SERVER_TIMESTAMP}, merge=True)
         # BigQuery is optional - only write if available and dataset exists
         if bq():
             try:
@@ -337,6 +343,31 @@ def write_daily_steps(uid: str, date: str, steps: int):
                 # BigQuery errors are non-fatal - log warning but don't fail
                 logger.warning(f"Failed to write steps to BigQuery (dataset may not exist): {bq_error}")
 
+def write_daily_steps_batch(uid: str, steps_by_date: Dict[str, int]):
+    """Write several days of steps for one user with one Firestore batch and one BigQuery insert"""
+    global DAILY_STEPS_VERSION
+    DAILY_STEPS_VERSION += 1
+    rows = []
+    for date, steps in steps_by_date.items():
+        key = (uid, date); new_steps = max(DAILY_STEPS.get(key, 0), steps)
+        DAILY_STEPS[key] = new_steps
+        rows.append({"user_id": uid, "date": date, "steps": int(new_steps)})
+    if not rows:
+        return
+    if GCP_ENABLED and _fs_coll("daily_steps"):
+        from google.cloud import firestore
+        batch = fs().batch()
+        for row in rows:
+            batch.set(_fs_coll("daily_steps").document(f"{uid}_{row['date']}"), {**row, "updated_at": firestore.SERVER_TIMESTAMP}, merge=True)
+        batch.commit()
+        # BigQuery is optional - only write if available and dataset exists
+        if bq():
+            try:
+                bq().insert_rows_json(f"{BQ_DATASET}.fact_daily_steps", rows)
+            except Exception as bq_error:
+                # BigQuery errors are non-fatal - log warning but don't fail
+                logger.warning(f"Failed to write steps to BigQuery (dataset may not exist): {bq_error}")
+
 def get_user_steps(uid: str, comp_id: str | None = None) -> list[dict]:
     """Get user's step history, optionally filtered by competition"""
     if GCP_ENABLED and _fs_coll("daily_steps"):
@@ -353,6 +384,26 @@ def get_user_steps(uid: str, comp_id: str | None = None) -> list[dict]:
             steps.append({"user_id": user_id, "date": date, "steps": step_count})
     return sorted(steps, key=lambda x: x.get("date", ""), reverse=True)
 
+def get_steps_for_date(date: str) -> Dict[str, int]:
+    """Steps of every user on one day, as {uid: steps}"""
+    if GCP_ENABLED and _fs_coll("daily_steps"):
+        docs = _fs_coll("daily_steps").where("date", "==", date).stream()
+        return {d.get("user_id"): int(d.get("steps", 0)) for d in (doc.to_dict() for doc in docs) if d.get("user_id")}
+    return {uid: steps for (uid, step_date), steps in DAILY_STEPS.items() if step_date == date}
+
+def get_steps_between(start_date: str, end_date: str) -> list[dict]:
+    """All daily step entries with start_date <= date <= end_date"""
+    if GCP_ENABLED and _fs_coll("daily_steps"):
+        query = _fs_coll("daily_steps").where("date", ">=", start_date).where("date", "<=", end_date)
+        return [
+            {"user_id": d.get("user_id"), "date": d.get("date"), "steps": int(d.get("steps", 0))}
+            for d in (doc.to_dict() for doc in query.stream()) if d.get("user_id")
+        ]
+    return [
+        {"user_id": uid, "date": step_date, "steps": steps}
+        for (uid, step_date), steps in DAILY_STEPS.items() if start_date <= step_date <= end_date
+    ]
+
 def check_idempotency(idempotency_key: str, uid: str, date: str) -> bool:
     """Check if idempotency key has been used before"""
     if not idempotency_key:
@@ -379,6 +430,35 @@ def check_idempotency(idempotency_key: str, uid: str, date: str) -> bool:
     IDEMPOTENCY_KEYS[storage_key] = date
     return False
 
+def find_used_idempotency_keys(idempotency_keys: list[str], uid: str) -> set[str]:
+    """The keys already recorded for a user (one batched read), without recording any"""
+    if not idempotency_keys:
+        return set()
+    if GCP_ENABLED and _fs_coll("idempotency_keys"):
+        refs = [_fs_coll("idempotency_keys").document(f"{key}_{uid}") for key in idempotency_keys]
+        used_ids = {snap.id for snap in fs().get_all(refs) if snap.exists}
+        return {key for key in idempotency_keys if f"{key}_{uid}" in used_ids}
+    return {key for key in idempotency_keys if f"{key}_{uid}" in IDEMPOTENCY_KEYS}
+
+def record_idempotency_keys(dates_by_key: Dict[str, str], uid: str):
+    """Record used keys (key -> date) once the steps they cover are stored"""
+    if not dates_by_key:
+        return
+    if GCP_ENABLED and _fs_coll("idempotency_keys"):
+        batch = fs().batch()
+        created_at = datetime.utcnow().isoformat()
+        for key, date in dates_by_key.items():
+            batch.set(_fs_coll("idempotency_keys").document(f"{key}_{uid}"), {
+                "idempotency_key": key,
+                "user_id": uid,
+                "date": date,
+                "created_at": created_at
+            })
+        batch.commit()
+        return
+    for key, date in dates_by_key.items():
+        IDEMPOTENCY_KEYS[f"{key}_{uid}"] = date
+
 def is_user_in_team_for_competition(uid: str, comp_id: str) -> bool:
     """Check if user is a member of any team in the competition"""
     teams = get_teams(comp_id=comp_id)
@@ -386,6 +466,63 @@ def is_user_in_team_for_competition(uid: str, comp_id: str) -> bool:
         if uid in team.get("members", []):
             return True
     return False
+
+_scan_row_counts: Dict[tuple, tuple] = {}  # (date, start_date, end_date) -> (counted_at, rows)
+
+def _step_scan_rows(date: str | None, start_date: str | None, end_date: str | None) -> int:
+    """
+    Number of daily_steps documents a leaderboard with these date filters streams
+
+    Firestore counts are reused for LEADERBOARD_COUNT_TTL_SECONDS per filter, so
+    engine selection costs at most one count() round trip per filter and TTL.
+    """
+    if GCP_ENABLED and _fs_coll("daily_steps"):
+        key = (date, start_date, end_date)
+        cached = _scan_row_counts.get(key)
+        if cached and time.monotonic() - cached[0] < LEADERBOARD_COUNT_TTL_SECONDS:
+            return cached[1]
+        query = _fs_coll("daily_steps")
+        if date:
+            query = query.where("date", "==", date)
+        else:
+            if start_date:
+                query = query.where("date", ">=", start_date)
+            if end_date:
+                query = query.where("date", "<=", end_date)
+        try:
+            # Count aggregation reads index entries only, not the documents
+            rows = int(query.count().get()[0][0].value)
+        except Exception as e:
+            logger.warning(f"Failed to count daily_steps for leaderboard engine selection: {e}")
+            return 0
+        _scan_row_counts[key] = (time.monotonic(), rows)
+        return rows
+    return len(DAILY_STEPS)
+
+def _sql_member_totals(
+    members: list[tuple[str, str | None]] | None,
+    date: str | None,
+    start_date: str | None,
+    end_date: str | None,
+) -> list[dict] | None:
+    """
+    Per-(team, user) totals from the SQL engine for large scans
+
+    Returns None when the leaderboard is small enough to aggregate in Python
+    (or the SQL engine fails), so callers fall back to the document scan.
+    """
+    # Counted only in auto mode (and then cached)
+    if not use_sql_leaderboard(lambda: _step_scan_rows(date, start_date, end_date)):
+        return None
+    try:
+        engine = get_leaderboard_engine()
+        if hasattr(engine, "sync"):
+            engine.sync(DAILY_STEPS, DAILY_STEPS_VERSION)
+        return engine.member_totals(members, date=date, start_date=start_date, end_date=end_date)
+    except Exception as e:
+        logger.warning(f"SQL leaderboard aggregation failed, scanning documents instead: {e}")
+        return None
+
 def individual_leaderboard(
     comp_id: str | None = None,
     date: str | None = None,
@@ -410,7 +547,15 @@ def individual_leaderboard(
     
     # Aggregate steps by user
     agg = {}
-    if GCP_ENABLED and _fs_coll("daily_steps"):
+    members = None
+    if comp_id or team_id:
+        allowed = user_ids_in_comp & user_ids_in_team if comp_id and team_id else user_ids_in_comp or user_ids_in_team
+        members = [(uid, None) for uid in allowed]
+    sql_totals = _sql_member_totals(members, date, start_date, end_date)
+    if sql_totals is not None:
+        for row in sql_totals:
+            agg[row["user_id"]] = row["steps"]
+    elif GCP_ENABLED and _fs_coll("daily_steps"):
         query = _fs_coll("daily_steps")
         
         # Apply date filters
@@ -515,6 +660,15 @@ def team_leaderboard(
     else:
         teams = get_teams()
     
+    # Large scans: one SQL aggregation for every team instead of a scan per team
+    sql_totals = _sql_member_totals(
+        list({(uid, team.get("team_id")) for team in teams for uid in team.get("members", [])}),
+        date, start_date, end_date
+    )
+    sql_member_steps: Dict[str, Dict[str, int]] = {}
+    for row in sql_totals or []:
+        sql_member_steps.setdefault(row["team_id"], {})[row["user_id"]] = row["steps"]
+    
     # Aggregate steps by team
     result = []
     for team in teams:
@@ -528,7 +682,10 @@ def team_leaderboard(
         total_steps = 0
         member_steps = {}  # Track individual member steps
         
-        if GCP_ENABLED and _fs_coll("daily_steps"):
+        if sql_totals is not None:
+            member_steps = sql_member_steps.get(team_id, {})
+            total_steps = sum(member_steps.values())
+        elif GCP_ENABLED and _fs_coll("daily_steps"):
             query = _fs_coll("daily_steps")
             
             # Filter by members
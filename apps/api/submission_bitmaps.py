@@ -0,0 +1,226 @@
+"""
+Per-competition daily submission bitmaps
+
+Every competition member is interned to a small integer index (append-only,
+so indices never move). For each (competition, day) a bitmap has bit i set
+once member i has submitted steps for that day. Ingest paths set the bits as
+they write steps, and the rollup job rebuilds them for the days it
+recomputes, so "who hasn't submitted" is a bitwise difference
+(members & ~submitted) instead of a read of every member's history.
+
+Firestore layout:
+
+    submission_index/{comp_id}          {"comp_id", "members": [uid, ...]}  position = bit index
+    submission_bitmaps/{comp_id}_{date} {"comp_id", "date", "positions": [bit index, ...], "updated_at"}
+
+Setting bits is an ArrayUnion of positions rather than a read-modify-write
+transaction: every member of a competition writes the same day document, and
+unions commute, so concurrent syncs never abort each other. The array holds
+each position at most once, so it is bounded by the competition's members.
+Callers that store many submissions at once (the nightly sync) group them
+with record_submission_groups so each competition day is written once.
+"""
+
+import os
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Any
+
+from gcp_clients import fs
+
+logger = logging.getLogger(__name__)
+
+GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
+INDEX_COLLECTION = "submission_index"
+BITMAP_COLLECTION = "submission_bitmaps"
+
+# Local fallback: comp_id -> interned uids, (comp_id, date) -> bitmap
+SUBMISSION_INDEX: Dict[str, List[str]] = {}
+SUBMISSION_BITMAPS: Dict[tuple, int] = {}
+_lock = threading.Lock()
+
+# Index positions seen by this process (comp_id -> uid -> index)
+_positions: Dict[str, Dict[str, int]] = {}
+
+
+def _fs_coll(name: str):
+    """Get Firestore collection reference"""
+    return fs().collection(name) if fs() and GCP_ENABLED else None
+
+
+def bitmap_doc_id(comp_id: str, date: str) -> str:
+    return f"{comp_id}_{date}"
+
+
+def _load_index(comp_id: str) -> List[str]:
+    if _fs_coll(INDEX_COLLECTION):
+        doc = _fs_coll(INDEX_COLLECTION).document(comp_id).get()
+        return list((doc.to_dict() or {}).get("members", [])) if doc.exists else []
+    return list(SUBMISSION_INDEX.get(comp_id, []))
+
+
+def member_positions(comp_id: str, uids: Iterable[str]) -> Dict[str, int]:
+    """
+    Bit index of each uid, interning the ones the competition hasn't seen yet
+
+    Args:
+        comp_id: Competition id
+        uids: Users to look up
+
+    Returns:
+        Mapping uid -> bit index
+    """
+    uids = list(dict.fromkeys(uids))
+    with _lock:
+        positions = _positions.setdefault(comp_id, {})
+        if all(uid in positions for uid in uids):
+            return {uid: positions[uid] for uid in uids}
+
+    if _fs_coll(INDEX_COLLECTION):
+        from google.cloud import firestore
+        doc_ref = _fs_coll(INDEX_COLLECTION).document(comp_id)
+
+        @firestore.transactional
+        def _intern(transaction) -> List[str]:
+            snapshot = doc_ref.get(transaction=transaction)
+            members = list((snapshot.to_dict() or {}).get("members", [])) if snapshot.exists else []
+            known = set(members)
+            added = [uid for uid in uids if uid not in known]
+            if added:
+                members.extend(added)
+                transaction.set(doc_ref, {"comp_id": comp_id, "members": members})
+            return members
+
+        members = _intern(fs().transaction())
+    else:
+        with _lock:
+            members = SUBMISSION_INDEX.setdefault(comp_id, [])
+            known = set(members)
+            members.extend(uid for uid in uids if uid not in known)
+            members = list(members)
+
+    with _lock:
+        positions = _positions[comp_id] = {uid: i for i, uid in enumerate(members)}
+        return {uid: positions[uid] for uid in uids}
+
+
+def _bits_for(positions: Iterable[int]) -> int:
+    bits = 0
+    for position in positions:
+        bits |= 1 << position
+    return bits
+
+
+def bits_from_doc(data: Dict[str, Any]) -> int:
+    """A stored day document as a bitmap integer (also used by the agents)"""
+    return _bits_for(data.get("positions", []))
+
+
+def record_submissions(comp_id: str, date: str, uids: Iterable[str], replace: bool = False) -> None:
+    """
+    Mark users as having submitted steps for a competition day
+
+    Args:
+        comp_id: Competition id
+        date: Day (YYYY-MM-DD)
+        uids: Users who submitted
+        replace: Overwrite the day's bitmap instead of OR-ing into it (rebuilds)
+    """
+    uids = list(uids)
+    if not uids and not replace:
+        return
+    positions = sorted(member_positions(comp_id, uids).values())
+
+    if _fs_coll(BITMAP_COLLECTION):
+        from google.cloud import firestore
+        doc_ref = _fs_coll(BITMAP_COLLECTION).document(bitmap_doc_id(comp_id, date))
+        payload = {"comp_id": comp_id, "date": date, "updated_at": datetime.utcnow().isoformat()}
+        if replace:
+            doc_ref.set({**payload, "positions": positions})
+        else:
+            # A blind union: no read, no transaction to abort under contention
+            doc_ref.set({**payload, "positions": firestore.ArrayUnion(positions)}, merge=True)
+    else:
+        new_bits = _bits_for(positions)
+        with _lock:
+            key = (comp_id, date)
+            SUBMISSION_BITMAPS[key] = new_bits if replace else SUBMISSION_BITMAPS.get(key, 0) | new_bits
+
+
+def record_submission_groups(submissions: Iterable[Tuple[str, str, str]]) -> int:
+    """
+    Record (comp_id, date, uid) submissions with one write per competition day
+
+    Failures are logged, never raised (ingest paths); the rollup job rebuilds
+    the days it recomputes.
+
+    Returns:
+        Number of competition days written
+    """
+    groups: Dict[Tuple[str, str], Set[str]] = {}
+    for comp_id, date, uid in submissions:
+        groups.setdefault((comp_id, date), set()).add(uid)
+    for (comp_id, date), uids in groups.items():
+        try:
+            record_submissions(comp_id, date, sorted(uids))
+        except Exception as e:
+            logger.warning(f"Failed to update submission bitmap for {comp_id} on {date}: {e}")
+    return len(groups)
+
+
+def record_submission_safely(comp_id: str, date: str, uid: str) -> None:
+    """record_submissions for one user on an ingest path; failures are logged, never raised"""
+    record_submission_groups([(comp_id, date, uid)])
+
+
+def get_submission_bitmap(comp_id: str, date: str) -> Optional[int]:
+    """The day's bitmap as an integer, or None if nothing was recorded for the day"""
+    if _fs_coll(BITMAP_COLLECTION):
+        doc = _fs_coll(BITMAP_COLLECTION).document(bitmap_doc_id(comp_id, date)).get()
+        if not doc.exists:
+            return None
+        return bits_from_doc(doc.to_dict() or {})
+    with _lock:
+        return SUBMISSION_BITMAPS.get((comp_id, date))
+
+
+def missing_members(comp_id: str, date: str, members: Iterable[str]) -> Optional[Set[str]]:
+    """
+    Members without a submission for the day, from the bitmap difference
+
+    Returns:
+        The missing uids, or None if the day has no bitmap (caller falls back)
+    """
+    submitted = get_submission_bitmap(comp_id, date)
+    if submitted is None:
+        return None
+
+    members = set(members)
+    with _lock:
+        known = _positions.get(comp_id, {})
+        stale = any(uid not in known for uid in members)
+    if stale:
+        index = _load_index(comp_id)
+        with _lock:
+            known = _positions[comp_id] = {uid: i for i, uid in enumerate(index)}
+
+    # Members never interned have never submitted to this competition
+    missing = {uid for uid in members if uid not in known}
+    missing_bits = _bits_for(known[uid] for uid in members if uid in known) & ~submitted
+    index_of = {i: uid for uid, i in known.items()}
+    while missing_bits:
+        low = missing_bits & -missing_bits
+        missing.add(index_of[low.bit_length() - 1])
+        missing_bits ^= low
+    return missing
+
+
+def rebuild_submission_bitmaps(date: str, teams_by_comp: Dict[str, List[Dict[str, Any]]], steps_by_user: Dict[str, int]) -> None:
+    """Replace the day's bitmaps of the given competitions from that day's step facts"""
+    for comp_id, teams in teams_by_comp.items():
+        members = {uid for team in teams for uid in team.get("members", [])}
+        try:
+            record_submissions(comp_id, date, sorted(members & set(steps_by_user)), replace=True)
+        except Exception as e:
+            logger.warning(f"Failed to rebuild submission bitmap for {comp_id} on {date}: {e}")
@@ -0,0 +1,223 @@
+"""
+Shard leases for distributing the device sync cron
+
+Linked devices are partitioned into shards by a stable hash of the uid. A
+worker instance processes a shard only after claiming its lease document for
+the current run; the lease has an expiry that the holder keeps extending while
+it works, so a crashed shard becomes claimable again once its lease lapses.
+"""
+
+import os
+import logging
+import threading
+import zlib
+from typing import Dict, Optional, Any
+from datetime import datetime
+from gcp_clients import fs
+
+logger = logging.getLogger(__name__)
+
+GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
+
+# In-memory storage for local dev
+SYNC_LEASES: Dict[str, Dict[str, Any]] = {}  # lease_id -> lease data
+_local_lock = threading.Lock()
+
+
+def _fs_coll(name: str):
+    """Get Firestore collection reference"""
+    return fs().collection(name) if fs() and GCP_ENABLED else None
+
+
+def shard_for_uid(uid: str, shard_count: int) -> int:
+    """Stable shard assignment for a user (Python's hash() is salted per process)"""
+    if shard_count <= 1:
+        return 0
+    return zlib.crc32(uid.encode("utf-8")) % shard_count
+
+
+def _lease_id(run_id: str, shard: int) -> str:
+    return f"{run_id}_{shard}"
+
+
+def _is_claimable(lease: Optional[Dict[str, Any]], owner: str, now: float) -> bool:
+    if not lease:
+        return True
+    if lease.get("status") == "done":
+        return False
+    return lease.get("owner") == owner or lease.get("expires_at", 0) <= now
+
+
+def claim_sync_lease(run_id: str, shard: int, owner: str, ttl_seconds: int) -> bool:
+    """
+    Try to claim a shard for a sync run
+
+    Args:
+        run_id: Identifies the sync run (e.g. the sync date)
+        shard: Shard number
+        owner: Unique id of the claiming worker instance
+        ttl_seconds: Lease duration; renew_sync_lease extends it
+
+    Returns:
+        True if the caller now holds the lease
+    """
+    lease_id = _lease_id(run_id, shard)
+    now = datetime.utcnow().timestamp()
+    lease = {
+        "run_id": run_id,
+        "shard": shard,
+        "owner": owner,
+        "status": "running",
+        "expires_at": now + ttl_seconds,
+        "claimed_at": datetime.utcnow().isoformat(),
+    }
+
+    if GCP_ENABLED and _fs_coll("sync_leases"):
+        from google.cloud import firestore
+        doc_ref = _fs_coll("sync_leases").document(lease_id)
+
+        @firestore.transactional
+        def _claim(transaction) -> bool:
+            snapshot = doc_ref.get(transaction=transaction)
+            current = snapshot.to_dict() if snapshot.exists else None
+            if not _is_claimable(current, owner, now):
+                return False
+            lease["attempts"] = (current or {}).get("attempts", 0) + 1
+            transaction.set(doc_ref, lease)
+            return True
+
+        claimed = _claim(fs().transaction())
+    else:
+        with _local_lock:
+            current = SYNC_LEASES.get(lease_id)
+            claimed = _is_claimable(current, owner, now)
+            if claimed:
+                lease["attempts"] = (current or {}).get("attempts", 0) + 1
+                SYNC_LEASES[lease_id] = lease
+
+    if claimed:
+        logger.info(f"Claimed sync lease {lease_id} for {owner}")
+    return claimed
+
+
+def renew_sync_lease(run_id: str, shard: int, owner: str, ttl_seconds: int) -> bool:
+    """Extend a held lease; returns False if the lease was lost to another owner"""
+    lease_id = _lease_id(run_id, shard)
+    expires_at = datetime.utcnow().timestamp() + ttl_seconds
+
+    if GCP_ENABLED and _fs_coll("sync_leases"):
+        from google.cloud import firestore
+        doc_ref = _fs_coll("sync_leases").document(lease_id)
+
+        @firestore.transactional
+        def _renew(transaction) -> bool:
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists or (snapshot.to_dict() or {}).get("owner") != owner:
+                return False
+            transaction.update(doc_ref, {"expires_at": expires_at})
+            return True
+
+        return _renew(fs().transaction())
+
+    with _local_lock:
+        lease = SYNC_LEASES.get(lease_id)
+        if not lease or lease.get("owner") != owner:
+            return False
+        lease["expires_at"] = expires_at
+        return True
+
+
+def complete_sync_lease(run_id: str, shard: int, owner: str, summary: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Mark a shard done for this run so it is never processed again
+
+    Returns:
+        False (and nothing is written) if the caller no longer holds the lease
+    """
+    lease_id = _lease_id(run_id, shard)
+    update = {
+        "status": "done",
+        "completed_at": datetime.utcnow().isoformat(),
+        "summary": summary or {},
+    }
+
+    if GCP_ENABLED and _fs_coll("sync_leases"):
+        from google.cloud import firestore
+        doc_ref = _fs_coll("sync_leases").document(lease_id)
+
+        @firestore.transactional
+        def _complete(transaction) -> bool:
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists or (snapshot.to_dict() or {}).get("owner") != owner:
+                return False
+            transaction.update(doc_ref, update)
+            return True
+
+        completed = _complete(fs().transaction())
+    else:
+        with _local_lock:
+            lease = SYNC_LEASES.get(lease_id)
+            completed = bool(lease) and lease.get("owner") == owner
+            if completed:
+                lease.update(update)
+
+    if completed:
+        logger.info(f"Completed sync lease {lease_id}")
+    else:
+        logger.warning(f"Not completing sync lease {lease_id}: no longer held by {owner}")
+    return completed
+
+
+def release_sync_lease(run_id: str, shard: int, owner: str) -> None:
+    """Give up a held lease early (e.g. after a failure) so another instance can retry it"""
+    lease_id = _lease_id(run_id, shard)
+
+    if GCP_ENABLED and _fs_coll("sync_leases"):
+        doc_ref = _fs_coll("sync_leases").document(lease_id)
+        doc = doc_ref.get()
+        if doc.exists and (doc.to_dict() or {}).get("owner") == owner:
+            doc_ref.update({"expires_at": 0})
+        return
+
+    with _local_lock:
+        lease = SYNC_LEASES.get(lease_id)
+        if lease and lease.get("owner") == owner:
+            lease["expires_at"] = 0
+
+
+class LeaseHeartbeat:
+    """Context manager that keeps renewing a lease in the background while a shard is processed"""
+
+    def __init__(self, run_id: str, shard: int, owner: str, ttl_seconds: int):
+        self.run_id = run_id
+        self.shard = shard
+        self.owner = owner
+        self.ttl_seconds = ttl_seconds
+        # Set once renewal finds the lease held by another owner; work should stop
+        self.lost_event = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        interval = max(1.0, self.ttl_seconds / 3)
+        while not self._stop.wait(interval):
+            try:
+                if not renew_sync_lease(self.run_id, self.shard, self.owner, self.ttl_seconds):
+                    logger.warning(f"Lost sync lease {_lease_id(self.run_id, self.shard)}")
+                    self.lost_event.set()
+                    return
+            except Exception as e:
+                logger.warning(f"Failed to renew sync lease {_lease_id(self.run_id, self.shard)}: {e}")
+
+    @property
+    def lost(self) -> bool:
+        return self.lost_event.is_set()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
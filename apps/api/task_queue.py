@@ -0,0 +1,190 @@
+"""
+Device sync task queue
+
+The sync cron fans out one task per (uid, provider) instead of syncing every
+device in one request. In production tasks are published to the device sync
+Pub/Sub topic; its push subscription delivers them to the sync worker's
+/tasks/sync-device handler and takes care of retries with backoff and
+dead-lettering. Locally an in-process queue with the same retry, backoff and
+dead-letter behaviour stands in for Pub/Sub.
+"""
+
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Any
+
+from gcp_clients import publisher
+from pubsub_bus import publish_device_sync_tasks
+
+logger = logging.getLogger(__name__)
+
+GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
+
+# Retry policy for the local queue (the Pub/Sub subscription is configured to match)
+SYNC_TASK_MAX_ATTEMPTS = int(os.getenv("SYNC_TASK_MAX_ATTEMPTS", "5"))
+SYNC_TASK_MIN_BACKOFF_SECONDS = float(os.getenv("SYNC_TASK_MIN_BACKOFF_SECONDS", "10"))
+SYNC_TASK_MAX_BACKOFF_SECONDS = float(os.getenv("SYNC_TASK_MAX_BACKOFF_SECONDS", "600"))
+LOCAL_TASK_WORKERS = int(os.getenv("LOCAL_TASK_WORKERS", "4"))
+
+TaskHandler = Callable[[Dict[str, Any]], Any]
+
+
+class LocalTaskQueue:
+    """
+    In-process stand-in for the device sync topic and its push subscription
+
+    A handler that raises is retried with exponential backoff; after
+    max_attempts the task is moved to dead_letters.
+    """
+
+    def __init__(
+        self,
+        handler: TaskHandler,
+        workers: int = LOCAL_TASK_WORKERS,
+        max_attempts: int = SYNC_TASK_MAX_ATTEMPTS,
+        min_backoff: float = SYNC_TASK_MIN_BACKOFF_SECONDS,
+        max_backoff: float = SYNC_TASK_MAX_BACKOFF_SECONDS
+    ):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.dead_letters: List[Dict[str, Any]] = []
+        self.completed = 0
+        self.retried = 0
+        self._heap: List[tuple] = []  # (due, seq, attempt, task)
+        self._seq = itertools.count()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"sync-task-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, task: Dict[str, Any], delay: float = 0, attempt: int = 1) -> None:
+        """Add a task, optionally delayed by delay seconds"""
+        with self._cond:
+            self._ensure_started()
+            if attempt == 1:
+                self._pending += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), attempt, task))
+            self._cond.notify()
+
+    def _next_task(self):
+        with self._cond:
+            while True:
+                if self._heap:
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        _, _, attempt, task = heapq.heappop(self._heap)
+                        return attempt, task
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def _finish(self):
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            attempt, task = self._next_task()
+            try:
+                self.handler(task)
+                self.completed += 1
+                self._finish()
+            except Exception as e:
+                if attempt >= self.max_attempts:
+                    logger.error(f"Dead-lettering sync task {task.get('uid')}/{task.get('provider')} after {attempt} attempts: {e}")
+                    self.dead_letters.append({
+                        "task": task,
+                        "attempts": attempt,
+                        "error": str(e),
+                        "dead_lettered_at": datetime.utcnow().isoformat(),
+                    })
+                    self._finish()
+                    continue
+
+                backoff = min(self.max_backoff, self.min_backoff * (2 ** (attempt - 1)))
+                logger.warning(f"Sync task {task.get('uid')}/{task.get('provider')} failed (attempt {attempt}), retrying in {backoff}s: {e}")
+                self.retried += 1
+                self.enqueue(task, delay=backoff, attempt=attempt + 1)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every enqueued task succeeded or was dead-lettered"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stats(self) -> Dict[str, int]:
+        """Queue counters"""
+        with self._cond:
+            return {
+                "pending": self._pending,
+                "completed": self.completed,
+                "retried": self.retried,
+                "dead_lettered": len(self.dead_letters),
+            }
+
+
+_local_queue: Optional[LocalTaskQueue] = None
+
+
+def register_local_handler(handler: TaskHandler, **kwargs) -> LocalTaskQueue:
+    """Set the handler that processes tasks when running without Pub/Sub"""
+    global _local_queue
+    _local_queue = LocalTaskQueue(handler, **kwargs)
+    return _local_queue
+
+
+def local_queue() -> Optional[LocalTaskQueue]:
+    """The in-process queue, if a handler was registered"""
+    return _local_queue
+
+
+def can_enqueue_device_sync_tasks() -> bool:
+    """Whether enqueue_device_sync_tasks has somewhere to put tasks (Pub/Sub or a local handler)"""
+    return (GCP_ENABLED and publisher() is not None) or _local_queue is not None
+
+
+def enqueue_device_sync_tasks(tasks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Enqueue device sync tasks
+
+    Args:
+        tasks: Task payloads, one per (uid, provider)
+
+    Returns:
+        Where the tasks went and how many were enqueued
+    """
+    if not tasks:
+        return {"queue": "none", "count": 0}
+
+    if GCP_ENABLED:
+        result = publish_device_sync_tasks(tasks)
+        if not result.get("local"):
+            return {"queue": "pubsub", "count": len(tasks)}
+
+    if _local_queue is None:
+        raise RuntimeError("No local sync task handler registered")
+
+    for task in tasks:
+        _local_queue.enqueue(task)
+    return {"queue": "local", "count": len(tasks)}
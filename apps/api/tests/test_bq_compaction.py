@@ -0,0 +1,74 @@
+"""
+Unit tests for the BigQuery step fact compaction
+"""
+from datetime import date, timedelta
+
+import pytest
+
+import bq_compaction
+
+
+class FakeJob:
+    num_dml_affected_rows = 7
+    total_bytes_processed = 2048
+
+    def result(self):
+        return []
+
+
+class FakeClient:
+    """Records the MERGE statement and its parameters"""
+
+    def __init__(self):
+        self.queries = []
+
+    def query(self, sql, job_config=None):
+        self.queries.append((sql, {p.name: p.value for p in job_config.query_parameters}))
+        return FakeJob()
+
+
+@pytest.fixture
+def bq_client(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(bq_compaction, "bq", lambda: client)
+    return client
+
+
+def test_merge_keeps_the_largest_count_per_user_day(bq_client):
+    """One curated row per (user_id, date) with max(steps), the rule write_daily_steps applies"""
+    summary = bq_compaction.compact_daily_steps(lookback_days=10)
+
+    sql, params = bq_client.queries[0]
+    assert sql.lstrip().startswith(f"MERGE `{bq_compaction.BQ_DATASET}.daily_steps_curated`")
+    assert f"FROM `{bq_compaction.BQ_DATASET}.fact_daily_steps`" in sql
+    assert "MAX(steps) AS steps" in sql and "GROUP BY user_id, date" in sql
+    # A lower re-sent count never overwrites a higher one
+    assert "WHEN MATCHED AND target.steps < source.steps THEN" in sql
+    assert params == {"start_date": date.today() - timedelta(days=10)}
+    assert summary["start_date"] == (date.today() - timedelta(days=10)).isoformat()
+    assert summary["affected_rows"] == 7
+    assert summary["bytes_processed"] == 2048
+
+
+def test_merge_prunes_partitions_on_both_sides(bq_client):
+    """Source and target are both bounded by @start_date, so only recent partitions are scanned"""
+    bq_compaction.compact_daily_steps()
+
+    sql, params = bq_client.queries[0]
+    assert "WHERE date >= @start_date" in sql
+    assert "AND target.date >= @start_date" in sql
+    assert params["start_date"] == date.today() - timedelta(days=bq_compaction.COMPACTION_LOOKBACK_DAYS)
+
+
+def test_full_rebuild_compacts_every_partition(bq_client):
+    summary = bq_compaction.compact_daily_steps(lookback_days=None)
+
+    assert bq_client.queries[0][1] == {"start_date": date.min}
+    assert summary["start_date"] is None
+
+
+def test_compaction_requires_bigquery(monkeypatch):
+    monkeypatch.setattr(bq_compaction, "bq", lambda: None)
+
+    with pytest.raises(RuntimeError):
+        bq_compaction.compact_daily_steps()
@@ -0,0 +1,407 @@
+"""
+Unit tests for the Fitbit/Garmin device clients against a local stub server
+"""
+import json
+import threading
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fitbit_client
+import garmin_client
+from http_sessions import build_session, get_session, set_session
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the provider APIs, records every request it sees"""
+    protocol_version = "HTTP/1.1"  # Needed for keep-alive
+
+    def _send_json(self, status: int, body: dict, headers: dict | None = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _record(self):
+        self.server.requests_seen.append({
+            "method": self.command,
+            "path": self.path,
+            "client_port": self.client_address[1],
+            "headers": dict(self.headers),
+        })
+
+    def do_GET(self):
+        self._record()
+        route = self.server.routes.get(("GET", self.path.split("?")[0]))
+        if route is None:
+            self._send_json(404, {"errors": [{"message": "not found"}]})
+            return
+        self._send_json(*route)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self._record()
+        route = self.server.routes.get(("POST", self.path.split("?")[0]))
+        if route is None:
+            self._send_json(404, {"errors": [{"message": "not found"}]})
+            return
+        self._send_json(*route)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    """Run a stub provider server and point both clients' sessions at it"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubProviderHandler)
+    server.routes = {}
+    server.requests_seen = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(fitbit_client, "FITBIT_BASE_URL", base_url)
+    monkeypatch.setattr(fitbit_client, "FITBIT_TOKEN_URL", f"{base_url}/oauth2/token")
+    monkeypatch.setattr(fitbit_client, "FITBIT_CLIENT_ID", "client-id")
+    monkeypatch.setattr(fitbit_client, "FITBIT_CLIENT_SECRET", "client-secret")
+    monkeypatch.setattr(garmin_client, "GARMIN_BASE_URL", base_url)
+    set_session("fitbit", build_session(max_retries=0))
+    set_session("garmin", build_session(max_retries=0))
+
+    yield server
+
+    set_session("fitbit", None)
+    set_session("garmin", None)
+    server.shutdown()
+    server.server_close()
+
+
+def test_fitbit_daily_steps_from_stub(stub_server):
+    """Fitbit daily steps are parsed from the activity summary"""
+    stub_server.routes[("GET", "/1/user/-/activities/date/2025-02-10.json")] = (200, {"summary": {"steps": 12345}})
+
+    steps = fitbit_client.get_fitbit_daily_steps("token-abc", date(2025, 2, 10))
+
+    assert steps == 12345
+    assert stub_server.requests_seen[0]["headers"]["Authorization"] == "Bearer token-abc"
+
+
+def test_fitbit_session_reuses_connection(stub_server):
+    """Consecutive calls go over one kept-alive connection"""
+    stub_server.routes[("GET", "/1/user/-/activities/date/2025-02-10.json")] = (200, {"summary": {"steps": 1}})
+    stub_server.routes[("GET", "/1/user/-/activities/date/2025-02-11.json")] = (200, {"summary": {"steps": 2}})
+
+    fitbit_client.get_fitbit_daily_steps("token-abc", date(2025, 2, 10))
+    fitbit_client.get_fitbit_daily_steps("token-abc", date(2025, 2, 11))
+
+    ports = {r["client_port"] for r in stub_server.requests_seen}
+    assert len(stub_server.requests_seen) == 2
+    assert len(ports) == 1
+
+
+def test_fitbit_expired_token_raises(stub_server):
+    """A 401 from Fitbit surfaces as an expired-token ValueError"""
+    stub_server.routes[("GET", "/1/user/-/activities/date/2025-02-10.json")] = (401, {"errors": []})
+
+    with pytest.raises(ValueError, match="expired"):
+        fitbit_client.get_fitbit_daily_steps("token-abc", date(2025, 2, 10))
+
+
+def test_fitbit_refresh_token_uses_session(stub_server):
+    """Token refresh goes through the pooled session and keeps the old refresh token if none returned"""
+    stub_server.routes[("POST", "/oauth2/token")] = (200, {"access_token": "new-access", "expires_in": 3600})
+
+    tokens = fitbit_client.refresh_fitbit_token("old-refresh")
+
+    assert tokens["access_token"] == "new-access"
+    assert tokens["refresh_token"] == "old-refresh"
+    assert stub_server.requests_seen[0]["method"] == "POST"
+
+
+def test_garmin_daily_steps_from_stub(stub_server):
+    """Garmin daily steps are read from the daily summary endpoint"""
+    stub_server.routes[("GET", "/wellness-service/wellness/dailySummary")] = (200, {"steps": 8000})
+
+    steps = garmin_client.get_garmin_daily_steps("token-xyz", date(2025, 2, 10))
+
+    assert steps == 8000
+    assert "date=2025-02-10" in stub_server.requests_seen[0]["path"]
+
+
+def test_provider_5xx_is_not_retried_by_the_session(stub_server):
+    """A 5xx fails once, so the circuit breaker sees every failing call right away"""
+    stub_server.routes[("GET", "/wellness-service/wellness/dailySummary")] = (503, {"error": "down"})
+    set_session("garmin", build_session())
+
+    session = get_session("garmin")
+    response = session.get(f"{garmin_client.GARMIN_BASE_URL}/wellness-service/wellness/dailySummary?date=2025-02-10", timeout=5)
+
+    assert response.status_code == 503
+    assert len(stub_server.requests_seen) == 1
+
+
+def test_get_session_is_shared():
+    """The same pooled session is returned for repeated lookups"""
+    set_session("garmin", None)
+    try:
+        assert get_session("garmin") is get_session("garmin")
+        assert get_session("garmin") is not get_session("fitbit")
+    finally:
+        set_session("garmin", None)
+        set_session("fitbit", None)
+
+
+def test_fitbit_steps_range_single_call(stub_server):
+    """A multi-day Fitbit range is fetched with one time-series request"""
+    stub_server.routes[("GET", "/1/user/-/activities/steps/date/2025-02-10/2025-02-12.json")] = (200, {
+        "activities-steps": [
+            {"dateTime": "2025-02-10", "value": "1000"},
+            {"dateTime": "2025-02-11", "value": "2000"},
+            {"dateTime": "2025-02-12", "value": "0"},
+        ]
+    })
+
+    steps = fitbit_client.get_fitbit_steps_range("token-abc", date(2025, 2, 10), date(2025, 2, 12))
+
+    assert steps == {"2025-02-10": 1000, "2025-02-11": 2000, "2025-02-12": 0}
+    assert len(stub_server.requests_seen) == 1
+
+
+def test_garmin_steps_range_fetches_each_day(stub_server):
+    """Garmin has no range endpoint, so each day in the range is fetched"""
+    stub_server.routes[("GET", "/wellness-service/wellness/dailySummary")] = (200, {"steps": 500})
+
+    steps = garmin_client.get_garmin_steps_range("token-xyz", date(2025, 2, 10), date(2025, 2, 13))
+
+    assert steps == {"2025-02-10": 500, "2025-02-11": 500, "2025-02-12": 500, "2025-02-13": 500}
+    assert len(stub_server.requests_seen) == 4
+
+
+def test_device_sync_range_uses_range_fetch(client, stub_server):
+    """Manual sync with start_date/end_date costs one Fitbit call for the whole range"""
+    from device_storage import store_device_tokens
+    from storage import create_competition, create_team
+    store_device_tokens("range-sync@example.com", "fitbit", {"access_token": "token-abc"})
+    create_competition("range-sync-comp", {"comp_id": "range-sync-comp", "status": "ACTIVE", "start_date": "2025-02-10", "end_date": "2025-02-28"})
+    create_team("range-sync-team", "Range Sync", "range-sync@example.com", comp_id="range-sync-comp")
+    # The range is clamped to the competition, which starts on the 10th
+    stub_server.routes[("GET", "/1/user/-/activities/steps/date/2025-02-10/2025-02-11.json")] = (200, {
+        "activities-steps": [
+            {"dateTime": "2025-02-10", "value": "1500"},
+            {"dateTime": "2025-02-11", "value": "2500"},
+        ]
+    })
+
+    response = client.post(
+        "/devices/fitbit/sync?start_date=2025-02-01&end_date=2025-02-11",
+        headers={"X-Dev-User": "range-sync@example.com"},
+    )
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["days"] == {"2025-02-10": 1500, "2025-02-11": 2500}
+    assert data["steps"] == 4000
+    assert data["date"] == "2025-02-10"
+    assert len(stub_server.requests_seen) == 1
+
+
+def test_device_sync_of_past_range_keeps_last_sync(client, stub_server):
+    """A manual sync of a past range leaves last_sync alone; one through yesterday advances it"""
+    from datetime import timedelta
+    from device_storage import store_device_tokens, update_device_sync_time, get_device_tokens
+    uid = "past-range@example.com"
+    store_device_tokens(uid, "fitbit", {"access_token": "token-abc"})
+    update_device_sync_time(uid, "fitbit", datetime(2025, 3, 1))
+    yesterday = date.today() - timedelta(days=1)
+
+    response = client.post(
+        "/devices/fitbit/sync?start_date=2025-02-10&end_date=2025-02-10",
+        headers={"X-Dev-User": uid},
+    )
+
+    assert response.status_code == 200
+    assert get_device_tokens(uid, "fitbit")["last_sync"] == "2025-03-01T00:00:00"
+
+    response = client.post(
+        f"/devices/fitbit/sync?start_date={yesterday.isoformat()}&end_date={yesterday.isoformat()}",
+        headers={"X-Dev-User": uid},
+    )
+
+    assert response.status_code == 200
+    assert get_device_tokens(uid, "fitbit")["last_sync"] > datetime.combine(yesterday, datetime.min.time()).isoformat()
+
+
+def test_device_sync_rejects_long_ranges(client, stub_server):
+    """Ranges longer than MAX_CATCHUP_DAYS are rejected before any provider call"""
+    from device_storage import store_device_tokens
+    store_device_tokens("long-range@example.com", "garmin", {"access_token": "token-abc"})
+
+    response = client.post(
+        "/devices/garmin/sync?start_date=2024-01-01&end_date=2025-01-01",
+        headers={"X-Dev-User": "long-range@example.com"},
+    )
+
+    assert response.status_code == 400
+    assert stub_server.requests_seen == []
+
+
+def test_token_refresh_is_single_flight(monkeypatch):
+    """Concurrent callers with an expiring token trigger exactly one refresh"""
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    import token_manager
+    from device_storage import store_device_tokens, update_device_sync_time, get_device_tokens
+
+    uid = "single-flight@example.com"
+    store_device_tokens(uid, "fitbit", {
+        "access_token": "old-access",
+        "refresh_token": "old-refresh",
+        "expires_at": time.time() + 60,  # Inside the refresh skew window
+    })
+    update_device_sync_time(uid, "fitbit")
+    last_sync = get_device_tokens(uid, "fitbit")["last_sync"]
+
+    calls = []
+
+    def fake_refresh(refresh_token):
+        calls.append(refresh_token)
+        time.sleep(0.2)
+        return {"access_token": "new-access", "refresh_token": "new-refresh", "expires_at": time.time() + 28800}
+
+    monkeypatch.setattr(token_manager, "refresh_fitbit_token", fake_refresh)
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(lambda _: token_manager.ensure_fresh_tokens(uid, "fitbit"), range(5)))
+
+    assert calls == ["old-refresh"]
+    assert {r["access_token"] for r in results} == {"new-access"}
+    # Refreshing only replaces tokens, link metadata is kept
+    assert get_device_tokens(uid, "fitbit")["last_sync"] == last_sync
+
+
+def test_refresh_expiring_tokens_skips_fresh_devices(monkeypatch):
+    """Cron-start refresh only touches devices expiring within the window"""
+    import time
+    import token_manager
+    from device_storage import store_device_tokens, get_device_tokens
+
+    store_device_tokens("fresh@example.com", "fitbit", {"access_token": "a", "refresh_token": "r1", "expires_at": time.time() + 86400})
+    store_device_tokens("expiring@example.com", "fitbit", {"access_token": "b", "refresh_token": "r2", "expires_at": time.time() + 120})
+    monkeypatch.setattr(token_manager, "refresh_fitbit_token", lambda rt: {"access_token": f"new-{rt}", "refresh_token": rt, "expires_at": time.time() + 28800})
+
+    devices = [get_device_tokens("fresh@example.com", "fitbit"), get_device_tokens("expiring@example.com", "fitbit")]
+    summary = token_manager.refresh_expiring_tokens(devices, window_seconds=3600)
+
+    assert summary["due"] == 1
+    assert summary["refreshed"] == 1
+    assert get_device_tokens("expiring@example.com", "fitbit")["tokens"]["access_token"] == "new-r2"
+    assert get_device_tokens("fresh@example.com", "fitbit")["tokens"]["access_token"] == "a"
+
+
+def test_refresh_locks_are_a_fixed_striped_table():
+    """Every device maps onto the same bounded set of locks"""
+    import token_manager
+
+    locks = {id(token_manager._refresh_lock(f"stripe{i}@example.com", "fitbit")) for i in range(1000)}
+    assert len(token_manager._refresh_locks) == token_manager.TOKEN_REFRESH_LOCK_STRIPES
+    assert len(locks) <= token_manager.TOKEN_REFRESH_LOCK_STRIPES
+    assert token_manager._refresh_lock("same@example.com", "fitbit") is token_manager._refresh_lock("same@example.com", "fitbit")
+
+
+def test_fitbit_429_defers_with_retry_after(stub_server):
+    """A 429 with a long Retry-After raises RateLimitExceeded and blocks further calls without hitting Fitbit"""
+    import rate_limiter
+    rate_limiter.reset_rate_limits()
+    stub_server.routes[("GET", "/1/user/-/activities/date/2025-02-10.json")] = (429, {"errors": []}, {"Retry-After": "120"})
+
+    with pytest.raises(rate_limiter.RateLimitExceeded) as excinfo:
+        fitbit_client.get_fitbit_daily_steps("token-abc", date(2025, 2, 10), uid="quota@example.com")
+    assert excinfo.value.retry_after == 120
+
+    # The user's bucket is blocked, so the next call is deferred locally
+    with pytest.raises(rate_limiter.RateLimitExceeded):
+        fitbit_client.get_fitbit_daily_steps("token-abc", date(2025, 2, 10), uid="quota@example.com")
+    assert len(stub_server.requests_seen) == 1
+    assert rate_limiter.rate_limit_stats()["fitbit"]["throttled"] == 1
+    rate_limiter.reset_rate_limits()
+
+
+def test_fitbit_user_quota_follows_headers(stub_server, monkeypatch):
+    """Fitbit-Rate-Limit-Remaining clamps the user's bucket so an exhausted user is deferred up front"""
+    import rate_limiter
+    rate_limiter.reset_rate_limits()
+    stub_server.routes[("GET", "/1/user/-/activities/date/2025-02-10.json")] = (
+        200, {"summary": {"steps": 10}}, {"Fitbit-Rate-Limit-Remaining": "0", "Fitbit-Rate-Limit-Reset": "900"}
+    )
+
+    assert fitbit_client.get_fitbit_daily_steps("token-abc", date(2025, 2, 10), uid="exhausted@example.com") == 10
+    with pytest.raises(rate_limiter.RateLimitExceeded):
+        fitbit_client.get_fitbit_daily_steps("token-abc", date(2025, 2, 10), uid="exhausted@example.com")
+    # Other users keep their own quota
+    assert fitbit_client.get_fitbit_daily_steps("token-def", date(2025, 2, 10), uid="other@example.com") == 10
+    assert len(stub_server.requests_seen) == 2
+    rate_limiter.reset_rate_limits()
+
+
+def test_circuit_breaker_fails_fast_and_recovers(stub_server):
+    """After repeated 5xx the breaker opens and skips the provider, then a probe closes it again"""
+    import time
+    import rate_limiter
+    from circuit_breaker import CircuitBreaker, CircuitOpenError, set_breaker, OPEN, CLOSED
+    rate_limiter.reset_rate_limits()
+    breaker = CircuitBreaker("garmin", window_size=4, min_calls=3, failure_rate=0.5, open_seconds=0.2)
+    set_breaker("garmin", breaker)
+    stub_server.routes[("GET", "/wellness-service/wellness/dailySummary")] = (503, {"error": "down"})
+
+    try:
+        for _ in range(3):
+            with pytest.raises(ValueError, match="Failed to fetch Garmin data"):
+                garmin_client.get_garmin_daily_steps("token-xyz", date(2025, 2, 10))
+        assert breaker.state == OPEN
+
+        # Open: no request reaches the provider
+        with pytest.raises(CircuitOpenError):
+            garmin_client.get_garmin_daily_steps("token-xyz", date(2025, 2, 10))
+        assert len(stub_server.requests_seen) == 3
+
+        # After the open period a single probe goes through and closes the breaker
+        stub_server.routes[("GET", "/wellness-service/wellness/dailySummary")] = (200, {"steps": 42})
+        time.sleep(0.25)
+        assert garmin_client.get_garmin_daily_steps("token-xyz", date(2025, 2, 10)) == 42
+        assert breaker.state == CLOSED
+        assert len(stub_server.requests_seen) == 4
+    finally:
+        set_breaker("garmin", None)
+        rate_limiter.reset_rate_limits()
+
+
+def test_device_sync_retry_after_refresh_keeps_rate_limit_status(client, monkeypatch):
+    """A rate limit hit by the retry after a token refresh is a 429, not a reconnect prompt"""
+    import main
+    from device_storage import store_device_tokens
+    from rate_limiter import RateLimitExceeded
+    store_device_tokens("retry-limit@example.com", "fitbit", {"access_token": "old", "refresh_token": "r"})
+
+    calls = []
+
+    def fake_daily_steps(token, day, uid=None):
+        calls.append(token)
+        if token == "old":
+            raise ValueError("Fitbit access token expired")
+        raise RateLimitExceeded("fitbit", 30)
+
+    monkeypatch.setattr(main, "get_fitbit_daily_steps", fake_daily_steps)
+    monkeypatch.setattr(main, "ensure_fresh_tokens", lambda uid, provider, **kwargs: {"access_token": "old" if "device_data" in kwargs else "new", "refresh_token": "r"})
+
+    response = client.post("/devices/fitbit/sync?date=2025-02-10", headers={"X-Dev-User": "retry-limit@example.com"})
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "30"
+    assert calls == ["old", "new"]
@@ -0,0 +1,102 @@
+"""
+Unit tests for the SQL leaderboard path (local SQLite engine)
+"""
+import pytest
+
+import leaderboard_engine
+from leaderboard_engine import SqliteLeaderboardEngine, set_leaderboard_engine
+from storage import TEAMS, create_team, join_team, write_daily_steps, individual_leaderboard, team_leaderboard
+
+
+@pytest.fixture
+def sql_competition(monkeypatch):
+    """Two teams in one competition, plus steps from a user outside it"""
+    set_leaderboard_engine(SqliteLeaderboardEngine(":memory:"))
+    if "sql-lb-a" not in TEAMS:
+        create_team("sql-lb-a", "Alpha", "sql-a1@example.com", "sql-lb-comp")
+        join_team("sql-lb-a", "sql-a2@example.com")
+        create_team("sql-lb-b", "Beta", "sql-b1@example.com", "sql-lb-comp")
+
+    for uid, day, steps in [
+        ("sql-a1@example.com", "2025-03-01", 5000),
+        ("sql-a1@example.com", "2025-03-02", 7000),
+        ("sql-a2@example.com", "2025-03-02", 9000),
+        ("sql-b1@example.com", "2025-03-01", 15000),
+        ("sql-outsider@example.com", "2025-03-01", 99999),
+    ]:
+        write_daily_steps(uid, day, steps)
+    yield monkeypatch
+    set_leaderboard_engine(None)
+
+
+@pytest.mark.parametrize("filters", [{}, {"date": "2025-03-02"}, {"start_date": "2025-03-02", "end_date": "2025-03-31"}])
+def test_sql_leaderboards_match_python_scan(sql_competition, filters):
+    """Forcing the SQL engine gives the same rankings as the document scan"""
+    sql_competition.setattr(leaderboard_engine, "LEADERBOARD_ENGINE", "python")
+    python_individual = individual_leaderboard(comp_id="sql-lb-comp", **filters)
+    python_teams = team_leaderboard(comp_id="sql-lb-comp", **filters)
+
+    sql_competition.setattr(leaderboard_engine, "LEADERBOARD_ENGINE", "sql")
+    assert individual_leaderboard(comp_id="sql-lb-comp", **filters) == python_individual
+    assert _without_zero_members(team_leaderboard(comp_id="sql-lb-comp", **filters)) == _without_zero_members(python_teams)
+
+
+def _without_zero_members(rows):
+    # The local single-day scan lists members without steps as 0, SQL (like Firestore) omits them
+    return [{**row, "member_steps": {uid: steps for uid, steps in row["member_steps"].items() if steps}} for row in rows]
+
+
+def test_size_threshold_selects_sql(sql_competition):
+    """In auto mode the SQL path only kicks in at LEADERBOARD_SQL_MIN_ROWS"""
+    sql_competition.setattr(leaderboard_engine, "LEADERBOARD_ENGINE", "auto")
+    sql_competition.setattr(leaderboard_engine, "LEADERBOARD_SQL_MIN_ROWS", 10**9)
+    assert not leaderboard_engine.use_sql_leaderboard(1000)
+
+    sql_competition.setattr(leaderboard_engine, "LEADERBOARD_SQL_MIN_ROWS", 1)
+    rows = individual_leaderboard(comp_id="sql-lb-comp")
+
+    assert [(row["user_id"], row["steps"], row["rank"]) for row in rows] == [
+        ("sql-b1@example.com", 15000, 1),
+        ("sql-a1@example.com", 12000, 2),
+        ("sql-a2@example.com", 9000, 3),
+    ]
+
+
+def test_scan_size_counted_only_in_auto_mode(sql_competition):
+    """A fixed engine never counts the scan; auto mode does"""
+    counted = []
+    count_rows = lambda: counted.append(1) or 10
+
+    for engine, expected in [("sql", True), ("python", False)]:
+        sql_competition.setattr(leaderboard_engine, "LEADERBOARD_ENGINE", engine)
+        assert leaderboard_engine.use_sql_leaderboard(count_rows) is expected
+    assert counted == []
+
+    sql_competition.setattr(leaderboard_engine, "LEADERBOARD_ENGINE", "auto")
+    sql_competition.setattr(leaderboard_engine, "LEADERBOARD_SQL_MIN_ROWS", 5)
+    assert leaderboard_engine.use_sql_leaderboard(count_rows)
+    assert counted == [1]
+
+
+def test_bigquery_engine_reads_curated_table_and_uncompacted_tail():
+    """Duplicate fact rows are only read for the days compaction still revisits"""
+    from datetime import date, timedelta
+    from bq_compaction import COMPACTION_LOOKBACK_DAYS
+
+    class FakeJob:
+        def result(self):
+            return [{"team_id": "t1", "user_id": "u1", "steps": 42}]
+
+    class FakeClient:
+        def query(self, sql, job_config=None):
+            self.sql = sql
+            self.params = {p.name: getattr(p, "value", None) for p in job_config.query_parameters}
+            return FakeJob()
+
+    client = FakeClient()
+    rows = leaderboard_engine.BigQueryLeaderboardEngine(client, dataset="ds").member_totals([("u1", "t1")], start_date="2025-03-01", end_date="2025-03-31")
+
+    assert rows == [{"team_id": "t1", "user_id": "u1", "steps": 42}]
+    assert "`ds.daily_steps_curated`" in client.sql
+    assert "GREATEST(@start_date, @tail_start)" in client.sql
+    assert client.params["tail_start"] == date.today() - timedelta(days=COMPACTION_LOOKBACK_DAYS)
@@ -0,0 +1,54 @@
+"""
+Unit tests for the Arrow read-model export
+"""
+import json
+from datetime import date
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.ipc as ipc
+
+from read_model_export import export_competition
+from storage import COMPETITIONS, TEAMS, create_competition, create_team, join_team, write_daily_steps
+
+
+def _read_steps(root, manifest):
+    rows = []
+    for part in manifest["steps_parts"]:
+        table = ipc.open_file(pa.memory_map(f"{root}/rm-comp/{part['path']}", "r")).read_all()
+        rows.extend(zip(table.column("user_id").to_pylist(), [d.isoformat() for d in table.column("date").to_pylist()], table.column("steps").to_pylist()))
+    return sorted(rows)
+
+
+def test_incremental_export_publishes_consistent_versions(tmp_path):
+    """New versions append recent days, pick up late submissions and move CURRENT"""
+    if "rm-comp" not in COMPETITIONS:
+        create_competition("rm-comp", {
+            "comp_id": "rm-comp",
+            "status": "ACTIVE",
+            "registration_open_date": "2025-05-01",
+            "start_date": "2025-05-01",
+            "end_date": "2025-05-31",
+        })
+    if "rm-team" not in TEAMS:
+        create_team("rm-team", "Mappers", "rm-a@example.com", "rm-comp")
+        join_team("rm-team", "rm-b@example.com")
+    for day in range(1, 6):
+        write_daily_steps("rm-a@example.com", f"2025-05-{day:02d}", 1000 * day)
+    write_daily_steps("rm-outsider@example.com", "2025-05-02", 123)
+
+    first = export_competition("rm-comp", through=date(2025, 5, 4), root=str(tmp_path))
+    assert first["version"] == 1
+    assert len(_read_steps(tmp_path, first)) == 4
+
+    # A late submission for an already exported day and a new day
+    write_daily_steps("rm-b@example.com", "2025-05-04", 4444)
+    second = export_competition("rm-comp", through=date(2025, 5, 5), root=str(tmp_path))
+
+    assert second["version"] == 2
+    assert json.loads((tmp_path / "rm-comp" / "CURRENT").read_text())["version"] == 2
+    assert ("rm-b@example.com", "2025-05-04", 4444) in _read_steps(tmp_path, second)
+    assert len(_read_steps(tmp_path, second)) == 6
+    # Only the recompute window was exported again
+    assert [(part["start"], part["end"]) for part in second["steps_parts"]] == [("2025-05-01", "2025-05-01"), ("2025-05-02", "2025-05-05")]
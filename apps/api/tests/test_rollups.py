@@ -0,0 +1,89 @@
+"""
+Unit tests for the daily competition rollups
+"""
+from datetime import date
+
+from rollups import competitions_running_on, run_daily_rollups, get_daily_rollups, summarize_rollups
+from storage import COMPETITIONS, TEAMS, create_competition, create_team, join_team, write_daily_steps
+
+
+def _rollup_competition():
+    if "rollup-comp" not in COMPETITIONS:
+        create_competition("rollup-comp", {
+            "comp_id": "rollup-comp",
+            "name": "Rollup Cup",
+            "status": "ENDED",
+            "registration_open_date": "2025-04-01",
+            "start_date": "2025-04-10",
+            "end_date": "2025-04-20",
+        })
+    if "rollup-red" not in TEAMS:
+        create_team("rollup-red", "Red", "rollup-r1@example.com", "rollup-comp")
+        join_team("rollup-red", "rollup-r2@example.com")
+        create_team("rollup-blue", "Blue", "rollup-b1@example.com", "rollup-comp")
+
+    write_daily_steps("rollup-r1@example.com", "2025-04-10", 8000)
+    write_daily_steps("rollup-r2@example.com", "2025-04-10", 4000)
+    write_daily_steps("rollup-b1@example.com", "2025-04-11", 11000)
+    write_daily_steps("rollup-stranger@example.com", "2025-04-10", 50000)
+
+
+def test_rollups_aggregate_each_competition_day():
+    """Totals, submitters and per-team/per-user sums only count competition members"""
+    _rollup_competition()
+
+    run_daily_rollups(through=date(2025, 4, 11), days=3)
+    rollups = get_daily_rollups("rollup-comp")
+
+    # 2025-04-09 is before the competition started
+    assert [r["date"] for r in rollups] == ["2025-04-10", "2025-04-11"]
+    first = rollups[0]
+    assert first["total_steps"] == 12000
+    assert first["active_submitters"] == 2
+    assert first["member_count"] == 3
+    assert first["team_totals"] == {"rollup-red": 12000, "rollup-blue": 0}
+    # Per-user totals only go to BigQuery, the summary documents stay small
+    assert "user_totals" not in first
+
+    summary = summarize_rollups(rollups)
+    assert summary["total_steps"] == 23000
+    assert summary["peak_active_submitters"] == 2
+    assert summary["peak_day"] == {"date": "2025-04-10", "total_steps": 12000}
+    assert summary["team_totals"] == {"rollup-red": 12000, "rollup-blue": 11000}
+
+
+def test_rollups_skip_competitions_not_receiving_steps():
+    """Drafts and competitions past their grace period are not rolled up"""
+    create_competition("rollup-draft", {
+        "comp_id": "rollup-draft",
+        "status": "DRAFT",
+        "start_date": "2025-05-01",
+        "end_date": "2025-05-10",
+    })
+    create_competition("rollup-ended", {
+        "comp_id": "rollup-ended",
+        "status": "ENDED",
+        "start_date": "2025-05-01",
+        "end_date": "2025-05-03",
+    })
+
+    # 2025-05-05 is the last grace day of rollup-ended (GRACE_DAYS=2)
+    def rolled_up(through):
+        return [c["comp_id"] for c in competitions_running_on(date(2025, 5, 3), through) if c["comp_id"].startswith("rollup-")]
+
+    assert rolled_up(date(2025, 5, 5)) == ["rollup-ended"]
+    assert rolled_up(date(2025, 5, 6)) == []
+
+
+def test_stats_endpoint_reads_rollups(client, admin_headers, member_headers):
+    """Admins get the summary and daily trend, members are refused"""
+    _rollup_competition()
+    run_daily_rollups(through=date(2025, 4, 11), days=2)
+
+    assert client.get("/competitions/rollup-comp/stats", headers=member_headers).status_code == 403
+
+    response = client.get("/competitions/rollup-comp/stats", headers=admin_headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["summary"]["total_steps"] == 23000
+    assert [point["total_steps"] for point in data["trend"]] == [12000, 11000]
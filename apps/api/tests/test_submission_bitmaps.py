@@ -0,0 +1,71 @@
+"""
+Unit tests for the daily submission bitmaps
+"""
+from datetime import date
+
+from rollups import run_daily_rollups
+from storage import COMPETITIONS, TEAMS, create_competition, create_team, join_team, write_daily_steps
+import submission_bitmaps
+from submission_bitmaps import member_positions, missing_members, record_submissions, record_submission_groups, get_submission_bitmap
+
+
+def test_missing_members_is_the_bitmap_difference():
+    """Submitters are set as they arrive; members never seen count as missing"""
+    members = ["bits-a@example.com", "bits-b@example.com", "bits-c@example.com"]
+    assert missing_members("bits-comp", "2025-06-01", members) is None
+
+    record_submissions("bits-comp", "2025-06-01", ["bits-b@example.com"])
+    record_submissions("bits-comp", "2025-06-01", ["bits-b@example.com", "bits-a@example.com"])
+    record_submissions("bits-comp", "2025-06-02", ["bits-c@example.com"])
+
+    assert missing_members("bits-comp", "2025-06-01", members) == {"bits-c@example.com"}
+    assert missing_members("bits-comp", "2025-06-02", members + ["bits-new@example.com"]) == {
+        "bits-a@example.com", "bits-b@example.com", "bits-new@example.com"
+    }
+    # Interned positions never move
+    assert member_positions("bits-comp", ["bits-b@example.com", "bits-a@example.com", "bits-c@example.com"]) == {
+        "bits-b@example.com": 0, "bits-a@example.com": 1, "bits-c@example.com": 2
+    }
+
+
+def test_rollups_rebuild_bitmaps_from_step_facts():
+    """Steps written outside ingest are picked up when the rollup job recomputes the day"""
+    if "bits-rollup" not in COMPETITIONS:
+        create_competition("bits-rollup", {
+            "comp_id": "bits-rollup",
+            "status": "ENDED",
+            "registration_open_date": "2025-03-01",
+            "start_date": "2025-03-01",
+            "end_date": "2025-03-10",
+        })
+    if "bits-team" not in TEAMS:
+        create_team("bits-team", "Bits", "bits-r1@example.com", "bits-rollup")
+        join_team("bits-team", "bits-r2@example.com")
+
+    write_daily_steps("bits-r2@example.com", "2025-03-05", 3000)
+    assert get_submission_bitmap("bits-rollup", "2025-03-05") is None
+    run_daily_rollups(through=date(2025, 3, 5), days=1)
+
+    assert missing_members("bits-rollup", "2025-03-05", ["bits-r1@example.com", "bits-r2@example.com"]) == {"bits-r1@example.com"}
+
+
+def test_submission_groups_write_each_competition_day_once(monkeypatch):
+    """A sync's submissions are grouped so every competition day is written once"""
+    writes = []
+    original = submission_bitmaps.record_submissions
+    monkeypatch.setattr(submission_bitmaps, "record_submissions", lambda comp_id, date, uids: writes.append((comp_id, date, uids)) or original(comp_id, date, uids))
+
+    days = record_submission_groups([
+        ("group-comp", "2025-07-01", "group-a@example.com"),
+        ("group-comp", "2025-07-01", "group-b@example.com"),
+        ("group-comp", "2025-07-02", "group-a@example.com"),
+        ("group-comp", "2025-07-01", "group-a@example.com"),
+    ])
+
+    assert days == 2
+    assert sorted(writes) == [
+        ("group-comp", "2025-07-01", ["group-a@example.com", "group-b@example.com"]),
+        ("group-comp", "2025-07-02", ["group-a@example.com"]),
+    ]
+    assert missing_members("group-comp", "2025-07-02", ["group-a@example.com", "group-b@example.com"]) == {"group-b@example.com"}
+
@@ -0,0 +1,68 @@
+"""
+Unit tests for the device sync shard leases
+"""
+import sync_leases
+import time
+from sync_leases import shard_for_uid, claim_sync_lease, complete_sync_lease, release_sync_lease, renew_sync_lease, LeaseHeartbeat
+
+
+def test_shard_assignment_is_stable_and_in_range():
+    """Same uid always maps to the same shard, within bounds"""
+    uids = [f"user{i}@example.com" for i in range(200)]
+    shards = [shard_for_uid(uid, 8) for uid in uids]
+
+    assert shards == [shard_for_uid(uid, 8) for uid in uids]
+    assert set(shards) == set(range(8))
+    assert shard_for_uid("user0@example.com", 1) == 0
+
+
+def test_lease_claimed_by_one_owner_only():
+    """A held lease can't be claimed by another instance, a finished shard by no one"""
+    assert claim_sync_lease("run-a", 0, "worker-1", ttl_seconds=60)
+    assert not claim_sync_lease("run-a", 0, "worker-2", ttl_seconds=60)
+    # Other shards and other runs are independent
+    assert claim_sync_lease("run-a", 1, "worker-2", ttl_seconds=60)
+    assert claim_sync_lease("run-b", 0, "worker-2", ttl_seconds=60)
+
+    assert complete_sync_lease("run-a", 0, "worker-1", {"devices": 3})
+    assert not claim_sync_lease("run-a", 0, "worker-1", ttl_seconds=60)
+    assert sync_leases.SYNC_LEASES["run-a_0"]["status"] == "done"
+
+
+def test_expired_lease_is_reclaimed():
+    """A shard abandoned by a crashed instance is picked up once its lease expires"""
+    assert claim_sync_lease("run-c", 0, "crashed", ttl_seconds=0)
+    assert claim_sync_lease("run-c", 0, "worker-2", ttl_seconds=60)
+    assert sync_leases.SYNC_LEASES["run-c_0"]["attempts"] == 2
+    # The old owner can no longer extend it
+    assert not renew_sync_lease("run-c", 0, "crashed", ttl_seconds=60)
+
+
+def test_released_lease_is_immediately_claimable():
+    """Releasing after a failure lets another instance retry without waiting"""
+    assert claim_sync_lease("run-d", 0, "worker-1", ttl_seconds=600)
+    release_sync_lease("run-d", 0, "worker-1")
+    assert claim_sync_lease("run-d", 0, "worker-2", ttl_seconds=600)
+
+
+def test_completion_rejected_after_lease_lost():
+    """An owner whose expired lease was claimed by another instance can't mark the shard done"""
+    assert claim_sync_lease("run-e", 0, "slow-worker", ttl_seconds=0)
+    assert claim_sync_lease("run-e", 0, "worker-2", ttl_seconds=60)
+
+    assert not complete_sync_lease("run-e", 0, "slow-worker", {"devices": 1})
+    lease = sync_leases.SYNC_LEASES["run-e_0"]
+    assert lease["owner"] == "worker-2"
+    assert lease["status"] == "running"
+
+    assert complete_sync_lease("run-e", 0, "worker-2", {"devices": 1})
+    assert sync_leases.SYNC_LEASES["run-e_0"]["status"] == "done"
+
+
+def test_heartbeat_reports_lost_lease():
+    """The heartbeat sets its lost event once renewal finds another owner"""
+    assert claim_sync_lease("run-f", 0, "worker-1", ttl_seconds=3)
+    with LeaseHeartbeat("run-f", 0, "worker-1", ttl_seconds=3) as heartbeat:
+        sync_leases.SYNC_LEASES["run-f_0"]["owner"] = "worker-2"
+        assert heartbeat.lost_event.wait(timeout=5)
+    assert heartbeat.lost
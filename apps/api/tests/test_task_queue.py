@@ -0,0 +1,41 @@
+"""
+Unit tests for the local device sync task queue
+"""
+from task_queue import LocalTaskQueue
+
+
+def test_failed_task_is_retried_until_it_succeeds():
+    """A handler failure is retried with backoff instead of being lost"""
+    attempts = []
+
+    def handler(task):
+        attempts.append(task["uid"])
+        if len(attempts) < 3:
+            raise RuntimeError("provider unavailable")
+
+    queue = LocalTaskQueue(handler, workers=1, max_attempts=5, min_backoff=0.01, max_backoff=0.05)
+    queue.enqueue({"uid": "retry@example.com", "provider": "fitbit"})
+
+    assert queue.join(timeout=5)
+    assert attempts == ["retry@example.com"] * 3
+    assert queue.stats() == {"pending": 0, "completed": 1, "retried": 2, "dead_lettered": 0}
+
+
+def test_task_is_dead_lettered_after_max_attempts():
+    """A task that keeps failing ends up in dead_letters without blocking others"""
+    done = []
+
+    def handler(task):
+        if task["uid"] == "broken@example.com":
+            raise RuntimeError("always fails")
+        done.append(task["uid"])
+
+    queue = LocalTaskQueue(handler, workers=2, max_attempts=3, min_backoff=0.01, max_backoff=0.02)
+    queue.enqueue({"uid": "broken@example.com", "provider": "garmin"})
+    queue.enqueue({"uid": "ok@example.com", "provider": "garmin"})
+
+    assert queue.join(timeout=5)
+    assert done == ["ok@example.com"]
+    assert len(queue.dead_letters) == 1
+    assert queue.dead_letters[0]["attempts"] == 3
+    assert queue.dead_letters[0]["task"]["uid"] == "broken@example.com"
@@ -0,0 +1,125 @@
+"""
+Unit tests for the provider webhook endpoints
+"""
+import json
+import hmac
+import base64
+import hashlib
+from datetime import date, timedelta
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import fitbit_client
+import webhooks
+from device_storage import store_device_tokens, set_device_subscription, find_device
+
+
+@pytest.fixture
+def webhook_client(monkeypatch):
+    """App with only the webhook routes, capturing enqueued tasks"""
+    enqueued = []
+
+    def capture(tasks):
+        enqueued.extend(tasks)
+        return {"queue": "test", "count": len(tasks)}
+
+    monkeypatch.setattr(fitbit_client, "FITBIT_CLIENT_SECRET", "client-secret")
+    monkeypatch.setattr(webhooks, "FITBIT_SUBSCRIBER_VERIFY_CODE", "verify-me")
+    monkeypatch.setattr(webhooks, "GARMIN_WEBHOOK_SECRET", "garmin-secret")
+
+    app = FastAPI()
+    app.include_router(webhooks.create_webhook_router(capture, find_device, lambda: True))
+    client = TestClient(app)
+    client.enqueued = enqueued
+    return client
+
+
+def _fitbit_signature(body: bytes) -> str:
+    return base64.b64encode(hmac.new(b"client-secret&", body, hashlib.sha1).digest()).decode()
+
+
+def test_fitbit_subscriber_verification(webhook_client):
+    """The verify code gets 204, anything else 404"""
+    assert webhook_client.get("/webhooks/fitbit?verify=verify-me").status_code == 204
+    assert webhook_client.get("/webhooks/fitbit?verify=wrong").status_code == 404
+
+
+def test_fitbit_notification_enqueues_changed_days(webhook_client):
+    """A signed notification enqueues one task for the subscribed user covering the changed days"""
+    uid = "webhook-fitbit@example.com"
+    store_device_tokens(uid, "fitbit", {"access_token": "a"})
+    set_device_subscription(uid, "fitbit", fitbit_client.fitbit_subscription_id(uid))
+    today = date.today()
+    body = json.dumps([
+        {"collectionType": "activities", "date": (today - timedelta(days=1)).isoformat(), "subscriptionId": fitbit_client.fitbit_subscription_id(uid)},
+        {"collectionType": "activities", "date": today.isoformat(), "subscriptionId": fitbit_client.fitbit_subscription_id(uid)},
+        {"collectionType": "activities", "date": today.isoformat(), "subscriptionId": "unknown"},
+    ]).encode("utf-8")
+
+    response = webhook_client.post("/webhooks/fitbit", content=body, headers={"X-Fitbit-Signature": _fitbit_signature(body)})
+
+    assert response.status_code == 204
+    assert webhook_client.enqueued == [{
+        "uid": uid,
+        "provider": "fitbit",
+        "start": (today - timedelta(days=1)).isoformat(),
+        "end": today.isoformat(),
+        "source": "webhook",
+    }]
+
+
+def test_fitbit_notification_refreshes_expiring_token_before_enqueueing(webhook_client, monkeypatch):
+    """The queued sync task finds fresh tokens instead of refreshing on its critical path"""
+    import time
+    import token_manager
+    from device_storage import get_device_tokens
+
+    uid = "webhook-refresh@example.com"
+    store_device_tokens(uid, "fitbit", {"access_token": "old", "refresh_token": "r", "expires_at": time.time() + 120})
+    set_device_subscription(uid, "fitbit", fitbit_client.fitbit_subscription_id(uid))
+    monkeypatch.setattr(token_manager, "refresh_fitbit_token", lambda rt: {"access_token": "new", "refresh_token": rt, "expires_at": time.time() + 28800})
+    body = json.dumps([
+        {"collectionType": "activities", "date": date.today().isoformat(), "subscriptionId": fitbit_client.fitbit_subscription_id(uid)},
+    ]).encode("utf-8")
+
+    response = webhook_client.post("/webhooks/fitbit", content=body, headers={"X-Fitbit-Signature": _fitbit_signature(body)})
+
+    assert response.status_code == 204
+    assert [task["uid"] for task in webhook_client.enqueued] == [uid]
+    assert get_device_tokens(uid, "fitbit")["tokens"]["access_token"] == "new"
+
+
+def test_fitbit_notification_with_bad_signature_is_rejected(webhook_client):
+    """Fitbit expects a 404 for notifications that fail signature verification"""
+    body = b'[{"collectionType": "activities", "date": "2025-02-10", "subscriptionId": "x"}]'
+
+    response = webhook_client.post("/webhooks/fitbit", content=body, headers={"X-Fitbit-Signature": "forged"})
+
+    assert response.status_code == 404
+    assert webhook_client.enqueued == []
+
+
+def test_garmin_push_maps_access_token_to_user(webhook_client):
+    """Garmin dailies are matched to the linked device by access token"""
+    uid = "webhook-garmin@example.com"
+    store_device_tokens(uid, "garmin", {"access_token": "garmin-user-token"})
+    day = date.today().isoformat()
+    body = json.dumps({"dailies": [{"userAccessToken": "garmin-user-token", "calendarDate": day, "steps": 4000}]}).encode("utf-8")
+    signature = hmac.new(b"garmin-secret", body, hashlib.sha256).hexdigest()
+
+    assert webhook_client.post("/webhooks/garmin", content=body).status_code == 401
+    response = webhook_client.post("/webhooks/garmin", content=body, headers={"X-Garmin-Signature": signature})
+
+    assert response.status_code == 200
+    assert webhook_client.enqueued == [{"uid": uid, "provider": "garmin", "start": day, "end": day, "source": "webhook"}]
+
+
+def test_notifications_get_503_without_a_task_queue(client, monkeypatch):
+    """The API without Pub/Sub has no queue for sync tasks, so providers are asked to redeliver"""
+    import task_queue
+    monkeypatch.setattr(task_queue, "_local_queue", None)
+
+    assert client.post("/webhooks/fitbit", content=b"[]").status_code == 503
+    assert client.post("/webhooks/garmin", content=b"{}").status_code == 503
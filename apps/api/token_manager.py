@@ -0,0 +1,187 @@
+"""
+Device OAuth token manager
+
+Refreshes provider access tokens shortly before they expire so device syncs
+never pay for a token refresh on the critical path. Refreshes are single-flight
+per (uid, provider): a per-process lock serialises callers and a claim on the
+device document keeps other instances from refreshing at the same time, which
+matters because Fitbit refresh tokens are single-use.
+"""
+
+import os
+import time
+import zlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Any
+
+from device_storage import get_device_tokens, store_device_tokens, try_claim_token_refresh, release_token_refresh
+from fitbit_client import refresh_fitbit_token
+
+logger = logging.getLogger(__name__)
+
+# Refresh tokens this many seconds before expires_at
+TOKEN_REFRESH_SKEW_SECONDS = int(os.getenv("TOKEN_REFRESH_SKEW_SECONDS", "900"))
+# At the start of a cron run, refresh everything expiring within this window
+TOKEN_PREFETCH_SECONDS = int(os.getenv("TOKEN_PREFETCH_SECONDS", "3600"))
+TOKEN_REFRESH_CONCURRENCY = int(os.getenv("TOKEN_REFRESH_CONCURRENCY", "8"))
+# How long to wait for another instance's in-flight refresh to land
+TOKEN_REFRESH_WAIT_SECONDS = float(os.getenv("TOKEN_REFRESH_WAIT_SECONDS", "10"))
+
+# Devices share a fixed set of single-flight locks, so the table never grows
+TOKEN_REFRESH_LOCK_STRIPES = int(os.getenv("TOKEN_REFRESH_LOCK_STRIPES", "64"))
+
+_refresh_locks: List[threading.Lock] = [threading.Lock() for _ in range(max(1, TOKEN_REFRESH_LOCK_STRIPES))]
+
+
+def _refresh_lock(uid: str, provider: str) -> threading.Lock:
+    """
+    Get the in-process single-flight lock for a device
+
+    Devices hashing to the same stripe refresh one after the other, which is
+    still correct: every holder re-reads storage before refreshing.
+    """
+    return _refresh_locks[zlib.crc32(f"{provider}:{uid}".encode("utf-8")) % len(_refresh_locks)]
+
+
+def needs_refresh(tokens: Dict[str, Any], skew_seconds: int = TOKEN_REFRESH_SKEW_SECONDS) -> bool:
+    """Check whether tokens expire within skew_seconds"""
+    expires_at = tokens.get("expires_at")
+    if not expires_at:
+        return False
+    return datetime.utcnow().timestamp() + skew_seconds >= expires_at
+
+
+def _is_fresh(tokens: Dict[str, Any], skew_seconds: int, rejected_access_token: Optional[str]) -> bool:
+    """Tokens are usable if they differ from a rejected token and aren't about to expire"""
+    if rejected_access_token:
+        return bool(tokens.get("access_token")) and tokens.get("access_token") != rejected_access_token
+    return not needs_refresh(tokens, skew_seconds)
+
+
+def _refresh_tokens(uid: str, provider: str, tokens: Dict[str, Any]) -> Dict[str, Any]:
+    """Call the provider's refresh endpoint and persist the result"""
+    if provider == "garmin":
+        # Garmin OAuth 1.0a doesn't have refresh tokens
+        raise ValueError("Garmin token expired, re-authentication required")
+
+    if provider != "fitbit" or not tokens.get("refresh_token"):
+        raise ValueError(f"{provider.capitalize()} access token expired and no refresh token available")
+
+    logger.info(f"Refreshing {provider} token for user {uid}")
+    new_tokens = refresh_fitbit_token(tokens.get("refresh_token"))
+    store_device_tokens(uid, provider, new_tokens, refresh=True)
+    return new_tokens
+
+
+def ensure_fresh_tokens(
+    uid: str,
+    provider: str,
+    rejected_access_token: Optional[str] = None,
+    skew_seconds: int = TOKEN_REFRESH_SKEW_SECONDS,
+    device_data: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Get a device's tokens, refreshing them first if they are about to expire
+
+    Only one refresh per (uid, provider) is ever in flight. Callers that wait
+    on an in-flight refresh re-read storage and reuse its result instead of
+    refreshing again.
+
+    Args:
+        uid: User ID
+        provider: Provider name ("garmin" or "fitbit")
+        rejected_access_token: Access token the provider just rejected (401),
+            forces a refresh unless storage already holds a different token
+        skew_seconds: Refresh if the token expires within this many seconds
+        device_data: Device record the caller already loaded, saves a read
+
+    Returns:
+        Token data (access_token, refresh_token, expires_at, ...)
+
+    Raises:
+        ValueError: If the device isn't linked or the tokens can't be refreshed
+    """
+    device_data = device_data or get_device_tokens(uid, provider)
+    if not device_data:
+        raise ValueError(f"{provider.capitalize()} device not linked")
+
+    tokens = device_data.get("tokens") or {}
+    if _is_fresh(tokens, skew_seconds, rejected_access_token):
+        return tokens
+
+    # Only Fitbit tokens can be refreshed, others stay usable until they actually expire
+    if provider != "fitbit" and not rejected_access_token and not needs_refresh(tokens, 0):
+        return tokens
+
+    with _refresh_lock(uid, provider):
+        deadline = time.monotonic() + TOKEN_REFRESH_WAIT_SECONDS
+        while True:
+            # Another caller may have refreshed while we waited
+            device_data = get_device_tokens(uid, provider) or device_data
+            tokens = device_data.get("tokens") or {}
+            if _is_fresh(tokens, skew_seconds, rejected_access_token):
+                return tokens
+
+            if try_claim_token_refresh(uid, provider):
+                try:
+                    return _refresh_tokens(uid, provider, tokens)
+                except Exception:
+                    release_token_refresh(uid, provider)
+                    raise
+
+            # Another instance is refreshing, wait for its tokens to land
+            if time.monotonic() >= deadline:
+                raise ValueError(f"Timed out waiting for {provider} token refresh")
+            time.sleep(0.5)
+
+
+def refresh_expiring_tokens(
+    devices: List[Dict[str, Any]],
+    window_seconds: int = TOKEN_PREFETCH_SECONDS
+) -> Dict[str, Any]:
+    """
+    Proactively refresh every device token expiring within window_seconds
+
+    Intended for the start of a cron run so the sync itself never refreshes.
+    Refreshed tokens are written back into the passed device records, so the
+    caller can keep using its device list.
+
+    Args:
+        devices: Device records as returned by get_all_linked_devices()
+        window_seconds: Refresh tokens expiring within this many seconds
+
+    Returns:
+        Summary with checked/refreshed/failed counts and per-device errors
+    """
+    due = [
+        device
+        for device in devices
+        if device.get("uid")
+        and device.get("provider") == "fitbit"
+        and needs_refresh(device.get("tokens") or {}, window_seconds)
+    ]
+
+    summary = {"checked": len(devices), "due": len(due), "refreshed": 0, "failed": 0, "errors": []}
+    if not due:
+        return summary
+
+    def _refresh_one(device: Dict[str, Any]):
+        return ensure_fresh_tokens(device["uid"], device["provider"], skew_seconds=window_seconds)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(TOKEN_REFRESH_CONCURRENCY, len(due)))) as executor:
+        futures = [(device, executor.submit(_refresh_one, device)) for device in due]
+        for device, future in futures:
+            uid, provider = device["uid"], device["provider"]
+            try:
+                device["tokens"] = future.result()
+                summary["refreshed"] += 1
+            except Exception as e:
+                logger.warning(f"Proactive {provider} token refresh failed for user {uid}: {e}")
+                summary["failed"] += 1
+                summary["errors"].append({"uid": uid, "provider": provider, "error": str(e)})
+
+    logger.info(f"Token refresh: {summary['refreshed']} refreshed, {summary['failed']} failed of {summary['due']} due")
+    return summary
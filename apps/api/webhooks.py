@@ -0,0 +1,253 @@
+"""
+Provider push notifications (Fitbit subscriptions, Garmin Health API push)
+
+Instead of polling every linked device, providers tell us which user's data
+changed on which day. Each endpoint verifies the notification, acknowledges
+right away and, after the response is sent, maps the notification to our uid
+and enqueues one device sync task per (uid, provider) covering only the
+changed dates.
+
+The router is mounted on the public API (providers call it in production,
+tasks go to Pub/Sub) and on the sync worker (local development, where tasks
+run on the worker's in-process queue). Where tasks can't be queued (the API
+without Pub/Sub), notifications are answered 503 so the provider redelivers
+them instead of losing the change. scripts/post_sample_webhooks.py posts
+signed sample notifications for local testing.
+"""
+
+import os
+import hmac
+import json
+import base64
+import hashlib
+import logging
+from datetime import date
+from typing import Callable, Dict, List, Optional, Any, Tuple
+
+from fastapi import APIRouter, BackgroundTasks, Request, Response
+
+from device_storage import find_device
+from task_queue import enqueue_device_sync_tasks, can_enqueue_device_sync_tasks
+from token_manager import refresh_expiring_tokens
+
+logger = logging.getLogger(__name__)
+
+GCP_ENABLED = os.getenv("GCP_ENABLED", "false").lower() == "true"
+
+# Code Fitbit sends to verify the subscriber endpoint (set in the Fitbit app settings)
+FITBIT_SUBSCRIBER_VERIFY_CODE = os.getenv("FITBIT_SUBSCRIBER_VERIFY_CODE", "")
+# Shared secret for signing Garmin push requests (set on the Garmin endpoint configuration)
+GARMIN_WEBHOOK_SECRET = os.getenv("GARMIN_WEBHOOK_SECRET", "")
+# Oldest notification date accepted, older changes are left to the nightly catch-up
+WEBHOOK_MAX_AGE_DAYS = int(os.getenv("WEBHOOK_MAX_AGE_DAYS", "7"))
+
+DeviceLookup = Callable[[str, str, Any], Optional[Dict[str, Any]]]
+TaskEnqueuer = Callable[[List[Dict[str, Any]]], Dict[str, Any]]
+QueueCheck = Callable[[], bool]
+
+
+def _fitbit_client_secret() -> str:
+    # Read through the module so tests can point it at a stub configuration
+    import fitbit_client
+    return fitbit_client.FITBIT_CLIENT_SECRET
+
+
+def verify_fitbit_signature(body: bytes, signature: Optional[str]) -> bool:
+    """
+    Check X-Fitbit-Signature: base64 HMAC-SHA1 of the body keyed with "<client secret>&"
+
+    Without a configured client secret this only passes in local dev.
+    """
+    secret = _fitbit_client_secret()
+    if not secret:
+        return not GCP_ENABLED
+    if not signature:
+        return False
+    expected = base64.b64encode(hmac.new(f"{secret}&".encode("utf-8"), body, hashlib.sha1).digest()).decode()
+    return hmac.compare_digest(expected, signature)
+
+
+def verify_garmin_signature(body: bytes, signature: Optional[str]) -> bool:
+    """
+    Check X-Garmin-Signature: hex HMAC-SHA256 of the body keyed with GARMIN_WEBHOOK_SECRET
+
+    Garmin notifications are additionally only accepted for access tokens of
+    linked devices (see parse_garmin_notifications).
+    """
+    if not GARMIN_WEBHOOK_SECRET:
+        return not GCP_ENABLED
+    if not signature:
+        return False
+    expected = hmac.new(GARMIN_WEBHOOK_SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def _parse_day(value: Any) -> Optional[date]:
+    try:
+        day = date.fromisoformat(str(value))
+    except (TypeError, ValueError):
+        return None
+    # Providers date notifications in the user's timezone, which can be a day ahead of ours
+    if (date.today() - day).days > WEBHOOK_MAX_AGE_DAYS or (day - date.today()).days > 1:
+        return None
+    return day
+
+
+def parse_fitbit_notifications(payload: Any, lookup_device: DeviceLookup = find_device) -> List[Tuple[str, str, date]]:
+    """
+    Map Fitbit notifications to (uid, provider, date)
+
+    Payload is a list of {"collectionType", "date", "ownerId", "subscriptionId", ...}.
+    Only activity notifications for known subscriptions are kept.
+    """
+    changes = []
+    for notification in payload if isinstance(payload, list) else []:
+        if notification.get("collectionType") not in ("activities", None):
+            continue
+        day = _parse_day(notification.get("date"))
+        device = lookup_device("fitbit", "subscription_id", notification.get("subscriptionId"))
+        if day is None or device is None:
+            logger.info(f"Ignoring Fitbit notification: {notification}")
+            continue
+        changes.append((device["uid"], "fitbit", day))
+    return changes
+
+
+def parse_garmin_notifications(payload: Any, lookup_device: DeviceLookup = find_device) -> List[Tuple[str, str, date]]:
+    """
+    Map Garmin Health API push/ping notifications to (uid, provider, date)
+
+    Payload is {"dailies": [{"userAccessToken", "calendarDate", ...}], ...}.
+    The user is identified by matching userAccessToken against linked devices.
+    """
+    changes = []
+    summaries = payload.get("dailies", []) if isinstance(payload, dict) else []
+    for summary in summaries:
+        day = _parse_day(summary.get("calendarDate"))
+        device = lookup_device("garmin", "tokens.access_token", summary.get("userAccessToken"))
+        if day is None or device is None:
+            logger.info(f"Ignoring Garmin notification for {summary.get('calendarDate')}")
+            continue
+        changes.append((device["uid"], "garmin", day))
+    return changes
+
+
+def build_webhook_tasks(changes: List[Tuple[str, str, date]]) -> List[Dict[str, Any]]:
+    """Coalesce changed days into one sync task per (uid, provider) spanning those days"""
+    days_by_device: Dict[Tuple[str, str], List[date]] = {}
+    for uid, provider, day in changes:
+        days_by_device.setdefault((uid, provider), []).append(day)
+
+    return [
+        {
+            "uid": uid,
+            "provider": provider,
+            "start": min(days).isoformat(),
+            "end": max(days).isoformat(),
+            "source": "webhook",
+        }
+        for (uid, provider), days in days_by_device.items()
+    ]
+
+
+def _enqueue_changes(provider: str, payload: Any, enqueue_tasks: TaskEnqueuer, lookup_device: DeviceLookup) -> None:
+    """
+    Runs after the response is sent: resolve users and enqueue their sync tasks
+
+    Tokens of the notified devices that expire soon are refreshed here, so the
+    sync task itself doesn't refresh on its critical path.
+    """
+    devices: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def lookup(lookup_provider: str, field: str, value: Any) -> Optional[Dict[str, Any]]:
+        device = lookup_device(lookup_provider, field, value)
+        if device and device.get("uid"):
+            devices[(device["uid"], lookup_provider)] = {**device, "provider": lookup_provider}
+        return device
+
+    try:
+        if provider == "fitbit":
+            changes = parse_fitbit_notifications(payload, lookup)
+        else:
+            changes = parse_garmin_notifications(payload, lookup)
+        tasks = build_webhook_tasks(changes)
+        if tasks:
+            refresh_expiring_tokens(list(devices.values()))
+            result = enqueue_tasks(tasks)
+            logger.info(f"Enqueued {result['count']} {provider} sync tasks from webhook ({result['queue']})")
+    except Exception as e:
+        logger.error(f"Failed to enqueue {provider} webhook changes: {e}", exc_info=True)
+
+
+def create_webhook_router(
+    enqueue_tasks: TaskEnqueuer = enqueue_device_sync_tasks,
+    lookup_device: DeviceLookup = find_device,
+    can_enqueue: QueueCheck = can_enqueue_device_sync_tasks
+) -> APIRouter:
+    """
+    Build the webhook routes
+
+    Args:
+        enqueue_tasks: Enqueues device sync tasks (the hosting service's task queue)
+        lookup_device: Finds a linked device by field (the hosting service's device storage)
+        can_enqueue: Whether enqueue_tasks can take tasks right now; if not, notifications get 503
+    """
+    router = APIRouter()
+
+    @router.get("/webhooks/fitbit")
+    def verify_fitbit_subscriber(verify: str = ""):
+        """
+        Fitbit subscriber verification
+
+        Fitbit calls this with the correct code (expects 204) and a wrong one (expects 404).
+        """
+        if FITBIT_SUBSCRIBER_VERIFY_CODE and hmac.compare_digest(verify, FITBIT_SUBSCRIBER_VERIFY_CODE):
+            return Response(status_code=204)
+        return Response(status_code=404)
+
+    @router.post("/webhooks/fitbit")
+    async def fitbit_webhook(request: Request, background_tasks: BackgroundTasks):
+        """
+        Fitbit subscription notifications
+
+        Must answer within a few seconds, so only the signature is checked inline.
+        Fitbit expects 404 for notifications with an invalid signature.
+        """
+        body = await request.body()
+        if not verify_fitbit_signature(body, request.headers.get("X-Fitbit-Signature")):
+            logger.warning("Rejected Fitbit notification with invalid signature")
+            return Response(status_code=404)
+
+        try:
+            payload = json.loads(body or b"[]")
+        except ValueError:
+            return Response(status_code=400)
+
+        if not can_enqueue():
+            logger.error("Cannot queue sync tasks, asking Fitbit to redeliver the notification")
+            return Response(status_code=503)
+
+        background_tasks.add_task(_enqueue_changes, "fitbit", payload, enqueue_tasks, lookup_device)
+        return Response(status_code=204)
+
+    @router.post("/webhooks/garmin")
+    async def garmin_webhook(request: Request, background_tasks: BackgroundTasks):
+        """Garmin Health API push/ping notifications"""
+        body = await request.body()
+        if not verify_garmin_signature(body, request.headers.get("X-Garmin-Signature")):
+            logger.warning("Rejected Garmin notification with invalid signature")
+            return Response(status_code=401)
+
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            return Response(status_code=400)
+
+        if not can_enqueue():
+            logger.error("Cannot queue sync tasks, asking Garmin to redeliver the notification")
+            return Response(status_code=503)
+
+        background_tasks.add_task(_enqueue_changes, "garmin", payload, enqueue_tasks, lookup_device)
+        return Response(status_code=200)
+
+    return router
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The worker imports the API modules (as api.<module>) and gcp_clients
+APPS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(APPS_DIR, "api"))
+sys.path.insert(0, APPS_DIR)
+
+# Set environment for testing
+os.environ["GCP_ENABLED"] = "false"
+os.environ["COMP_TZ"] = "Europe/Bucharest"
@@ -0,0 +1,181 @@
+"""
+Streaming-pull consumer for the steps.ingest subscription
+
+Alternative to Pub/Sub push (/pubsub/push in worker.py) for high-volume
+periods such as backfills: messages are pulled over one streaming connection
+under flow control, written in batches with worker.write_rows (one Firestore
+batch commit and one BigQuery insert per batch) and acknowledged together once
+the batch is stored. A failed batch is nacked and redelivered; write_rows
+skips events whose idempotency_key was already stored.
+
+SIGTERM/SIGINT flush and ack what is buffered while the stream is still open
+(acks sent after it closes are dropped), then stop the stream and exit, so a
+Cloud Run/Kubernetes shutdown neither drops nor redelivers work.
+
+Run as its own process:
+    python subscriber.py
+"""
+
+import os
+import json
+import signal
+import logging
+import threading
+from typing import Any, Dict, List, Tuple
+
+from google.cloud import pubsub_v1
+
+from worker import write_rows
+
+logger = logging.getLogger(__name__)
+
+PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT", "StepSquad")
+PUBSUB_SUB_INGEST = os.getenv("PUBSUB_SUB_INGEST", "steps.ingest.sub")
+# Flow control: most messages/bytes leased but not yet acked at any time
+SUB_MAX_MESSAGES = int(os.getenv("SUB_MAX_MESSAGES", "1000"))
+SUB_MAX_BYTES = int(os.getenv("SUB_MAX_BYTES", str(10 * 1024 * 1024)))
+# Write a batch when it is this big or its oldest message waited this long
+SUB_BATCH_SIZE = int(os.getenv("SUB_BATCH_SIZE", "200"))  # Firestore batches cap at 500 writes (2 per message)
+SUB_BATCH_WINDOW_SECONDS = float(os.getenv("SUB_BATCH_WINDOW_MS", "500")) / 1000
+SUB_DRAIN_TIMEOUT_SECONDS = float(os.getenv("SUB_DRAIN_TIMEOUT_SECONDS", "25"))
+
+
+def parse_row(data: bytes) -> Dict[str, Any]:
+    """Decode an ingest event into a row for write_rows (fact_daily_steps columns plus idempotency_key)"""
+    payload = json.loads(data.decode("utf-8"))
+    return {
+        "user_id": payload["user_id"],
+        "date": payload["date"],
+        "steps": int(payload["steps"]),
+        "idempotency_key": payload.get("idempotency_key"),
+    }
+
+
+class BatchingConsumer:
+    """Buffers pulled messages and writes/acks them in batches on a flusher thread"""
+
+    def __init__(self, write_fn=write_rows, batch_size: int = SUB_BATCH_SIZE, window: float = SUB_BATCH_WINDOW_SECONDS):
+        self.write_fn = write_fn
+        self.batch_size = max(1, batch_size)
+        self.window = window
+        self.written = 0
+        self.failed = 0
+        self._buffer: List[Tuple[Dict[str, Any], Any]] = []  # (row, message)
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def on_message(self, message) -> None:
+        """Subscriber callback (runs on the client's callback threads)"""
+        try:
+            row = parse_row(message.data)
+        except (ValueError, KeyError, TypeError) as e:
+            # Redelivering a malformed event can never succeed
+            logger.error(f"Dropping malformed ingest message {getattr(message, 'message_id', '')}: {e}")
+            message.ack()
+            return
+
+        with self._cond:
+            if self._stopping:
+                # Draining: the flusher may already be gone, let another consumer take it
+                message.nack()
+                return
+            self._buffer.append((row, message))
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buffer) >= self.batch_size or self._stopping, timeout=self.window)
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                done = self._stopping and not self._buffer
+
+            if batch:
+                self._commit(batch)
+            if done:
+                return
+
+    def _commit(self, batch: List[Tuple[Dict[str, Any], Any]]):
+        try:
+            self.write_fn([row for row, _ in batch])
+        except Exception as e:
+            logger.error(f"Failed to write batch of {len(batch)} ingest messages, nacking: {e}")
+            self.failed += len(batch)
+            for _, message in batch:
+                message.nack()
+            return
+
+        # The client library sends these to Pub/Sub as batched acknowledge requests
+        for _, message in batch:
+            message.ack()
+        self.written += len(batch)
+
+    def stop(self, timeout: float = SUB_DRAIN_TIMEOUT_SECONDS):
+        """
+        Stop buffering, flush and ack everything buffered, then stop the flusher thread
+
+        Call this while the streaming pull is still open: acks sent after it is
+        cancelled are dropped by the client and the messages redelivered.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            # Flushing took too long; hand what is left back to Pub/Sub
+            with self._cond:
+                leftover = self._buffer[:]
+                del self._buffer[:]
+            for _, message in leftover:
+                message.nack()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(PROJECT, PUBSUB_SUB_INGEST)
+
+    consumer = BatchingConsumer()
+    consumer.start()
+
+    flow_control = pubsub_v1.types.FlowControl(max_messages=SUB_MAX_MESSAGES, max_bytes=SUB_MAX_BYTES)
+    streaming_pull = subscriber.subscribe(
+        subscription_path,
+        callback=consumer.on_message,
+        flow_control=flow_control,
+        await_callbacks_on_shutdown=True,
+    )
+    logger.info(f"Listening on {subscription_path} (max {SUB_MAX_MESSAGES} messages / {SUB_MAX_BYTES} bytes outstanding)")
+
+    shutdown = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: shutdown.set())
+    signal.signal(signal.SIGINT, lambda *_: shutdown.set())
+
+    while not shutdown.wait(1.0):
+        if streaming_pull.done():
+            # Stream died (e.g. permission error); surface it and drain what we have
+            logger.error(f"Streaming pull stopped: {streaming_pull.exception()}")
+            break
+
+    logger.info("Draining ingest subscriber")
+    # Write and ack the buffered batch while the stream can still deliver the acks;
+    # messages arriving meanwhile are nacked
+    consumer.stop()
+    # Then stop the stream; unprocessed leased messages are nacked by the client
+    streaming_pull.cancel()
+    try:
+        streaming_pull.result(timeout=SUB_DRAIN_TIMEOUT_SECONDS)
+    except Exception:
+        pass
+    subscriber.close()
+    logger.info(f"Ingest subscriber stopped: {consumer.written} written, {consumer.failed} failed")
+
+
+if __name__ == "__main__":
+    main()
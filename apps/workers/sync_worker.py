@@ -5,33 +5,63 @@ Syncs steps from linked Garmin/Fitbit devices daily via Cloud Scheduler
 """
 
 import os
+import json
+import base64
 import logging
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import sys
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from gcp_clients import init_clients
 
 # Import API clients (same directory structure)
 try:
     from api.device_storage import get_all_linked_devices, update_device_sync_time, get_device_tokens
-    from api.garmin_client import get_garmin_daily_steps, refresh_garmin_token
-    from api.fitbit_client import get_fitbit_daily_steps, refresh_fitbit_token
-    from api.storage import write_daily_steps, check_idempotency, is_user_in_team_for_competition, get_competitions, get_competition
-    from api.pubsub_bus import publish_ingest
+    from api.garmin_client import get_garmin_daily_steps, get_garmin_steps_range
+    from api.fitbit_client import get_fitbit_daily_steps, get_fitbit_steps_range
+    from api.storage import write_daily_steps_batch, find_used_idempotency_keys, record_idempotency_keys, get_competitions, get_teams
+    from api.pubsub_bus import publish_ingest_batch
+    from api.token_manager import ensure_fresh_tokens, refresh_expiring_tokens
+    from api.sync_leases import shard_for_uid, claim_sync_lease, complete_sync_lease, release_sync_lease, LeaseHeartbeat
+    from api.task_queue import enqueue_device_sync_tasks, register_local_handler, local_queue
+    from api.rate_limiter import RateLimitExceeded, rate_limit_stats
+    from api.circuit_breaker import CircuitOpenError, breaker_states
+    from api.webhooks import create_webhook_router
+    from api.device_storage import find_device
+    from api.bq_compaction import compact_daily_steps, COMPACTION_LOOKBACK_DAYS
+    from api.rollups import run_daily_rollups
+    from api.read_model_export import export_read_models
+    from api.submission_bitmaps import record_submission_groups
 except ImportError:
     # Try alternative import path
     import sys
     sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
     from device_storage import get_all_linked_devices, update_device_sync_time, get_device_tokens
-    from garmin_client import get_garmin_daily_steps, refresh_garmin_token
-    from fitbit_client import get_fitbit_daily_steps, refresh_fitbit_token
-    from storage import write_daily_steps, check_idempotency, is_user_in_team_for_competition, get_competitions, get_competition
-    from pubsub_bus import publish_ingest
+    from garmin_client import get_garmin_daily_steps, get_garmin_steps_range
+    from fitbit_client import get_fitbit_daily_steps, get_fitbit_steps_range
+    from storage import write_daily_steps_batch, find_used_idempotency_keys, record_idempotency_keys, get_competitions, get_teams
+    from pubsub_bus import publish_ingest_batch
+    from token_manager import ensure_fresh_tokens, refresh_expiring_tokens
+    from sync_leases import shard_for_uid, claim_sync_lease, complete_sync_lease, release_sync_lease, LeaseHeartbeat
+    from task_queue import enqueue_device_sync_tasks, register_local_handler, local_queue
+    from rate_limiter import RateLimitExceeded, rate_limit_stats
+    from circuit_breaker import CircuitOpenError, breaker_states
+    from webhooks import create_webhook_router
+    from device_storage import find_device
+    from bq_compaction import compact_daily_steps, COMPACTION_LOOKBACK_DAYS
+    from rollups import run_daily_rollups
+    from read_model_export import export_read_models
+    from submission_bitmaps import record_submission_groups
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -43,23 +73,242 @@ init_clients()
 
 COMP_TZ = os.getenv("COMP_TZ", "Europe/Bucharest")
 GRACE_DAYS = int(os.getenv("GRACE_DAYS", "2"))
+# Longest window a device is backfilled in one run (e.g. a device that never synced)
+MAX_CATCHUP_DAYS = int(os.getenv("MAX_CATCHUP_DAYS", "31"))
 
+# Concurrency limits for the nightly device sync
+# SYNC_MAX_CONCURRENCY bounds the total number of devices synced at once,
+# the per-provider limits keep us from hammering a single provider API.
+SYNC_MAX_CONCURRENCY = int(os.getenv("SYNC_MAX_CONCURRENCY", "16"))
+SYNC_PROVIDER_CONCURRENCY = {
+    "garmin": int(os.getenv("GARMIN_SYNC_CONCURRENCY", "4")),
+    "fitbit": int(os.getenv("FITBIT_SYNC_CONCURRENCY", "8")),
+}
 
-def sync_device_for_user(uid: str, provider: str, sync_date: date) -> Dict[str, Any]:
+# Sharding for the nightly device sync
+# Devices are split into SYNC_SHARD_COUNT shards by uid hash. Each shard is
+# claimed through a lease that expires after SYNC_LEASE_SECONDS unless the
+# holder renews it, so concurrent or repeated scheduler hits split the work
+# and a shard abandoned by a crashed instance is picked up by the next run.
+SYNC_SHARD_COUNT = max(1, int(os.getenv("SYNC_SHARD_COUNT", "1")))
+SYNC_LEASE_SECONDS = int(os.getenv("SYNC_LEASE_SECONDS", "900"))
+
+# Identifies this instance as a lease owner
+WORKER_ID = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+
+# "inline" syncs devices inside the cron request (sharded as above),
+# "queue" fans out one task per device to /tasks/sync-device
+SYNC_DISPATCH = os.getenv("SYNC_DISPATCH", "inline")
+
+# Webhook tasks carry no competition list, the worker caches active competitions this long
+ACTIVE_COMPETITIONS_CACHE_SECONDS = int(os.getenv("ACTIVE_COMPETITIONS_CACHE_SECONDS", "300"))
+
+# Sync errors that retrying won't fix; such tasks are acked instead of retried
+PERMANENT_SYNC_ERRORS = ("device not linked", "access token not found", "re-authentication required")
+
+
+class SyncTaskError(Exception):
+    """A device sync task failed and should be retried"""
+
+
+def fetch_device_steps(
+    provider: str,
+    access_token: str,
+    start_date: date,
+    end_date: date,
+    uid: Optional[str] = None
+) -> Dict[str, int]:
+    """
+    Fetch steps for a date range from a provider
+    
+    A single day uses the daily endpoint; longer ranges use the provider's
+    range fetch (one time-series call for Fitbit, concurrent days for Garmin).
+    Calls go through the shared provider rate limiter, keyed per user by uid.
+    
+    Returns:
+        Dictionary mapping date (ISO format) to step count
+    
+    Raises:
+        ValueError: If the provider is unknown or the fetch fails
+    """
+    if provider == "garmin":
+        if start_date == end_date:
+            return {start_date.isoformat(): get_garmin_daily_steps(access_token, start_date, uid)}
+        return get_garmin_steps_range(access_token, start_date, end_date, uid)
+    elif provider == "fitbit":
+        if start_date == end_date:
+            return {start_date.isoformat(): get_fitbit_daily_steps(access_token, start_date, uid)}
+        return get_fitbit_steps_range(access_token, start_date, end_date, uid)
+    raise ValueError(f"Unknown provider: {provider}")
+
+
+def load_active_competitions(today: Optional[date] = None) -> List[Dict[str, Any]]:
+    """
+    Load competitions that can still accept synced steps, with their members
+    
+    That is ACTIVE competitions plus ENDED ones still inside their grace period.
+    Loaded once per cron run and shared by every device sync.
+    
+    Returns:
+        List of {"comp_id", "start", "grace_end", "members"} with dates as date objects
+    """
+    if today is None:
+        today = datetime.now().date()
+    
+    active_competitions = []
+    
+    for competition in get_competitions():
+        comp_id = competition.get("comp_id")
+        if not comp_id:
+            continue
+        
+        try:
+            comp_start = datetime.strptime(competition.get("start_date"), "%Y-%m-%d").date()
+            comp_end = datetime.strptime(competition.get("end_date"), "%Y-%m-%d").date()
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Error checking date range for competition {comp_id}: {e}")
+            continue
+        
+        grace_end = comp_end + timedelta(days=GRACE_DAYS)
+        status = competition.get("status")
+        if status != "ACTIVE" and not (status == "ENDED" and today <= grace_end):
+            continue
+        
+        members = set()
+        for team in get_teams(comp_id=comp_id):
+            members.update(team.get("members", []))
+        
+        active_competitions.append({
+            "comp_id": comp_id,
+            "start": comp_start,
+            "grace_end": grace_end,
+            "members": members,
+        })
+    
+    return active_competitions
+
+
+def get_user_active_competitions(uid: str, active_competitions: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    Get the competitions a user can sync steps into, with their accepted date range
+    
+    Args:
+        uid: User ID
+        active_competitions: Preloaded result of load_active_competitions()
+    
+    Returns:
+        List of {"comp_id", "start", "grace_end"} with dates as date objects
+    """
+    if active_competitions is None:
+        active_competitions = load_active_competitions()
+    
+    return [
+        {"comp_id": c["comp_id"], "start": c["start"], "grace_end": c["grace_end"]}
+        for c in active_competitions
+        if uid in c["members"]
+    ]
+
+
+def compute_sync_window(
+    last_sync: Optional[str],
+    user_competitions: List[Dict[str, Any]],
+    sync_through: date
+) -> Optional[Tuple[date, date]]:
+    """
+    Compute the days a device still needs synced
+    
+    The window starts at the last day stored by the previous sync (that day
+    may have been synced while still in progress, its final count goes
+    through since keys include the count) and ends at sync_through. It is
+    capped to the user's competition ranges plus grace days and to
+    MAX_CATCHUP_DAYS.
+    
+    Args:
+        last_sync: The device's last_sync (midnight of the last day stored), or None
+        user_competitions: Result of get_user_active_competitions()
+        sync_through: Last day to sync (normally yesterday)
+    
+    Returns:
+        (start, end) dates inclusive, or None if there is nothing to sync
+    """
+    if not user_competitions:
+        return None
+    
+    earliest_start = min(c["start"] for c in user_competitions)
+    latest_end = max(c["grace_end"] for c in user_competitions)
+    end = min(sync_through, latest_end)
+    
+    start = earliest_start
+    if last_sync:
+        try:
+            start = max(start, datetime.fromisoformat(last_sync).date())
+        except (ValueError, TypeError):
+            logger.warning(f"Invalid last_sync value: {last_sync}")
+    
+    start = max(start, end - timedelta(days=MAX_CATCHUP_DAYS - 1))
+    
+    if start > end:
+        return None
+    return start, end
+
+
+def fetched_through(start: date, end: date, steps_by_date: Dict[str, int]) -> Optional[date]:
+    """
+    Last day of the unbroken run of fetched days from start
+    
+    Range fetches skip days that failed (e.g. get_garmin_steps_range), so
+    last_sync must not move past the first missing day.
+    """
+    through = None
+    day = start
+    while day <= end and day.isoformat() in steps_by_date:
+        through = day
+        day += timedelta(days=1)
+    return through
+
+
+def sync_device_for_user(
+    uid: str,
+    provider: str,
+    sync_date: date,
+    end_date: Optional[date] = None,
+    competitions: Optional[List[Dict[str, Any]]] = None,
+    device_data: Optional[Dict[str, Any]] = None,
+    partial: bool = False,
+    record_bitmaps: bool = True
+) -> Dict[str, Any]:
     """
-    Sync steps from a device for a specific user and date
+    Sync steps from a device for a specific user and date (or date range)
+    
+    The whole range is fetched with one range request and its days are
+    written as one batch. Idempotency keys include the day's count, so a day
+    is resubmitted only when its count changed, and they are recorded only
+    once the batch is written. A catch-up moves last_sync to the last day of
+    the unbroken run of fetched days from sync_date, and only when the write
+    succeeded, so days a provider failed to return are fetched again.
     
     Args:
         uid: User ID
         provider: Device provider ("garmin" or "fitbit")
-        sync_date: Date to sync steps for
+        sync_date: Date to sync steps for (first day of the range)
+        end_date: Optional last day of the range, inclusive (defaults to sync_date)
+        competitions: Preloaded get_user_active_competitions() result for the user
+        device_data: Preloaded device record (tokens are re-read only if they need a refresh)
+        partial: Sync only these days (e.g. from a webhook) rather than catching up;
+            last_sync is left alone so the nightly catch-up still covers any gap
+        record_bitmaps: Set the submission bitmap bits here; batch callers pass
+            False and record all their devices' submissions together
     
     Returns:
         Sync result with steps and submissions
     """
+    if end_date is None or end_date < sync_date:
+        end_date = sync_date
+    
     try:
         # Get stored tokens
-        device_data = get_device_tokens(uid, provider)
+        if not device_data:
+            device_data = get_device_tokens(uid, provider)
         
         if not device_data:
             return {
@@ -78,44 +327,39 @@ def sync_device_for_user(uid: str, provider: str, sync_date: date) -> Dict[str,
                 "steps": 0
             }
         
-        # Check if token is expired and refresh if needed
-        expires_at = tokens.get("expires_at")
-        if expires_at and datetime.utcnow().timestamp() >= expires_at:
-            logger.info(f"Refreshing {provider} token for user {uid}")
-            try:
-                if provider == "fitbit" and tokens.get("refresh_token"):
-                    new_tokens = refresh_fitbit_token(tokens.get("refresh_token"))
-                    # Update stored tokens
-                    from api.device_storage import store_device_tokens
-                    store_device_tokens(uid, provider, new_tokens)
-                    access_token = new_tokens.get("access_token")
-                elif provider == "garmin":
-                    # Garmin OAuth 1.0a doesn't have refresh tokens
-                    return {
-                        "status": "error",
-                        "error": "Garmin token expired, re-authentication required",
-                        "steps": 0
-                    }
-            except Exception as e:
-                logger.error(f"Failed to refresh {provider} token: {e}")
-                return {
-                    "status": "error",
-                    "error": f"Token refresh failed: {str(e)}",
-                    "steps": 0
-                }
+        # Tokens are normally refreshed at the start of the cron run, this only
+        # refreshes (single-flight) if one is still about to expire
+        try:
+            tokens = ensure_fresh_tokens(uid, provider, device_data=device_data)
+            access_token = tokens.get("access_token")
+        except Exception as e:
+            logger.error(f"Failed to refresh {provider} token: {e}")
+            return {
+                "status": "error",
+                "error": f"Token refresh failed: {str(e)}",
+                "steps": 0
+            }
         
-        # Fetch steps from device API
+        # Fetch steps from device API (one call for the whole range where possible)
         try:
-            if provider == "garmin":
-                steps = get_garmin_daily_steps(access_token, sync_date)
-            elif provider == "fitbit":
-                steps = get_fitbit_daily_steps(access_token, sync_date)
-            else:
-                return {
-                    "status": "error",
-                    "error": f"Unknown provider: {provider}",
-                    "steps": 0
-                }
+            try:
+                steps_by_date = fetch_device_steps(provider, access_token, sync_date, end_date, uid)
+            except ValueError as e:
+                if provider != "fitbit" or "expired" not in str(e).lower():
+                    raise
+                # Token was revoked early, refresh once (single-flight) and retry
+                tokens = ensure_fresh_tokens(uid, provider, rejected_access_token=access_token)
+                access_token = tokens.get("access_token")
+                steps_by_date = fetch_device_steps(provider, access_token, sync_date, end_date, uid)
+        except (RateLimitExceeded, CircuitOpenError) as e:
+            # Quota exhausted or provider down: leave last_sync alone so the days are picked up later
+            logger.warning(f"Deferring {provider} sync for {uid}: {e}")
+            return {
+                "status": "error",
+                "error": str(e),
+                "retry_after": e.retry_after,
+                "steps": 0
+            }
         except ValueError as e:
             logger.warning(f"Failed to fetch steps from {provider} for {uid}: {e}")
             return {
@@ -124,104 +368,110 @@ def sync_device_for_user(uid: str, provider: str, sync_date: date) -> Dict[str,
                 "steps": 0
             }
         
-        if steps == 0:
-            logger.info(f"No steps found for {uid} from {provider} on {sync_date}")
-            return {
-                "status": "success",
-                "steps": 0,
-                "message": "No steps found for this date"
-            }
+        total_steps = sum(steps_by_date.values())
         
-        # Find user's active competitions and submit steps
-        all_competitions = get_competitions()
-        user_competitions = []
+        # Find user's active competitions and submit steps for each day in range
+        user_competitions = competitions if competitions is not None else get_user_active_competitions(uid)
         
-        for competition in all_competitions:
-            comp_id = competition.get("comp_id")
-            if not comp_id:
-                continue
-            
-            # Check if competition is ACTIVE
-            if competition.get("status") != "ACTIVE":
+        candidates = []
+        for day_str, steps in sorted(steps_by_date.items()):
+            if not steps:
                 continue
-            
-            # Check if user is in a team for this competition
-            if not is_user_in_team_for_competition(uid, comp_id):
+            day = datetime.strptime(day_str, "%Y-%m-%d").date()
+            for competition in user_competitions:
+                # Check if date is within competition range (with grace days)
+                if competition["start"] <= day <= competition["grace_end"]:
+                    # Keyed on the count, so a day synced while still in progress goes through again
+                    idempotency_key = f"{provider}_{day_str}_{uid}_{competition['comp_id']}_{steps}"
+                    candidates.append((day_str, steps, competition["comp_id"], idempotency_key))
+        
+        used_keys = find_used_idempotency_keys([key for _, _, _, key in candidates], uid)
+        
+        submissions = []
+        batch_steps = {}
+        batch_events = []
+        batch_keys = {}
+        for day_str, steps, comp_id, idempotency_key in candidates:
+            if idempotency_key in used_keys:
+                logger.info(f"Skipping duplicate submission for {uid} in {comp_id} on {day_str}")
+                submissions.append({
+                    "comp_id": comp_id,
+                    "date": day_str,
+                    "status": "skipped",
+                    "reason": "duplicate"
+                })
                 continue
             
-            # Check if date is within competition range (with grace days)
-            try:
-                comp_start = datetime.strptime(competition.get("start_date"), "%Y-%m-%d").date()
-                comp_end = datetime.strptime(competition.get("end_date"), "%Y-%m-%d").date()
-                grace_end = comp_end + timedelta(days=GRACE_DAYS)
-                
-                if comp_start <= sync_date <= grace_end:
-                    user_competitions.append(comp_id)
-            except (ValueError, KeyError) as e:
-                logger.warning(f"Error checking date range for competition {comp_id}: {e}")
-                continue
+            batch_steps[day_str] = steps
+            batch_keys[idempotency_key] = day_str
+            batch_events.append({
+                "user_id": uid,
+                "comp_id": comp_id,
+                "date": day_str,
+                "steps": steps,
+                "provider": provider,
+                "tz": COMP_TZ,
+                "source_ts": datetime.utcnow().isoformat(),
+                "idempotency_key": idempotency_key,
+            })
+            submissions.append({
+                "comp_id": comp_id,
+                "date": day_str,
+                "status": "submitted",
+                "steps": steps
+            })
         
-        # Submit steps to each active competition
-        submissions = []
-        for comp_id in user_competitions:
+        # Write the whole window at once, then publish its events together
+        stored = True
+        if batch_steps:
             try:
-                # Generate idempotency key
-                idempotency_key = f"{provider}_{sync_date.isoformat()}_{uid}_{comp_id}"
-                
-                # Check idempotency
-                if check_idempotency(idempotency_key, uid, sync_date.isoformat()):
-                    logger.info(f"Skipping duplicate submission for {uid} in {comp_id} on {sync_date}")
-                    submissions.append({
-                        "comp_id": comp_id,
-                        "status": "skipped",
-                        "reason": "duplicate"
-                    })
-                    continue
-                
-                # Write steps
-                write_daily_steps(uid, sync_date.isoformat(), steps)
+                write_daily_steps_batch(uid, batch_steps)
+                # Keys are only used up once their steps are stored, so a failed write is retried
+                record_idempotency_keys(batch_keys, uid)
+            except Exception as e:
+                logger.error(f"Failed to write steps batch for {uid}: {e}")
+                for submission in submissions:
+                    if submission["status"] == "submitted":
+                        submission["status"] = "error"
+                        submission["error"] = str(e)
+                batch_events = []
+                stored = False
+            
+            if batch_events:
+                if record_bitmaps:
+                    record_submission_groups((event["comp_id"], event["date"], uid) for event in batch_events)
                 
-                # Publish to Pub/Sub
                 try:
-                    publish_ingest({
-                        "user_id": uid,
-                        "comp_id": comp_id,
-                        "date": sync_date.isoformat(),
-                        "steps": steps,
-                        "provider": provider,
-                        "tz": COMP_TZ,
-                        "source_ts": datetime.utcnow().isoformat(),
-                        "idempotency_key": idempotency_key,
-                    })
+                    publish_ingest_batch(batch_events)
                 except Exception as pubsub_error:
-                    logger.warning(f"Failed to publish step ingestion event to Pub/Sub: {pubsub_error}")
-                
-                submissions.append({
-                    "comp_id": comp_id,
-                    "status": "submitted",
-                    "steps": steps
-                })
+                    logger.warning(f"Failed to publish step ingestion events to Pub/Sub: {pubsub_error}")
                 
-                logger.info(f"Submitted {steps} steps for {uid} to competition {comp_id}")
-                
-            except Exception as e:
-                logger.error(f"Failed to submit steps to competition {comp_id}: {e}")
-                submissions.append({
-                    "comp_id": comp_id,
-                    "status": "error",
-                    "error": str(e)
-                })
+                logger.info(f"Submitted {len(batch_events)} step entries for {uid} from {sync_date} to {end_date}")
+        
+        # Move last_sync through the days actually stored (None if the first day is missing)
+        synced_through = fetched_through(sync_date, end_date, steps_by_date) if stored else None
+        if not partial and synced_through:
+            update_device_sync_time(uid, provider, datetime.combine(synced_through, datetime.min.time()))
         
-        # Update sync time
-        update_device_sync_time(uid, provider)
+        if total_steps == 0:
+            logger.info(f"No steps found for {uid} from {provider} from {sync_date} to {end_date}")
+            return {
+                "status": "success",
+                "steps": 0,
+                "message": "No steps found for this date",
+                "synced_through": synced_through.isoformat() if synced_through else None,
+            }
         
         return {
             "status": "success",
             "provider": provider,
             "date": sync_date.isoformat(),
-            "steps": steps,
+            "end_date": end_date.isoformat(),
+            "steps": total_steps,
+            "days": steps_by_date,
             "competitions": submissions,
             "submitted_count": len([s for s in submissions if s.get("status") == "submitted"]),
+            "synced_through": synced_through.isoformat() if synced_through else None,
         }
     
     except Exception as e:
@@ -233,20 +483,342 @@ def sync_device_for_user(uid: str, provider: str, sync_date: date) -> Dict[str,
         }
 
 
+def sync_devices_concurrently(
+    devices: List[Dict[str, Any]],
+    sync_through: date,
+    active_competitions: Optional[List[Dict[str, Any]]] = None,
+    stop_event: Optional[threading.Event] = None
+) -> List[Dict[str, Any]]:
+    """
+    Catch up a list of linked devices using a bounded thread pool
+    
+    Each device syncs the window from its last_sync to sync_through (see
+    compute_sync_window). The pool size caps global concurrency; a semaphore
+    per provider caps how many requests are in flight against each provider
+    API at the same time.
+    
+    Args:
+        devices: Device records as returned by get_all_linked_devices()
+        sync_through: Last day to sync (normally yesterday)
+        active_competitions: Preloaded result of load_active_competitions()
+        stop_event: Once set, devices not started yet are skipped (e.g. the shard lease was lost)
+    
+    Returns:
+        Per-device sync results, in the same order as the input devices
+    """
+    if active_competitions is None:
+        active_competitions = load_active_competitions()
+    
+    provider_limits = {
+        provider: threading.BoundedSemaphore(max(1, limit))
+        for provider, limit in SYNC_PROVIDER_CONCURRENCY.items()
+    }
+    
+    def _sync_one(device_data: Dict[str, Any]) -> Dict[str, Any]:
+        uid = device_data.get("uid")
+        provider = device_data.get("provider")
+        if stop_event is not None and stop_event.is_set():
+            return {"status": "skipped", "reason": "stopped", "steps": 0, "uid": uid, "provider": provider}
+        user_competitions = get_user_active_competitions(uid, active_competitions)
+        window = compute_sync_window(device_data.get("last_sync"), user_competitions, sync_through)
+        
+        if window is None:
+            result = {
+                "status": "success",
+                "steps": 0,
+                "message": "Up to date" if user_competitions else "No active competitions"
+            }
+        else:
+            start, end = window
+            logger.info(f"Syncing {provider} device for user {uid} from {start} to {end}")
+            semaphore = provider_limits.get(provider)
+            if semaphore:
+                with semaphore:
+                    result = sync_device_for_user(uid, provider, start, end, user_competitions, device_data, record_bitmaps=False)
+            else:
+                result = sync_device_for_user(uid, provider, start, end, user_competitions, device_data, record_bitmaps=False)
+        
+        result["uid"] = uid
+        result["provider"] = provider
+        return result
+    
+    jobs = [
+        device_data
+        for device_data in devices
+        if device_data.get("uid") and device_data.get("provider")
+    ]
+    
+    if not jobs:
+        return []
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(SYNC_MAX_CONCURRENCY, len(jobs)))) as executor:
+        futures = [executor.submit(_sync_one, device_data) for device_data in jobs]
+        results = []
+        for device_data, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # sync_device_for_user handles its own errors, this is a safety net
+                uid = device_data.get("uid")
+                provider = device_data.get("provider")
+                logger.error(f"Unexpected error syncing {provider} device for user {uid}: {e}", exc_info=True)
+                results.append({
+                    "status": "error",
+                    "error": str(e),
+                    "steps": 0,
+                    "uid": uid,
+                    "provider": provider,
+                })
+    
+    # One submission bitmap write per competition day for all devices, not one per user
+    record_submission_groups(
+        (submission["comp_id"], submission["date"], result["uid"])
+        for result in results
+        for submission in result.get("competitions", [])
+        if submission.get("status") == "submitted"
+    )
+    
+    return results
+
+
+def sync_shard(
+    shard: int,
+    devices: List[Dict[str, Any]],
+    sync_through: date,
+    active_competitions: List[Dict[str, Any]],
+    run_id: str,
+    owner: str = WORKER_ID
+) -> Optional[Dict[str, Any]]:
+    """
+    Claim a shard's lease and sync its devices
+    
+    Args:
+        shard: Shard number
+        devices: Devices belonging to this shard
+        sync_through: Last day to sync (inclusive)
+        active_competitions: Output of load_active_competitions()
+        run_id: Sync run the lease belongs to (one run per sync date)
+        owner: Lease owner id
+    
+    Returns:
+        Shard summary with results, or None if another instance holds or
+        already finished the shard. If the lease is lost midway, devices not
+        started yet are skipped and the shard is left to the new holder
+        (lease_lost is True).
+    """
+    if not claim_sync_lease(run_id, shard, owner, SYNC_LEASE_SECONDS):
+        return None
+    
+    try:
+        with LeaseHeartbeat(run_id, shard, owner, SYNC_LEASE_SECONDS) as heartbeat:
+            # Refresh tokens expiring soon up front so no device sync pays for it
+            token_refresh = refresh_expiring_tokens(devices)
+            # Once the lease is lost the new holder syncs the shard; stop starting devices
+            results = sync_devices_concurrently(devices, sync_through, active_competitions, stop_event=heartbeat.lost_event)
+    except Exception:
+        # Let another instance retry right away instead of waiting for expiry
+        release_sync_lease(run_id, shard, owner)
+        raise
+    
+    skipped = [r for r in results if r.get("status") == "skipped"]
+    results = [r for r in results if r.get("status") != "skipped"]
+    success_count = len([r for r in results if r.get("status") == "success"])
+    summary = {
+        "devices": len(devices),
+        "successful": success_count,
+        "errors": len(results) - success_count,
+    }
+    # Only the current holder may mark the shard done
+    lease_lost = heartbeat.lost or not complete_sync_lease(run_id, shard, owner, summary)
+    if lease_lost:
+        logger.warning(f"Lost sync lease for shard {shard} of run {run_id}; skipped {len(skipped)} devices")
+    
+    return {
+        "shard": shard,
+        **summary,
+        "lease_lost": lease_lost,
+        "skipped_devices": len(skipped),
+        "token_refresh": token_refresh,
+        "results": results
+    }
+
+
+def build_sync_task(
+    device_data: Dict[str, Any],
+    sync_through: date,
+    active_competitions: List[Dict[str, Any]],
+    run_id: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Build the queue task for one device, or None if it has nothing to sync
+    
+    The user's competitions travel with the task so the handler doesn't have
+    to reload every competition and team for each device.
+    """
+    uid = device_data.get("uid")
+    provider = device_data.get("provider")
+    if not uid or not provider:
+        return None
+    
+    user_competitions = get_user_active_competitions(uid, active_competitions)
+    if compute_sync_window(device_data.get("last_sync"), user_competitions, sync_through) is None:
+        return None
+    
+    return {
+        "uid": uid,
+        "provider": provider,
+        "sync_through": sync_through.isoformat(),
+        "run_id": run_id,
+        "competitions": [
+            {"comp_id": c["comp_id"], "start": c["start"].isoformat(), "grace_end": c["grace_end"].isoformat()}
+            for c in user_competitions
+        ],
+    }
+
+
+_competitions_cache: Dict[str, Any] = {"loaded_at": 0.0, "competitions": None}
+_competitions_cache_lock = threading.Lock()
+
+
+def get_cached_active_competitions() -> List[Dict[str, Any]]:
+    """load_active_competitions(), cached for ACTIVE_COMPETITIONS_CACHE_SECONDS"""
+    with _competitions_cache_lock:
+        now = time.monotonic()
+        if _competitions_cache["competitions"] is None or now - _competitions_cache["loaded_at"] > ACTIVE_COMPETITIONS_CACHE_SECONDS:
+            _competitions_cache["competitions"] = load_active_competitions()
+            _competitions_cache["loaded_at"] = now
+        return _competitions_cache["competitions"]
+
+
+def run_sync_task(task: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Process one device sync task
+    
+    Cron tasks recompute their window from the device's current last_sync, so
+    a task delivered twice (or after a newer sync) finds nothing left to do.
+    Webhook tasks carry the changed days ("start"/"end") and sync just those.
+    
+    Raises:
+        SyncTaskError: If the sync failed in a way that may succeed on retry
+    """
+    uid = task["uid"]
+    provider = task["provider"]
+    if "competitions" in task:
+        user_competitions = [
+            {
+                "comp_id": c["comp_id"],
+                "start": date.fromisoformat(c["start"]),
+                "grace_end": date.fromisoformat(c["grace_end"]),
+            }
+            for c in task["competitions"]
+        ]
+    else:
+        user_competitions = get_user_active_competitions(uid, get_cached_active_competitions())
+    
+    device_data = get_device_tokens(uid, provider)
+    if not device_data:
+        logger.info(f"Dropping sync task for {uid}: {provider} device no longer linked")
+        return {"status": "dropped", "uid": uid, "provider": provider, "reason": "device not linked"}
+    
+    partial = bool(task.get("start"))
+    if partial:
+        window = None
+        if user_competitions:
+            start = max(date.fromisoformat(task["start"]), min(c["start"] for c in user_competitions))
+            end = min(date.fromisoformat(task.get("end") or task["start"]), max(c["grace_end"] for c in user_competitions))
+            window = (start, end) if start <= end else None
+    else:
+        window = compute_sync_window(device_data.get("last_sync"), user_competitions, date.fromisoformat(task["sync_through"]))
+    
+    if window is None:
+        return {"status": "success", "uid": uid, "provider": provider, "steps": 0, "message": "Up to date"}
+    
+    start, end = window
+    result = sync_device_for_user(uid, provider, start, end, user_competitions, device_data, partial=partial)
+    result["uid"] = uid
+    result["provider"] = provider
+    
+    if result.get("status") == "error":
+        error = str(result.get("error", ""))
+        if any(marker in error.lower() for marker in PERMANENT_SYNC_ERRORS):
+            logger.warning(f"Dropping sync task for {uid}/{provider}: {error}")
+            result["status"] = "dropped"
+            return result
+        raise SyncTaskError(error)
+    
+    return result
+
+
+# Without Pub/Sub, tasks run on an in-process queue with the same retry policy
+register_local_handler(run_sync_task)
+
+# Provider webhooks, mounted here too so local notifications land on the local queue
+app.include_router(create_webhook_router(enqueue_device_sync_tasks, find_device))
+
+
+@app.post("/tasks/sync-device")
+async def sync_device_task(request: Request):
+    """
+    Pub/Sub push endpoint for one device sync task
+    
+    Returns 5xx for retryable failures so Pub/Sub redelivers with backoff and
+    eventually dead-letters the task; permanent failures are acknowledged.
+    """
+    envelope = await request.json()
+    message = envelope.get("message", {})
+    data_b64 = message.get("data", "")
+    if not data_b64:
+        return {"status": "no-data"}
+    
+    try:
+        task = json.loads(base64.b64decode(data_b64).decode("utf-8"))
+    except (ValueError, TypeError) as e:
+        # A malformed message will never succeed, ack it
+        logger.error(f"Invalid sync task payload: {e}")
+        return {"status": "invalid"}
+    
+    attempt = envelope.get("deliveryAttempt", 1)
+    try:
+        return await run_in_threadpool(run_sync_task, task)
+    except SyncTaskError as e:
+        logger.warning(f"Sync task for {task.get('uid')}/{task.get('provider')} failed on attempt {attempt}: {e}")
+        raise HTTPException(status_code=503, detail=f"Sync failed: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error in sync task for {task.get('uid')}/{task.get('provider')}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Sync failed: {str(e)}")
+
+
 @app.post("/cron/sync-devices")
-async def sync_all_devices(request: Request):
+async def sync_all_devices(request: Request, shard: Optional[int] = None):
     """
     Cloud Scheduler endpoint to sync all linked devices
     
     This endpoint is called by Cloud Scheduler daily to sync steps
-    from all linked Garmin and Fitbit devices.
+    from all linked Garmin and Fitbit devices. Each device fetches the window
+    from its last sync through yesterday in one range request. Devices are
+    synced concurrently, bounded by SYNC_MAX_CONCURRENCY and the per-provider
+    limits.
+    
+    Devices are split into SYNC_SHARD_COUNT shards. The call works through
+    every shard it can claim a lease for, skipping shards that another
+    instance holds or that are already done for this sync date. Scheduling
+    several calls at once spreads the shards across instances; re-running the
+    job picks up shards whose lease expired after a crash.
     
-    Expected call: POST /cron/sync-devices
+    With SYNC_DISPATCH=queue the cron only enqueues one task per device that
+    has something to sync and returns; /tasks/sync-device does the syncing.
+    
+    Expected call: POST /cron/sync-devices (optionally ?shard=N for one shard)
     """
     try:
-        # Get sync date (default to yesterday for daily sync)
-        # Cloud Scheduler typically runs at midnight, syncing previous day
-        sync_date = datetime.now().date() - timedelta(days=1)
+        # Sync through yesterday; each device catches up from its last sync,
+        # so days missed by earlier runs are backfilled automatically
+        today = datetime.now().date()
+        sync_date = today - timedelta(days=1)
+        run_id = sync_date.isoformat()
+        
+        if shard is not None and not 0 <= shard < SYNC_SHARD_COUNT:
+            raise HTTPException(status_code=400, detail=f"shard must be between 0 and {SYNC_SHARD_COUNT - 1}")
         
         # Get all linked devices
         all_devices = get_all_linked_devices()
@@ -259,56 +831,149 @@ async def sync_all_devices(request: Request):
                 "sync_count": 0
             }
         
-        logger.info(f"Starting sync for {len(all_devices)} devices on {sync_date}")
+        if SYNC_DISPATCH == "queue":
+            active_competitions = await run_in_threadpool(load_active_competitions, today)
+            tasks = [
+                task
+                for task in (build_sync_task(device, sync_date, active_competitions, run_id) for device in all_devices)
+                if task is not None
+            ]
+            # Refresh expiring tokens before the tasks exist, so no task refreshes on its critical path
+            queued = {(task["uid"], task["provider"]) for task in tasks}
+            token_refresh = await run_in_threadpool(
+                refresh_expiring_tokens, [d for d in all_devices if (d.get("uid"), d.get("provider")) in queued]
+            )
+            enqueued = await run_in_threadpool(enqueue_device_sync_tasks, tasks)
+            logger.info(f"Enqueued {len(tasks)} device sync tasks ({enqueued['queue']}) for {len(all_devices)} devices through {sync_date}")
+            return {
+                "status": "success",
+                "mode": "queue",
+                "sync_date": sync_date.isoformat(),
+                "total_devices": len(all_devices),
+                "enqueued": len(tasks),
+                "up_to_date": len(all_devices) - len(tasks),
+                "token_refresh": token_refresh,
+                "queue": enqueued["queue"]
+            }
         
-        sync_results = []
-        success_count = 0
-        error_count = 0
+        devices_by_shard: Dict[int, List[Dict[str, Any]]] = {}
+        for device in all_devices:
+            devices_by_shard.setdefault(shard_for_uid(device.get("uid", ""), SYNC_SHARD_COUNT), []).append(device)
         
-        for device_data in all_devices:
-            uid = device_data.get("uid")
-            provider = device_data.get("provider")
-            
-            if not uid or not provider:
-                continue
-            
-            logger.info(f"Syncing {provider} device for user {uid}")
-            
-            result = sync_device_for_user(uid, provider, sync_date)
-            result["uid"] = uid
-            result["provider"] = provider
-            
-            sync_results.append(result)
-            
-            if result.get("status") == "success":
-                success_count += 1
+        shards = [shard] if shard is not None else list(range(SYNC_SHARD_COUNT))
+        logger.info(f"Starting sync for {len(all_devices)} devices through {sync_date} ({len(shards)} of {SYNC_SHARD_COUNT} shards, worker {WORKER_ID})")
+        
+        # Run the blocking sync pool off the event loop so /health stays responsive
+        active_competitions = await run_in_threadpool(load_active_competitions, today)
+        
+        shard_summaries = []
+        skipped_shards = []
+        for shard_id in shards:
+            summary = await run_in_threadpool(
+                sync_shard, shard_id, devices_by_shard.get(shard_id, []), sync_date, active_competitions, run_id
+            )
+            if summary is None:
+                skipped_shards.append(shard_id)
             else:
-                error_count += 1
+                shard_summaries.append(summary)
         
-        logger.info(f"Sync complete: {success_count} successful, {error_count} errors")
+        sync_results = [r for summary in shard_summaries for r in summary.pop("results")]
+        success_count = len([r for r in sync_results if r.get("status") == "success"])
+        error_count = len(sync_results) - success_count
+        
+        logger.info(f"Sync complete: {success_count} successful, {error_count} errors, {len(skipped_shards)} shards skipped")
         
         return {
             "status": "success",
+            "mode": "inline",
             "sync_date": sync_date.isoformat(),
-            "total_devices": len(all_devices),
+            "total_devices": len(sync_results),
             "successful": success_count,
             "errors": error_count,
+            "shards": shard_summaries,
+            "skipped_shards": skipped_shards,
             "results": sync_results
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in sync_all_devices: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Sync failed: {str(e)}")
 
 
+@app.post("/cron/compact-daily-steps")
+async def compact_steps(full: bool = False):
+    """
+    Cloud Scheduler endpoint to compact fact_daily_steps into daily_steps_curated
+    
+    Runs after the nightly sync. Only the last COMPACTION_LOOKBACK_DAYS days
+    are merged unless ?full=true rebuilds from the whole fact table.
+    """
+    try:
+        summary = await run_in_threadpool(compact_daily_steps, None if full else COMPACTION_LOOKBACK_DAYS)
+        return {"status": "success", **summary}
+    except RuntimeError as e:
+        # No BigQuery (local dev): nothing to compact
+        return {"status": "skipped", "message": str(e)}
+    except Exception as e:
+        logger.error(f"Error compacting daily steps: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Compaction failed: {str(e)}")
+
+
+@app.post("/cron/daily-rollups")
+async def daily_rollups(through: Optional[str] = None, days: Optional[int] = None):
+    """
+    Cloud Scheduler endpoint to materialize per-competition daily rollups
+    
+    Recomputes the last ROLLUP_RECOMPUTE_DAYS days through yesterday (or
+    through ?through=YYYY-MM-DD, ?days=N) so late submissions are picked up.
+    Run after the nightly device sync.
+    """
+    try:
+        through_date = datetime.strptime(through, "%Y-%m-%d").date() if through else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="through must be YYYY-MM-DD")
+    
+    try:
+        kwargs = {"days": days} if days else {}
+        summary = await run_in_threadpool(run_daily_rollups, through_date, **kwargs)
+        return {"status": "success", **summary}
+    except Exception as e:
+        logger.error(f"Error computing daily rollups: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Rollups failed: {str(e)}")
+
+
+@app.post("/cron/export-read-models")
+async def export_read_model_snapshots(comp_id: Optional[str] = None):
+    """
+    Cloud Scheduler endpoint to export competition read models (Arrow snapshots)
+    
+    Appends the latest days of every running or recently ended competition
+    (or only ?comp_id=...) as a new snapshot version under READ_MODEL_PATH.
+    """
+    try:
+        result = await run_in_threadpool(export_read_models, [comp_id] if comp_id else None)
+        errors = [c for c, r in result["competitions"].items() if r["status"] == "error"]
+        return {"status": "partial" if errors else "success", **result}
+    except Exception as e:
+        logger.error(f"Error exporting read models: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Export failed: {str(e)}")
+
+
 @app.get("/health")
 def health():
     """Health check endpoint"""
-    return {
+    health_data = {
         "ok": True,
         "service": "stepsquad-sync-worker",
         "version": "0.1.0"
     }
+    health_data["rate_limits"] = rate_limit_stats()
+    health_data["circuit_breakers"] = breaker_states()
+    if local_queue() is not None:
+        health_data["local_task_queue"] = local_queue().stats()
+    return health_data
 
 
 if __name__ == "__main__":
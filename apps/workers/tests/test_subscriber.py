@@ -0,0 +1,115 @@
+"""
+Unit tests for the streaming-pull ingest subscriber
+"""
+import json
+from types import SimpleNamespace
+
+import subscriber
+from subscriber import BatchingConsumer
+
+
+class FakeMessage:
+    def __init__(self, payload, log, message_id="m"):
+        self.data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        self.message_id = message_id
+        self.log = log
+
+    def ack(self):
+        self.log.append(("ack", self.message_id))
+
+    def nack(self):
+        self.log.append(("nack", self.message_id))
+
+
+def _event(n):
+    return {"user_id": f"sub-{n}@example.com", "date": "2025-03-01", "steps": n, "idempotency_key": f"key-{n}"}
+
+
+def test_stop_flushes_and_acks_a_partial_batch():
+    """Buffered messages below the batch size are written and acked by stop(), not left to redeliver"""
+    log, written = [], []
+    consumer = BatchingConsumer(written.extend, batch_size=100, window=10)
+    consumer.start()
+    consumer.on_message(FakeMessage(_event(1), log, "m1"))
+    consumer.on_message(FakeMessage(_event(2), log, "m2"))
+
+    consumer.stop(timeout=5)
+
+    assert [row["idempotency_key"] for row in written] == ["key-1", "key-2"]
+    assert log == [("ack", "m1"), ("ack", "m2")]
+    assert consumer.written == 2
+
+
+def test_messages_after_stop_are_nacked():
+    log = []
+    consumer = BatchingConsumer(lambda rows: None, batch_size=100, window=10)
+    consumer.start()
+    consumer.stop(timeout=5)
+
+    consumer.on_message(FakeMessage(_event(3), log, "late"))
+
+    assert log == [("nack", "late")]
+
+
+def test_failed_write_nacks_the_batch():
+    log = []
+
+    def fail(rows):
+        raise RuntimeError("BigQuery unavailable")
+
+    consumer = BatchingConsumer(fail, batch_size=2, window=10)
+    consumer.start()
+    consumer.on_message(FakeMessage(_event(1), log, "m1"))
+    consumer.on_message(FakeMessage(_event(2), log, "m2"))
+    consumer.stop(timeout=5)
+
+    assert sorted(log) == [("nack", "m1"), ("nack", "m2")]
+    assert consumer.failed == 2
+
+
+def test_malformed_message_is_acked_and_dropped():
+    log, written = [], []
+    consumer = BatchingConsumer(written.extend, batch_size=100, window=10)
+
+    consumer.on_message(FakeMessage(b"not json", log, "bad"))
+
+    assert log == [("ack", "bad")]
+    assert consumer._buffer == []
+
+
+def test_shutdown_acks_the_buffer_before_cancelling_the_stream(monkeypatch):
+    """Acks sent after the streaming pull is cancelled are dropped, so the drain must come first"""
+    log = []
+
+    class FakeStream:
+        def done(self):
+            return True
+
+        def exception(self):
+            return None
+
+        def cancel(self):
+            log.append(("cancel", None))
+
+        def result(self, timeout=None):
+            return None
+
+    class FakeSubscriberClient:
+        def subscription_path(self, project, subscription):
+            return f"projects/{project}/subscriptions/{subscription}"
+
+        def subscribe(self, path, callback, **kwargs):
+            callback(FakeMessage(_event(1), log, "buffered"))
+            return FakeStream()
+
+        def close(self):
+            log.append(("close", None))
+
+    fake_pubsub = SimpleNamespace(SubscriberClient=FakeSubscriberClient, types=SimpleNamespace(FlowControl=lambda **kwargs: kwargs))
+    monkeypatch.setattr(subscriber, "pubsub_v1", fake_pubsub)
+    monkeypatch.setattr(subscriber, "BatchingConsumer", lambda: BatchingConsumer(lambda rows: None, batch_size=100, window=10))
+    monkeypatch.setattr(subscriber.signal, "signal", lambda *args: None)
+
+    subscriber.main()
+
+    assert log == [("ack", "buffered"), ("cancel", None), ("close", None)]
@@ -0,0 +1,173 @@
+"""
+Unit tests for the nightly device catch-up
+"""
+from datetime import date, datetime
+
+import pytest
+
+import sync_worker
+from sync_worker import compute_sync_window, fetched_through, sync_device_for_user
+
+COMPETITIONS = [{"comp_id": "comp-1", "start": date(2025, 3, 1), "grace_end": date(2025, 3, 30)}]
+
+
+def test_window_starts_at_comp_start_without_last_sync():
+    assert compute_sync_window(None, COMPETITIONS, date(2025, 3, 10)) == (date(2025, 3, 1), date(2025, 3, 10))
+    assert compute_sync_window(None, [], date(2025, 3, 10)) is None
+
+
+def test_window_refetches_last_synced_day():
+    """The last day stored may have been synced while still in progress"""
+    assert compute_sync_window("2025-03-07T00:00:00", COMPETITIONS, date(2025, 3, 10)) == (date(2025, 3, 7), date(2025, 3, 10))
+    assert compute_sync_window("2025-03-11T00:00:00", COMPETITIONS, date(2025, 3, 10)) is None
+
+
+def test_window_capped_by_grace_end_and_catchup_limit(monkeypatch):
+    assert compute_sync_window("2025-03-28T00:00:00", COMPETITIONS, date(2025, 4, 5)) == (date(2025, 3, 28), date(2025, 3, 30))
+    monkeypatch.setattr(sync_worker, "MAX_CATCHUP_DAYS", 3)
+    assert compute_sync_window(None, COMPETITIONS, date(2025, 3, 10)) == (date(2025, 3, 8), date(2025, 3, 10))
+
+
+def test_fetched_through_stops_at_first_missing_day():
+    steps = {"2025-03-01": 10, "2025-03-02": 0, "2025-03-04": 30}
+    assert fetched_through(date(2025, 3, 1), date(2025, 3, 4), steps) == date(2025, 3, 2)
+    assert fetched_through(date(2025, 3, 3), date(2025, 3, 4), steps) is None
+
+
+@pytest.fixture
+def device_sync(monkeypatch):
+    """sync_device_for_user with a fake provider and captured writes"""
+    state = {"days": {}, "writes": [], "sync_times": [], "fail_write": False}
+
+    def write_batch(uid, steps_by_date):
+        if state["fail_write"]:
+            raise RuntimeError("Firestore unavailable")
+        state["writes"].append(dict(steps_by_date))
+
+    monkeypatch.setattr(sync_worker, "ensure_fresh_tokens", lambda uid, provider, **kwargs: {"access_token": "token"})
+    monkeypatch.setattr(sync_worker, "fetch_device_steps", lambda provider, token, start, end, uid=None: dict(state["days"]))
+    monkeypatch.setattr(sync_worker, "write_daily_steps_batch", write_batch)
+    monkeypatch.setattr(sync_worker, "update_device_sync_time", lambda uid, provider, sync_time=None: state["sync_times"].append(sync_time))
+    monkeypatch.setattr(sync_worker, "publish_ingest_batch", lambda events: None)
+
+    def run(uid, start, end, **kwargs):
+        return sync_device_for_user(uid, "fitbit", start, end, COMPETITIONS, {"tokens": {"access_token": "token"}}, record_bitmaps=False, **kwargs)
+
+    state["run"] = run
+    return state
+
+
+def test_catchup_advances_last_sync_through_stored_days_only(device_sync):
+    """A day the provider failed to return stops last_sync before it"""
+    device_sync["days"] = {"2025-03-01": 5000, "2025-03-02": 6000, "2025-03-04": 7000}
+    result = device_sync["run"]("catchup-gap@example.com", date(2025, 3, 1), date(2025, 3, 4))
+
+    assert result["submitted_count"] == 3
+    assert result["synced_through"] == "2025-03-02"
+    assert device_sync["sync_times"] == [datetime(2025, 3, 2)]
+
+
+def test_failed_write_keeps_days_for_the_next_run(device_sync):
+    uid = "catchup-fail@example.com"
+    device_sync["days"] = {"2025-03-01": 5000, "2025-03-02": 6000}
+    device_sync["fail_write"] = True
+    result = device_sync["run"](uid, date(2025, 3, 1), date(2025, 3, 2))
+
+    assert result["submitted_count"] == 0
+    assert device_sync["sync_times"] == []
+
+    device_sync["fail_write"] = False
+    result = device_sync["run"](uid, date(2025, 3, 1), date(2025, 3, 2))
+    assert result["submitted_count"] == 2
+    assert device_sync["writes"] == [{"2025-03-01": 5000, "2025-03-02": 6000}]
+
+
+def test_last_synced_day_resubmitted_when_its_count_grew(device_sync):
+    uid = "catchup-final@example.com"
+    device_sync["days"] = {"2025-03-05": 3000}
+    device_sync["run"](uid, date(2025, 3, 5), date(2025, 3, 5))
+
+    # Next night the window starts at the same day again, now with its final count
+    device_sync["days"] = {"2025-03-05": 9000, "2025-03-06": 4000}
+    result = device_sync["run"](uid, date(2025, 3, 5), date(2025, 3, 6))
+    assert result["submitted_count"] == 2
+    assert device_sync["writes"][-1] == {"2025-03-05": 9000, "2025-03-06": 4000}
+
+    # An unchanged count is a duplicate
+    result = device_sync["run"](uid, date(2025, 3, 5), date(2025, 3, 6))
+    assert result["submitted_count"] == 0
+    assert {s["reason"] for s in result["competitions"]} == {"duplicate"}
+
+
+def test_window_without_steps_still_advances_last_sync(device_sync):
+    device_sync["days"] = {"2025-03-01": 0, "2025-03-02": 0}
+    result = device_sync["run"]("catchup-idle@example.com", date(2025, 3, 1), date(2025, 3, 2))
+
+    assert result["steps"] == 0
+    assert device_sync["sync_times"] == [datetime(2025, 3, 2)]
+
+
+def test_partial_sync_leaves_last_sync_alone(device_sync):
+    device_sync["days"] = {"2025-03-03": 5000}
+    result = device_sync["run"]("catchup-webhook@example.com", date(2025, 3, 3), date(2025, 3, 3), partial=True)
+
+    assert result["submitted_count"] == 1
+    assert device_sync["sync_times"] == []
+
+
+def test_queue_dispatch_refreshes_tokens_before_enqueueing(monkeypatch):
+    """Queued tasks find fresh tokens: the cron refreshes the devices it enqueues first"""
+    from fastapi.testclient import TestClient
+
+    calls = []
+    devices = [
+        {"uid": "queue-a@example.com", "provider": "fitbit", "last_sync": None},
+        {"uid": "queue-idle@example.com", "provider": "fitbit", "last_sync": None},
+    ]
+    active = [{"comp_id": "comp-1", "start": date(2025, 3, 1), "grace_end": date(2099, 1, 1), "members": {"queue-a@example.com"}}]
+    monkeypatch.setattr(sync_worker, "SYNC_DISPATCH", "queue")
+    monkeypatch.setattr(sync_worker, "get_all_linked_devices", lambda: devices)
+    monkeypatch.setattr(sync_worker, "load_active_competitions", lambda today=None: active)
+    monkeypatch.setattr(sync_worker, "refresh_expiring_tokens", lambda due: calls.append(("refresh", [d["uid"] for d in due])) or {"due": len(due)})
+    monkeypatch.setattr(sync_worker, "enqueue_device_sync_tasks", lambda tasks: calls.append(("enqueue", [t["uid"] for t in tasks])) or {"queue": "test"})
+
+    response = TestClient(sync_worker.app).post("/cron/sync-devices")
+
+    assert response.status_code == 200
+    assert calls == [("refresh", ["queue-a@example.com"]), ("enqueue", ["queue-a@example.com"])]
+
+
+def test_devices_sync_concurrently_within_provider_limits(monkeypatch):
+    """Results keep the input order, per-provider limits hold and a crashing sync becomes an error result"""
+    import threading
+    import time
+
+    lock = threading.Lock()
+    in_flight = {"garmin": 0, "fitbit": 0}
+    peak = {"garmin": 0, "fitbit": 0}
+
+    def fake_sync(uid, provider, start, end, competitions, device_data, record_bitmaps=True):
+        if uid == "crash@example.com":
+            raise RuntimeError("boom")
+        with lock:
+            in_flight[provider] += 1
+            peak[provider] = max(peak[provider], in_flight[provider])
+        time.sleep(0.05)
+        with lock:
+            in_flight[provider] -= 1
+        return {"status": "success", "steps": 100, "competitions": []}
+
+    devices = [{"uid": f"concurrent-{i}@example.com", "provider": "garmin" if i % 2 else "fitbit", "last_sync": None} for i in range(8)]
+    devices.insert(3, {"uid": "crash@example.com", "provider": "fitbit", "last_sync": None})
+    members = {device["uid"] for device in devices}
+    active = [{"comp_id": "comp-1", "start": date(2025, 3, 1), "grace_end": date(2025, 3, 30), "members": members}]
+    monkeypatch.setattr(sync_worker, "sync_device_for_user", fake_sync)
+    monkeypatch.setattr(sync_worker, "SYNC_MAX_CONCURRENCY", 8)
+    monkeypatch.setattr(sync_worker, "SYNC_PROVIDER_CONCURRENCY", {"garmin": 1, "fitbit": 2})
+
+    results = sync_worker.sync_devices_concurrently(devices, date(2025, 3, 10), active)
+
+    assert [r["uid"] for r in results] == [device["uid"] for device in devices]
+    assert [r["status"] for r in results].count("error") == 1
+    assert results[3]["error"] == "boom"
+    assert peak == {"garmin": 1, "fitbit": 2}
@@ -0,0 +1,173 @@
+"""
+Unit tests for the steps.ingest push worker
+"""
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import worker
+
+
+def _submit_all(batcher, rows):
+    async def run():
+        return await asyncio.gather(*(batcher.submit(row) for row in rows), return_exceptions=True)
+    return asyncio.run(run())
+
+
+def test_concurrent_messages_share_one_write():
+    """Rows arriving within the window are flushed together"""
+    flushed = []
+    batcher = worker.MicroBatcher(flushed.append, window=0.01, max_size=10)
+
+    results = _submit_all(batcher, [{"n": 0}, {"n": 1}, {"n": 2}])
+
+    assert results == [None, None, None]
+    assert flushed == [[{"n": 0}, {"n": 1}, {"n": 2}]]
+
+
+def test_full_batch_flushes_before_the_window():
+    flushed = []
+    batcher = worker.MicroBatcher(flushed.append, window=10, max_size=2)
+
+    _submit_all(batcher, [{"n": i} for i in range(4)])
+
+    assert [len(rows) for rows in flushed] == [2, 2]
+
+
+def test_messages_are_acked_only_after_the_commit():
+    """submit() returns (the request answers 2xx) only once its batch is stored"""
+    committed = threading.Event()
+    batcher = worker.MicroBatcher(lambda rows: committed.wait(5), window=0.01, max_size=10)
+
+    async def run():
+        request = asyncio.ensure_future(batcher.submit({"n": 0}))
+        await asyncio.sleep(0.1)
+        pending = not request.done()
+        committed.set()
+        await request
+        return pending
+
+    assert asyncio.run(run()) is True
+
+
+def test_failed_commit_fails_every_message_in_the_batch():
+    """Each request of a failed batch gets the error, so Pub/Sub redelivers all of them"""
+    def fail(rows):
+        raise RuntimeError("Firestore unavailable")
+
+    batcher = worker.MicroBatcher(fail, window=0.01, max_size=10)
+
+    results = _submit_all(batcher, [{"n": 0}, {"n": 1}])
+
+    assert [str(result) for result in results] == ["Firestore unavailable"] * 2
+
+
+def test_push_answers_500_when_the_write_fails(monkeypatch):
+    import base64
+    import json
+    from fastapi.testclient import TestClient
+
+    def fail(rows):
+        raise RuntimeError("Firestore unavailable")
+
+    monkeypatch.setattr(worker, "batcher", worker.MicroBatcher(fail, window=0.01))
+    data = base64.b64encode(json.dumps({"user_id": "push@example.com", "date": "2025-03-01", "steps": 100}).encode()).decode()
+
+    response = TestClient(worker.app).post("/pubsub/push", json={"message": {"data": data}})
+
+    assert response.status_code == 500
+
+
+class FakeFirestore:
+    """Documents by path, with the batch/get_all calls write_rows makes"""
+
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+
+    def collection(self, name):
+        return SimpleNamespace(document=lambda doc_id: SimpleNamespace(id=doc_id, path=f"{name}/{doc_id}"))
+
+    def get_all(self, refs):
+        self.reads += 1
+        return [SimpleNamespace(id=ref.id, exists=ref.path in self.docs) for ref in refs]
+
+    def batch(self):
+        writes = []
+        return SimpleNamespace(
+            set=lambda ref, data, merge=False: writes.append((ref.path, data)),
+            commit=lambda: self.docs.update(writes),
+        )
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    """Fake Firestore/BigQuery clients and an empty dedupe cache"""
+    inserts = []
+
+    def insert_rows_json(table, rows, row_ids=None):
+        if stores.bq_errors:
+            return stores.bq_errors
+        inserts.append(list(row_ids))
+        return []
+
+    stores = SimpleNamespace(fs=FakeFirestore(), inserts=inserts, bq_errors=[])
+    monkeypatch.setattr(worker, "_fs_client", stores.fs)
+    monkeypatch.setattr(worker, "_bq_client", SimpleNamespace(insert_rows_json=insert_rows_json))
+    monkeypatch.setattr(worker, "recent_keys", worker.RecentKeys(max_size=100))
+    return stores
+
+
+def _row(key, steps=100):
+    return {"user_id": "dedupe@example.com", "date": "2025-03-01", "steps": steps, "idempotency_key": key}
+
+
+def test_stored_events_get_an_expiring_dedupe_record(stores):
+    """Each stored key gets a record with expire_at (the Firestore TTL field) DEDUPE_TTL_DAYS ahead"""
+    worker.write_rows([_row("fitbit_2025-03-01_dedupe@example.com")])
+
+    record = stores.fs.docs["ingest_dedupe/fitbit_2025-03-01_dedupe@example.com"]
+    expected = datetime.now(timezone.utc) + timedelta(days=worker.DEDUPE_TTL_DAYS)
+    assert abs(record["expire_at"] - expected) < timedelta(minutes=1)
+    assert stores.inserts == [["fitbit_2025-03-01_dedupe@example.com"]]
+
+
+def test_redelivered_events_are_skipped(stores, monkeypatch):
+    """Duplicates in a batch keep the first row; another process finds the persistent record"""
+    worker.write_rows([_row("key-a"), _row("key-a", steps=200), _row(None)])
+    assert len(stores.inserts[0]) == 2
+    assert stores.fs.docs["daily_steps/dedupe@example.com_2025-03-01"]["steps"] == 100
+
+    # Same process: the in-memory cache answers without a read
+    reads = stores.fs.reads
+    worker.write_rows([_row("key-a")])
+    assert stores.fs.reads == reads
+
+    # A fresh process (empty cache) reads the dedupe record
+    monkeypatch.setattr(worker, "recent_keys", worker.RecentKeys(max_size=100))
+    worker.write_rows([_row("key-a")])
+    assert len(stores.inserts) == 1
+    assert "key-a" in worker.recent_keys
+
+
+def test_keys_with_slashes_map_to_one_document(stores, monkeypatch):
+    worker.write_rows([_row("garmin/2025-03-01/user")])
+
+    assert "ingest_dedupe/garmin_2025-03-01_user" in stores.fs.docs
+    monkeypatch.setattr(worker, "recent_keys", worker.RecentKeys(max_size=100))
+    assert worker.filter_new_rows([_row("garmin/2025-03-01/user")]) == []
+
+
+def test_failed_bigquery_insert_leaves_no_dedupe_record(stores):
+    """The event only counts as stored once both writes succeeded, so a redelivery is written again"""
+    stores.bq_errors = [{"index": 0, "errors": ["backend error"]}]
+    with pytest.raises(RuntimeError):
+        worker.write_rows([_row("key-retry")])
+    assert stores.fs.docs == {}
+
+    stores.bq_errors = []
+    worker.write_rows([_row("key-retry")])
+    assert "ingest_dedupe/key-retry" in stores.fs.docs
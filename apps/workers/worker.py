@@ -1,9 +1,181 @@
-import base64, json, os
-from fastapi import FastAPI, Request
+import asyncio, base64, json, logging, os, threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from google.cloud import firestore, bigquery
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
 BQ_DATASET = os.getenv("BQ_DATASET", "stepsquad")
+# Messages arriving within this window are written together
+BATCH_WINDOW_SECONDS = float(os.getenv("BATCH_WINDOW_MS", "50")) / 1000
+BATCH_MAX_MESSAGES = int(os.getenv("BATCH_MAX_MESSAGES", "100"))  # Firestore batches cap at 500 writes (2 per message)
+# Idempotency keys of recently stored events, checked before the persistent record
+DEDUPE_CACHE_SIZE = int(os.getenv("DEDUPE_CACHE_SIZE", "10000"))
+# Persistent dedupe records expire (Firestore TTL on expire_at) well after Pub/Sub stops redelivering
+DEDUPE_COLLECTION = os.getenv("DEDUPE_COLLECTION", "ingest_dedupe")
+DEDUPE_TTL_DAYS = int(os.getenv("DEDUPE_TTL_DAYS", "14"))
+
+# Clients are created once per process; building them per message dominated latency
+_fs_client = None
+_bq_client = None
+
+
+def fs_client():
+    global _fs_client
+    if _fs_client is None:
+        _fs_client = firestore.Client()
+    return _fs_client
+
+
+def bq_client():
+    global _bq_client
+    if _bq_client is None:
+        _bq_client = bigquery.Client()
+    return _bq_client
+
+
+class RecentKeys:
+    """Bounded LRU set of idempotency keys already stored by this process"""
+
+    def __init__(self, max_size: int = DEDUPE_CACHE_SIZE):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return True
+            return False
+
+    def add_all(self, keys):
+        with self._lock:
+            for key in keys:
+                self._keys[key] = True
+                self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+
+recent_keys = RecentKeys()
+
+
+def dedupe_ref(key: str):
+    # Keys embed user emails etc.; "/" would split the document path
+    return fs_client().collection(DEDUPE_COLLECTION).document(key.replace("/", "_"))
+
+
+def filter_new_rows(rows: list) -> list:
+    """
+    Drop rows whose idempotency key was already stored
+
+    Checks the in-memory cache first, then reads the persistent records of the
+    remaining keys in one round trip. Duplicates within the batch keep the
+    first row. Rows without a key are always written.
+    """
+    fresh, unseen = [], {}
+    for row in rows:
+        key = row.get("idempotency_key")
+        if not key:
+            fresh.append(row)
+        elif key not in recent_keys and key not in unseen:
+            unseen[key] = row
+
+    if unseen:
+        stored = {snap.id for snap in fs_client().get_all([dedupe_ref(key) for key in unseen]) if snap.exists}
+        recent_keys.add_all(key for key in unseen if key.replace("/", "_") in stored)
+        fresh.extend(row for key, row in unseen.items() if key.replace("/", "_") not in stored)
+    return fresh
+
+
+def write_rows(rows: list):
+    """
+    Write a batch of step rows with one Firestore batch commit and one BigQuery insert
+
+    Events already stored (same idempotency_key) are skipped. BigQuery is written
+    first and the dedupe records are committed with the Firestore rows, so an
+    event only counts as stored once both writes succeeded; a failure in between
+    is redelivered and BigQuery drops the re-sent row by insertId.
+    """
+    rows = filter_new_rows(rows)
+    if not rows:
+        return
+
+    facts = [{"user_id": row["user_id"], "date": row["date"], "steps": row["steps"]} for row in rows]
+    row_ids = [row.get("idempotency_key") or f"{row['user_id']}_{row['date']}_{row['steps']}" for row in rows]
+    errors = bq_client().insert_rows_json(f"{BQ_DATASET}.fact_daily_steps", facts, row_ids=row_ids)
+    if errors:
+        raise RuntimeError(f"BigQuery insert failed: {errors}")
+
+    expire_at = datetime.now(timezone.utc) + timedelta(days=DEDUPE_TTL_DAYS)
+    keys = [row["idempotency_key"] for row in rows if row.get("idempotency_key")]
+    batch = fs_client().batch()
+    for fact in facts:
+        doc = fs_client().collection("daily_steps").document(f"{fact['user_id']}_{fact['date']}")
+        # updated_at: server write time, the fairness agent's incremental watermark
+        batch.set(doc, {**fact, "updated_at": firestore.SERVER_TIMESTAMP}, merge=True)
+    for key in keys:
+        batch.set(dedupe_ref(key), {"stored_at": firestore.SERVER_TIMESTAMP, "expire_at": expire_at})
+    batch.commit()
+    recent_keys.add_all(keys)
+
+
+class MicroBatcher:
+    """
+    Coalesces rows from concurrent push requests into one write
+
+    Each request awaits its batch's commit, so a message is only acknowledged
+    (2xx) once its row is stored; a failed commit fails every request in the
+    batch and Pub/Sub redelivers them.
+    """
+
+    def __init__(self, flush_fn, window: float = BATCH_WINDOW_SECONDS, max_size: int = BATCH_MAX_MESSAGES):
+        self.flush_fn = flush_fn
+        self.window = window
+        self.max_size = max_size
+        self._pending = []  # (row, future)
+        self._timer = None
+        self._commits = set()
+
+    async def submit(self, row: dict):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._commit(batch))
+            self._commits.add(task)
+            task.add_done_callback(self._commits.discard)
+
+    async def _commit(self, batch: list):
+        try:
+            await run_in_threadpool(self.flush_fn, [row for row, _ in batch])
+        except Exception as e:
+            logger.error(f"Failed to write batch of {len(batch)} messages: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+batcher = MicroBatcher(write_rows)
+
 
 @app.get("/health")
 def health():
@@ -21,12 +193,13 @@ async def pubsub_push(request: Request):
     uid = payload["user_id"]
     date = payload["date"]
     steps = int(payload["steps"])
+    key = payload.get("idempotency_key")
+    if key and key in recent_keys:
+        return {"status": "duplicate"}
 
-    fs = firestore.Client()
-    bq = bigquery.Client()
-    fs.collection("daily_steps").document(f"{uid}_{date}").set(
-        {"user_id": uid, "date": date, "steps": steps}, merge=True
-    )
-    bq.insert_rows_json(f"{BQ_DATASET}.fact_daily_steps",
-                        [{"user_id": uid, "date": date, "steps": steps}])
+    try:
+        await batcher.submit({"user_id": uid, "date": date, "steps": steps, "idempotency_key": key})
+    except Exception as e:
+        # Non-2xx makes Pub/Sub redeliver the message
+        raise HTTPException(status_code=500, detail=f"Write failed: {e}")
     return {"status": "ok"}
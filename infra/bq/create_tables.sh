@@ -3,4 +3,6 @@ set -euo pipefail
 : "${GOOGLE_CLOUD_PROJECT:?Set GOOGLE_CLOUD_PROJECT}"
 DATASET="${1:-stepsquad}"
 bq query --use_legacy_sql=false --parameter=DATASET::${DATASET} "$(cat create_tables.sql | sed 's/`\${DATASET}`/'\'${DATASET}\''/g)"
+# Tables created before clustering was added: clustering applies to newly written data
+bq update --clustering_fields=user_id "${DATASET}.fact_daily_steps" >/dev/null
 echo "Created dataset and tables in ${DATASET}"
@@ -1,6 +1,29 @@
 CREATE SCHEMA IF NOT EXISTS `${DATASET}`;
+-- Append-only: one row per write, so a (user_id, date) can appear many times
 CREATE TABLE IF NOT EXISTS `${DATASET}.fact_daily_steps` (
   user_id STRING,
   date DATE,
   steps INT64
-) PARTITION BY date;
+) PARTITION BY date
+CLUSTER BY user_id;
+-- One row per (user_id, date) with max(steps), maintained by the compaction MERGE
+-- (POST /cron/compact-daily-steps on the sync worker)
+CREATE TABLE IF NOT EXISTS `${DATASET}.daily_steps_curated` (
+  user_id STRING,
+  date DATE,
+  steps INT64,
+  updated_at TIMESTAMP
+) PARTITION BY date
+CLUSTER BY user_id;
+-- Per-competition daily aggregates from the rollup job (POST /cron/daily-rollups):
+-- one competition row (team_id and user_id NULL), one row per team, one per user
+CREATE TABLE IF NOT EXISTS `${DATASET}.daily_rollups` (
+  comp_id STRING,
+  date DATE,
+  team_id STRING,
+  user_id STRING,
+  steps INT64,
+  active_submitters INT64,
+  member_count INT64
+) PARTITION BY date
+CLUSTER BY comp_id;
@@ -21,6 +21,7 @@ resource "google_project_service" "services" {
     "bigquery.googleapis.com",
     "cloudscheduler.googleapis.com",
     "secretmanager.googleapis.com",
+    "iam.googleapis.com",
   ])
   project = var.project_id
   service = each.value
@@ -36,6 +37,142 @@ resource "google_pubsub_subscription" "steps_ingest_sub" {
   ack_deadline_seconds = 20
 }
 
+# One message per (uid, provider) device sync, pushed to the sync worker
+resource "google_pubsub_topic" "device_sync" {
+  name = "device.sync"
+}
+
+resource "google_pubsub_topic" "device_sync_dlq" {
+  name = "device.sync.dlq"
+}
+
+resource "google_pubsub_subscription" "device_sync_sub" {
+  name                 = "device.sync.sub"
+  topic                = google_pubsub_topic.device_sync.name
+  ack_deadline_seconds = 300
+
+  dynamic "push_config" {
+    for_each = var.sync_worker_url == "" ? [] : [var.sync_worker_url]
+    content {
+      push_endpoint = "${push_config.value}/tasks/sync-device"
+
+      # The sync worker does not allow unauthenticated calls
+      oidc_token {
+        service_account_email = google_service_account.device_sync_pusher.email
+      }
+    }
+  }
+
+  retry_policy {
+    minimum_backoff = "10s"
+    maximum_backoff = "600s"
+  }
+
+  dead_letter_policy {
+    dead_letter_topic     = google_pubsub_topic.device_sync_dlq.id
+    max_delivery_attempts = 5
+  }
+}
+
+resource "google_pubsub_subscription" "device_sync_dlq_sub" {
+  name  = "device.sync.dlq.sub"
+  topic = google_pubsub_topic.device_sync_dlq.name
+}
+
+# Identity Pub/Sub pushes device sync tasks as
+resource "google_service_account" "device_sync_pusher" {
+  account_id   = "device-sync-pusher"
+  display_name = "Device sync push invoker"
+}
+
+resource "google_cloud_run_v2_service_iam_member" "device_sync_pusher_invoker" {
+  count    = var.sync_worker_url == "" ? 0 : 1
+  name     = var.sync_worker_service
+  location = var.region
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${google_service_account.device_sync_pusher.email}"
+}
+
+data "google_project" "project" {}
+
+locals {
+  pubsub_service_agent = "serviceAccount:service-${data.google_project.project.number}@gcp-sa-pubsub.iam.gserviceaccount.com"
+}
+
+# The Pub/Sub service agent signs the push OIDC tokens
+resource "google_service_account_iam_member" "device_sync_pusher_token_creator" {
+  service_account_id = google_service_account.device_sync_pusher.name
+  role               = "roles/iam.serviceAccountTokenCreator"
+  member             = local.pubsub_service_agent
+}
+
+# Dead-lettering needs the service agent to publish to the DLQ and ack on the source subscription
+resource "google_pubsub_topic_iam_member" "device_sync_dlq_publisher" {
+  topic  = google_pubsub_topic.device_sync_dlq.name
+  role   = "roles/pubsub.publisher"
+  member = local.pubsub_service_agent
+}
+
+resource "google_pubsub_subscription_iam_member" "device_sync_sub_subscriber" {
+  subscription = google_pubsub_subscription.device_sync_sub.name
+  role         = "roles/pubsub.subscriber"
+  member       = local.pubsub_service_agent
+}
+
+# Ingest worker dedupe records (one per idempotency key) are deleted after expire_at
+resource "google_firestore_field" "ingest_dedupe_ttl" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "ingest_dedupe"
+  field      = "expire_at"
+
+  ttl_config {}
+  index_config {}
+}
+
+# Cached agent LLM responses are deleted after expire_at
+resource "google_firestore_field" "llm_cache_ttl" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "llm_cache"
+  field      = "expire_at"
+
+  ttl_config {}
+  index_config {}
+}
+
+# Incremental fairness runs read a competition's members' step writes since a watermark
+resource "google_firestore_index" "daily_steps_user_updated_at" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "daily_steps"
+
+  fields {
+    field_path = "user_id"
+    order      = "ASCENDING"
+  }
+  fields {
+    field_path = "updated_at"
+    order      = "ASCENDING"
+  }
+}
+
+# Agents read the days after a competition's read-model export for its members
+resource "google_firestore_index" "daily_steps_user_date" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "daily_steps"
+
+  fields {
+    field_path = "user_id"
+    order      = "ASCENDING"
+  }
+  fields {
+    field_path = "date"
+    order      = "ASCENDING"
+  }
+}
+
 resource "google_bigquery_dataset" "stepsquad" {
   dataset_id = var.bq_dataset
   location   = var.region
@@ -1,3 +1,6 @@
 output "topic_steps_ingest" { value = google_pubsub_topic.steps_ingest.name }
 output "sub_steps_ingest" { value = google_pubsub_subscription.steps_ingest_sub.name }
 output "bq_dataset" { value = google_bigquery_dataset.stepsquad.dataset_id }
+output "topic_device_sync" { value = google_pubsub_topic.device_sync.name }
+output "topic_device_sync_dlq" { value = google_pubsub_topic.device_sync_dlq.name }
+output "device_sync_pusher" { value = google_service_account.device_sync_pusher.email }
@@ -11,3 +11,15 @@ variable "bq_dataset" {
   type    = string
   default = "stepsquad"
 }
+
+variable "sync_worker_url" {
+  type        = string
+  default     = ""
+  description = "Base URL of the sync worker service; enables push delivery of device sync tasks"
+}
+
+variable "sync_worker_service" {
+  type        = string
+  default     = "stepsquad-workers"
+  description = "Cloud Run service name of the sync worker; the push service account is granted run.invoker on it"
+}